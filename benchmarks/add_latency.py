@@ -0,0 +1,59 @@
+"""Per-batch add latency of the hnswlib index with and without geometric capacity growth.
+
+A growth factor of 1.0 reproduces the previous behaviour of resizing the index to the exact
+number of elements on every add.
+
+    python benchmarks/add_latency.py --elements 100000 --batch-size 100 --dim 128
+"""
+import argparse
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib
+
+
+def run(growth_factor, elements, batch_size, dim):
+    settings = Settings(
+        persist_directory=tempfile.mkdtemp(),
+        chroma_index_growth_factor=growth_factor,
+        chroma_index_write_behind=True,
+        chroma_index_flush_interval=3600,
+    )
+    idx = Hnswlib(settings)
+    data = np.random.default_rng(0).random((elements, dim), dtype=np.float32)
+    ids = [uuid.uuid4() for _ in range(elements)]
+
+    latencies = []
+    for start in range(0, elements, batch_size):
+        s = time.perf_counter()
+        idx.add_incremental(
+            "bench", ids[start : start + batch_size], data[start : start + batch_size]
+        )
+        latencies.append(time.perf_counter() - s)
+    idx.stop()
+    return np.array(latencies[1:])  # the first batch builds the index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--growth-factor", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"{'growth':>8} {'total s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for factor in [1.0, args.growth_factor]:
+        latencies = run(factor, args.elements, args.batch_size, args.dim) * 1000
+        print(
+            f"{factor:>8.2f} {latencies.sum() / 1000:>9.2f} {np.percentile(latencies, 50):>8.2f} "
+            f"{np.percentile(latencies, 99):>8.2f} {latencies.max():>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Rows per second of DuckDB.add for adds of 1k, 100k and 1M rows.
+
+Each add is made to an empty in-memory database, with random embeddings, a small metadata
+dict and a document per row, as a numpy array and as lists of floats, the form the API passes
+them in. A statement per row, as rows were inserted before the columnar batch, is measured on
+the smallest add for reference; it is too slow to wait for on the larger ones. Lists of floats
+take several times the memory of the array, --inputs numpy leaves them out of large adds.
+
+    python benchmarks/duckdb_add.py --dim 768 --rows 1000 100000 1000000
+    python benchmarks/duckdb_add.py --dim 768 --rows 1000000 --inputs numpy
+"""
+import argparse
+import json
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.duckdb import DuckDB
+
+ROWS = [1000, 100000, 1000000]
+
+
+def row_at_a_time(db, collection_uuid, embeddings, metadatas, documents, ids):
+    """Inserts a statement per row, as DuckDB.add did before"""
+    data_to_insert = [
+        [
+            collection_uuid,
+            str(uuid.uuid4()),
+            embedding,
+            json.dumps(metadatas[i]),
+            documents[i],
+            ids[i],
+        ]
+        for i, embedding in enumerate(embeddings)
+    ]
+    db._conn.executemany(
+        "INSERT INTO embeddings (collection_uuid, uuid, embedding, metadata, document, id) "
+        "VALUES (?,?,?,?,?,?)",
+        data_to_insert,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--rows", type=int, nargs="+", default=ROWS)
+    parser.add_argument(
+        "--inputs", nargs="+", default=["numpy", "lists"], choices=["numpy", "lists"]
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    db = DuckDB(Settings(persist_directory=tempfile.mkdtemp()))
+    collection_uuid = str(uuid.uuid4())
+
+    print(f"{'rows':>8} {'input':>12} {'seconds':>8} {'rows/s':>10}")
+    for rows in args.rows:
+        embeddings = rng.random((rows, args.dim))
+        metadatas = [{"source": f"doc{i % 100}", "position": i} for i in range(rows)]
+        documents = [f"document {i}" for i in range(rows)]
+        ids = [f"id{i}" for i in range(rows)]
+
+        runs = [(name, db.add) for name in args.inputs]
+        if rows == min(args.rows):
+            runs.append(("row at a time", lambda *a: row_at_a_time(db, *a)))
+        for name, add in runs:
+            db._conn.execute("DELETE FROM embeddings")
+            data = embeddings if name == "numpy" else embeddings.tolist()
+            s = time.perf_counter()
+            add(collection_uuid, data, metadatas, documents, ids)
+            seconds = time.perf_counter() - s
+            print(f"{rows:>8} {name:>12} {seconds:>8.2f} {rows / seconds:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Latency of filtered queries at 0.1%, 1%, 10% and 50% selectivity.
+
+Each selectivity is run through the plan the index picks for it, and through each plan forced:
+the exact scan of the allowed vectors, the filtered graph search and the post-filtered one. The
+planned latency should be close to the lowest of the three at every selectivity.
+
+    python benchmarks/filtered_latency.py --elements 1000000 --dim 128 --queries 200
+"""
+import argparse
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib
+
+
+def build(settings, elements, dim, batch_size=100000):
+    idx = Hnswlib(settings)
+    rng = np.random.default_rng(0)
+    ids = [uuid.uuid4() for _ in range(elements)]
+    for start in range(0, elements, batch_size):
+        batch = rng.random((min(batch_size, elements - start), dim), dtype=np.float32)
+        idx.add_incremental("bench", ids[start : start + batch_size], batch)
+    return idx, ids
+
+
+def measure(idx, ids, selectivity, queries, k):
+    rng = np.random.default_rng(1)
+    allowed = [ids[i] for i in np.flatnonzero(rng.random(len(ids)) < selectivity)]
+    latencies = []
+    for query in queries:
+        s = time.perf_counter()
+        idx.get_nearest_neighbors("bench", [query], k, uuids=allowed)
+        latencies.append(time.perf_counter() - s)
+    return np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    idx, ids = build(Settings(persist_directory=directory), args.elements, args.dim)
+    queries = np.random.default_rng(2).random((args.queries, args.dim), dtype=np.float32)
+    selectivities = [0.001, 0.01, 0.1, 0.5]
+    never_exact = {"chroma_query_exact_threshold": 0, "chroma_query_exact_scan_cost": float("inf")}
+    # the same index files, with the planner forced to always take one path
+    forced = [
+        ("exact", {"chroma_query_exact_threshold": args.elements * args.dim}),
+        ("filtered", dict(never_exact, chroma_query_postfilter_selectivity=1.1)),
+        ("postfilter", dict(never_exact, chroma_query_postfilter_selectivity=0.0)),
+    ]
+
+    latencies = {("planned", s): measure(idx, ids, s, queries, args.k) for s in selectivities}
+    idx.stop()
+    del idx
+    for path, settings in forced:
+        # one copy of the index loaded at a time
+        index = Hnswlib(Settings(persist_directory=directory, **settings))
+        for selectivity in selectivities:
+            latencies[path, selectivity] = measure(index, ids, selectivity, queries, args.k)
+        index.stop()
+        del index
+
+    print(f"{'selectivity':>11} {'path':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for selectivity in selectivities:
+        for path in ["planned"] + [path for path, _ in forced]:
+            path_latencies = latencies[path, selectivity]
+            print(
+                f"{selectivity:>11.1%} {path:>10} {np.percentile(path_latencies, 50):>8.2f} "
+                f"{np.percentile(path_latencies, 99):>8.2f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Build time, memory, recall@k and queries per second of each index backend and its parameters.
+
+Vectors are drawn around random cluster centers, as embeddings are clustered, and the exact
+nearest neighbors of each query are found with numpy to measure recall against. Every
+configuration is built from the same vectors and searched at each of its search_ef values,
+one query at a time for latency and in a single batch for throughput.
+
+Results are written as json, and compared with the results of an earlier run when one is
+given as a baseline. The exit status is 1 if any configuration lost more recall or
+throughput than the tolerances allow, so that a run can gate a change.
+
+    python benchmarks/index_backends.py --elements 100000 --dim 128 --output run.json
+    python benchmarks/index_backends.py --elements 100000 --dim 128 --baseline run.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import uuid
+
+import hnswlib
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+
+# name, collection metadata, and the search_ef values to query it with; search_ef is the
+# candidate list of a graph and the number of lists an ivf index probes, and does not change
+# an exact scan
+CONFIGURATIONS = [
+    ("flat", {"index:type": "flat"}, [None]),
+    ("hnsw-M16", {"index:type": "hnsw", "hnsw:M": 16, "hnsw:construction_ef": 100}, [10, 50, 200]),
+    ("hnsw-M32", {"index:type": "hnsw", "hnsw:M": 32, "hnsw:construction_ef": 200}, [10, 50, 200]),
+    ("hnsw-4shards", {"index:type": "hnsw", "hnsw:M": 16, "hnsw:shards": 4}, [10, 50, 200]),
+    ("sq8", {"index:type": "sq8", "index:rerank": 0}, [None]),
+    ("sq8+rerank", {"index:type": "sq8"}, [None]),
+    ("pq+rerank", {"index:type": "pq"}, [None]),
+    ("ivf", {"index:type": "ivf"}, [4, 16, 64]),
+]
+
+
+def clustered(rng, elements, dim, clusters):
+    centers = rng.normal(size=(clusters, dim)) * 4
+    return (
+        centers[rng.integers(clusters, size=elements)] + rng.normal(size=(elements, dim))
+    ).astype(np.float32)
+
+
+def ground_truth(data, queries, k, space, block_size=1024):
+    """Labels of the exact k nearest neighbors of each query, scanning the data in blocks"""
+    if space == "cosine":
+        data = data / np.linalg.norm(data, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    norms = np.einsum("ij,ij->i", data, data)
+    truth = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), block_size):
+        block = queries[start : start + block_size]
+        if space == "l2":
+            distances = norms[None, :] - 2 * block @ data.T
+        else:
+            distances = -(block @ data.T)
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        truth[start : start + block_size] = np.take_along_axis(nearest, order, axis=1)
+    return truth
+
+
+def measure(idx, name, labels_of, queries, truth, k, search_ef):
+    latencies = []
+    found = []
+    for query in queries:
+        s = time.perf_counter()
+        results, _ = idx.get_nearest_neighbors(name, query[None, :], k, search_ef=search_ef)
+        latencies.append(time.perf_counter() - s)
+        found.append([labels_of[u] for u in results[0]])
+    recall = np.mean([len(np.intersect1d(f, t)) / k for f, t in zip(found, truth)])
+
+    s = time.perf_counter()
+    idx.get_nearest_neighbors(name, queries, k, search_ef=search_ef)
+    batch_time = time.perf_counter() - s
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "recall": float(recall),
+        "qps": float(len(queries) / (latencies.sum() / 1000)),
+        "batch_qps": float(len(queries) / batch_time),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def compare(results, baseline, recall_tolerance, qps_tolerance):
+    """Print each result against the baseline result of the same configuration and search_ef,
+    and return the number of regressions"""
+    previous = {(r["name"], r["search_ef"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"\n{'index':>12} {'ef':>5} {'recall':>14} {'qps':>16} {'batch qps':>16}")
+    for result in results:
+        before = previous.get((result["name"], result["search_ef"]))
+        if before is None:
+            continue
+        recall_delta = result["recall"] - before["recall"]
+        qps_ratio = result["qps"] / before["qps"]
+        batch_ratio = result["batch_qps"] / before["batch_qps"]
+        regressed = (
+            recall_delta < -recall_tolerance or min(qps_ratio, batch_ratio) < 1 - qps_tolerance
+        )
+        regressions += regressed
+        print(
+            f"{result['name']:>12} {str(result['search_ef']):>5} "
+            f"{result['recall']:>6.3f} {recall_delta:>+7.3f} "
+            f"{result['qps']:>8.0f} {qps_ratio:>6.2f}x "
+            f"{result['batch_qps']:>8.0f} {batch_ratio:>6.2f}x"
+            + ("  REGRESSED" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--space", default="l2", choices=["l2", "cosine", "ip"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--configs", nargs="+", choices=[c[0] for c in CONFIGURATIONS], help="all if not given"
+    )
+    parser.add_argument("--output", help="json file to write the results to")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare against")
+    parser.add_argument("--recall-tolerance", type=float, default=0.01)
+    parser.add_argument(
+        "--qps-tolerance", type=float, default=0.2, help="fraction of qps that may be lost"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    data = clustered(rng, args.elements + args.queries, args.dim, args.clusters)
+    data, queries = data[: args.elements], data[args.elements :]
+    s = time.perf_counter()
+    truth = ground_truth(data, queries, args.k, args.space)
+    print(f"exact neighbors of {args.queries} queries in {time.perf_counter() - s:.1f}s")
+
+    ids = [uuid.uuid4() for _ in range(args.elements)]
+    labels_of = {u: i for i, u in enumerate(ids)}
+    idx = Hnswlib(Settings(persist_directory=tempfile.mkdtemp()))
+
+    results = []
+    print(
+        f"{'index':>12} {'ef':>5} {'build s':>8} {'MB':>8} {'recall@' + str(args.k):>9} "
+        f"{'qps':>8} {'batch qps':>9} {'p50 ms':>7} {'p99 ms':>7}"
+    )
+    for name, metadata, search_efs in CONFIGURATIONS:
+        if args.configs and name not in args.configs:
+            continue
+        params = index_params_from_metadata(dict(metadata, **{"hnsw:space": args.space}))
+        s = time.perf_counter()
+        idx.build(name, len(ids), [(ids, data)], params)
+        build_time = time.perf_counter() - s
+        loaded = idx._get(name)
+        # the index alone, the uuid mapping is the same for every backend
+        megabytes = (loaded.nbytes() - loaded.ids.nbytes()) / 2**20
+
+        for search_ef in search_efs:
+            result = {
+                "name": name,
+                "metadata": metadata,
+                "backend": loaded.metadata["backend"],
+                "search_ef": search_ef,
+                "build_s": build_time,
+                "index_mb": megabytes,
+            }
+            result.update(measure(idx, name, labels_of, queries, truth, args.k, search_ef))
+            results.append(result)
+            print(
+                f"{name:>12} {str(search_ef):>5} {build_time:>8.2f} {megabytes:>8.1f} "
+                f"{result['recall']:>9.3f} {result['qps']:>8.0f} {result['batch_qps']:>9.0f} "
+                f"{result['p50_ms']:>7.2f} {result['p99_ms']:>7.2f}"
+            )
+        idx.delete(name)
+
+    run = {
+        "dataset": {
+            "elements": args.elements,
+            "dim": args.dim,
+            "clusters": args.clusters,
+            "queries": args.queries,
+            "k": args.k,
+            "space": args.space,
+            "seed": args.seed,
+        },
+        "environment": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "hnswlib": getattr(hnswlib, "__version__", None),
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["dataset"] != run["dataset"]:
+            print(f"\nthe baseline was run on a different dataset: {baseline['dataset']}")
+        if compare(results, baseline, args.recall_tolerance, args.qps_tolerance) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
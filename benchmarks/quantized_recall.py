@@ -0,0 +1,78 @@
+"""Recall@10 and resident memory of flat, hnsw, sq8 and pq indexes over the same vectors.
+
+Vectors are drawn around random cluster centers, so that they have structure for the
+quantizers to learn, as embeddings do. Quantized indexes are measured with and without
+re-ranking by exact distances.
+
+    python benchmarks/quantized_recall.py --elements 100000 --dim 128 --queries 200
+"""
+import argparse
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+
+
+def clustered(rng, elements, dim, clusters=100):
+    centers = rng.normal(size=(clusters, dim)) * 4
+    return (
+        centers[rng.integers(clusters, size=elements)] + rng.normal(size=(elements, dim))
+    ).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = clustered(rng, args.elements + args.queries, args.dim)
+    data, queries = data[: args.elements], data[args.elements :]
+    ids = [uuid.uuid4() for _ in range(args.elements)]
+    idx = Hnswlib(Settings(persist_directory=tempfile.mkdtemp()))
+
+    configurations = [
+        ("flat", {"index:type": "flat"}),
+        ("hnsw", {"index:type": "hnsw"}),
+        ("sq8", {"index:type": "sq8", "index:rerank": 0}),
+        ("sq8+rerank", {"index:type": "sq8"}),
+        ("pq", {"index:type": "pq", "index:rerank": 0}),
+        ("pq+rerank", {"index:type": "pq"}),
+        # twice the default subvectors, codes of an eighth rather than a sixteenth of the vectors
+        ("pq-2x+rerank", {"index:type": "pq", "pq:subvectors": args.dim // 2}),
+    ]
+    truth = None
+    print(f"{'index':>12} {'recall@10':>9} {'MB':>8} {'build s':>8} {'p50 ms':>8}")
+    for name, metadata in configurations:
+        s = time.perf_counter()
+        idx.build(name, len(ids), [(ids, data)], index_params_from_metadata(metadata))
+        build_time = time.perf_counter() - s
+
+        latencies = []
+        results = []
+        for query in queries:
+            s = time.perf_counter()
+            res, _ = idx.get_nearest_neighbors(name, [query], args.k)
+            latencies.append(time.perf_counter() - s)
+            results.append(set(res[0]))
+        if truth is None:
+            truth = results
+        recall = np.mean([len(r & t) / args.k for r, t in zip(results, truth)])
+        loaded = idx._get(name)
+        # the index alone, the uuid mapping is the same for all of them
+        megabytes = (loaded.nbytes() - loaded.ids.nbytes()) / 2**20
+        print(
+            f"{name:>12} {recall:>9.3f} {megabytes:>8.1f} {build_time:>8.2f} "
+            f"{np.percentile(latencies, 50) * 1000:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Throughput of batched k-nn queries split across threads, for batches of 1, 16 and 256 queries.
+
+Each batch is run with every thread count, through the same path as Collection.query, and
+its results are checked against the single-threaded ones. A batch smaller than
+chroma_query_min_queries_per_thread per thread is run with fewer threads, so single queries
+show the cost of the thread count check alone.
+
+    python benchmarks/query_threads.py --elements 100000 --dim 128 --threads 1 2 4 8
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+
+INDEX_TYPES = ["hnsw", "flat", "sq8", "ivf"]
+BATCH_SIZES = [1, 16, 256]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=2.0, help="time spent on each measurement")
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1})
+    )
+    parser.add_argument("--index-types", nargs="+", default=INDEX_TYPES, choices=INDEX_TYPES)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.random((args.elements, args.dim), dtype=np.float32)
+    ids = [uuid.uuid4() for _ in range(args.elements)]
+    idx = Hnswlib(Settings(persist_directory=tempfile.mkdtemp()))
+
+    print(
+        f"{'index':>5} {'batch':>5} {'threads':>7} {'ms/batch':>9} {'queries/s':>10} {'speedup':>7}"
+    )
+    for name in args.index_types:
+        idx.build(name, len(ids), [(ids, data)], index_params_from_metadata({"index:type": name}))
+        for batch_size in args.batch_sizes:
+            queries = rng.random((batch_size, args.dim), dtype=np.float32)
+            expected = None
+            baseline = None
+            for threads in args.threads:
+                results, _ = idx.get_nearest_neighbors(name, queries, args.k, num_threads=threads)
+                if expected is None:
+                    expected = results
+                assert (
+                    results == expected
+                ), f"{name} returned different results with {threads} threads"
+
+                batches = 0
+                s = time.perf_counter()
+                while time.perf_counter() - s < args.seconds:
+                    idx.get_nearest_neighbors(name, queries, args.k, num_threads=threads)
+                    batches += 1
+                latency = (time.perf_counter() - s) / batches
+                baseline = baseline or latency
+                print(
+                    f"{name:>5} {batch_size:>5} {threads:>7} {latency * 1000:>9.2f} "
+                    f"{batch_size / latency:>10.0f} {baseline / latency:>7.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
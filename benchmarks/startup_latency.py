@@ -0,0 +1,129 @@
+"""Time to load a collection's index and answer a first query in a fresh process, and the
+memory that process holds privately or shares with other processes through the page cache.
+
+A collection is built once for each index type, then loaded by --workers processes in turn,
+as uvicorn workers serving it would. Indexes saved as array files are memory mapped, so a
+process only maps them on load and reads their pages as queries touch them, while hnswlib
+reads its whole graph into private memory: hnsw, the backend of an auto index past
+chroma_index_flat_threshold elements, is not shared between processes.
+
+    python benchmarks/startup_latency.py --elements 1000000 --dim 128 --workers 2
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from chromadb.config import Settings
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+
+INDEX_TYPES = ["flat", "sq8", "ivf", "hnsw"]
+
+
+def resident_megabytes():
+    """Private (anonymous) and shared (file backed) resident memory of this process, from Linux"""
+    sizes = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                sizes[key] = int(value.split()[0]) / 1024
+    return sizes["RssAnon"], sizes["RssFile"]
+
+
+def worker(directory, name, dim, k):
+    """Load one collection in this process and report timings and memory as json"""
+    base = resident_megabytes()
+    s = time.perf_counter()
+    idx = Hnswlib(Settings(persist_directory=directory))
+    idx.load_if_not_loaded(name)
+    load = time.perf_counter() - s
+    loaded = resident_megabytes()
+
+    query = np.random.default_rng(1).random((1, dim), dtype=np.float32)
+    s = time.perf_counter()
+    idx.get_nearest_neighbors(name, query, k)
+    first_query = time.perf_counter() - s
+    queried = resident_megabytes()
+    print(
+        json.dumps(
+            {
+                "load": load,
+                "first_query": first_query,
+                "private_loaded": loaded[0] - base[0],
+                "private": queried[0] - base[0],
+                "shared": queried[1] - base[1],
+            }
+        )
+    )
+
+
+def build(directory, name, elements, dim, batch_size=100000):
+    idx = Hnswlib(Settings(persist_directory=directory))
+    rng = np.random.default_rng(0)
+
+    def chunks():
+        for start in range(0, elements, batch_size):
+            size = min(batch_size, elements - start)
+            yield [uuid.uuid4() for _ in range(size)], rng.random((size, dim), dtype=np.float32)
+
+    s = time.perf_counter()
+    idx.build(name, elements, chunks(), index_params_from_metadata({"index:type": name}))
+    build_time = time.perf_counter() - s
+    # saves the index and lets it go, so the built indexes do not stay in this process' memory
+    idx.stop()
+    return build_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--elements", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--index-types", nargs="+", default=INDEX_TYPES, choices=INDEX_TYPES)
+    parser.add_argument("--worker", nargs=2, metavar=("DIRECTORY", "NAME"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(*args.worker, args.dim, args.k)
+        return
+
+    directory = tempfile.mkdtemp()
+    print(
+        f"{'index':>5} {'build s':>8} {'worker':>6} {'load ms':>8} {'query ms':>8} "
+        f"{'private MB':>10} {'after query':>11} {'shared MB':>9}"
+    )
+    for name in args.index_types:
+        build_time = build(directory, name, args.elements, args.dim)
+        for i in range(args.workers):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--dim",
+                    str(args.dim),
+                    "--k",
+                    str(args.k),
+                    "--worker",
+                    directory,
+                    name,
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(
+                f"{name:>5} {build_time:>8.1f} {i:>6} {result['load'] * 1000:>8.1f} "
+                f"{result['first_query'] * 1000:>8.1f} {result['private_loaded']:>10.1f} "
+                f"{result['private']:>11.1f} {result['shared']:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
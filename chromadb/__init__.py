@@ -35,7 +35,15 @@ def get_db(settings=__settings):
         require("persist_directory")
         import chromadb.db.duckdb
 
-        return chromadb.db.duckdb.PersistentDuckDB(settings)
+        storage = settings.chroma_db_storage.lower()
+        if storage == "file":
+            return chromadb.db.duckdb.FileDuckDB(settings)
+        elif storage == "parquet":
+            return chromadb.db.duckdb.PersistentDuckDB(settings)
+        else:
+            raise ValueError(
+                f"Expected chroma_db_storage to be one of parquet, file, got {storage}"
+            )
     elif setting == "duckdb":
         require("persist_directory")
         logger.info("Using DuckDB in-memory for database. Data will be transient.")
@@ -61,7 +61,7 @@ class API(ABC):
 
         Args:
             name (str): The name of the collection to create. The name must be unique.
-            metadata (Optional[Dict], optional): A dictionary of metadata to associate with the collection. Defaults to None.
+            metadata (Optional[Dict], optional): A dictionary of metadata to associate with the collection. The keys "hnsw:space" (l2, cosine or ip), "hnsw:M", "hnsw:construction_ef", "hnsw:search_ef" and "hnsw:num_threads" configure the collection's index, and "index:type" picks an exact scan (flat), a graph (hnsw), a scan that becomes a graph as the collection grows (auto, the default), or a scan over int8 (sq8) or product quantized (pq) vectors, with "pq:subvectors" subvectors and the "index:rerank" * n_results nearest re-ranked by their exact distances, or an inverted file of "ivf:nlist" clusters kept on disk (ivf), of which "hnsw:search_ef" are probed. A graph is split into "hnsw:shards" graphs, built and searched in parallel. "index:partition_key" names a metadata key whose values each get an index of their own once they have chroma_index_partition_min_size elements, so that queries filtered to one value search only its elements. Defaults to None.
             get_or_create (bool, optional): If True, will return the collection if it already exists. Defaults to False.
             embedding_function (Optional[Callable], optional): A function that takes documents and returns an embedding. Defaults to None.
 
@@ -241,6 +241,9 @@ class API(ABC):
         where: Where = {},
         where_document: WhereDocument = {},
         include: Include = ["embeddings", "metadatas", "documents", "distances"],
+        search_ef: Optional[int] = None,
+        recall_target: Optional[float] = None,
+        num_threads: Optional[int] = None,
     ) -> QueryResult:
         """Gets the nearest neighbors of a single embedding
         ⚠️ This method should not be used directly.
@@ -249,6 +252,9 @@ class API(ABC):
             embedding (Sequence[float]): The embedding to find the nearest neighbors of
             n_results (int, optional): The number of nearest neighbors to return. Defaults to 10.
             where (Dict[str, str], optional): A dictionary of key-value pairs to filter the embeddings by. Defaults to {}.
+            search_ef (int, optional): The size of the candidate list of the index search. Derived from n_results and the collection size if None. Defaults to None.
+            recall_target (float, optional): The fraction of the exact nearest neighbors the search should find, using the collection's calibration. Defaults to None.
+            num_threads (int, optional): The most threads to split a batch of query embeddings across. The server's chroma_query_num_threads, or the collection's "hnsw:num_threads", if None. Defaults to None.
         """
         pass
 
@@ -290,3 +296,46 @@ class API(ABC):
 
         """
         pass
+
+    @abstractmethod
+    def warm_up(
+        self, collection_names: Optional[Sequence[str]] = None, queries: int = 10
+    ) -> Dict[str, bool]:
+        """Loads the indexes of collections, pins them in memory and runs synthetic queries
+        through them, so that the first queries after a start do not pay for loading them
+        ⚠️ This method should not be used directly.
+
+        Args:
+            collection_names (Optional[Sequence[str]], optional): The collections to warm up, or ["all"]. All collections if None. Defaults to None.
+            queries (int, optional): The number of synthetic queries to run on each index. Defaults to 10.
+
+        Returns:
+            Dict[str, bool]: Whether each collection had an index to warm up
+        """
+        pass
+
+    @abstractmethod
+    def index_status(self) -> Dict[str, Dict[str, bool]]:
+        """Returns whether the index of each collection is loaded in memory, and pinned there
+
+        Returns:
+            Dict[str, Dict[str, bool]]: The "loaded" and "pinned" state of each collection's index
+        """
+        pass
+
+    @abstractmethod
+    def calibrate_index(
+        self, collection_name: str, recall_targets: Optional[List[float]] = None
+    ) -> Dict[float, int]:
+        """Measures the search_ef needed to reach each recall target on a collection's index,
+        and keeps it for queries that ask for a recall_target.
+        ⚠️ This method should not be used directly.
+
+        Args:
+            collection_name (str): The collection whose index to calibrate
+            recall_targets (Optional[List[float]], optional): The recall targets to measure. Defaults to 0.9, 0.95 and 0.99.
+
+        Returns:
+            Dict[float, int]: The search_ef for each recall target
+        """
+        pass
@@ -231,6 +231,9 @@ class FastAPI(API):
         where={},
         where_document={},
         include: Include = ["metadatas", "documents", "distances"],
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
     ):
         """Gets the nearest neighbors of a single embedding"""
 
@@ -243,6 +246,9 @@ class FastAPI(API):
                     "where": where,
                     "where_document": where_document,
                     "include": include,
+                    "search_ef": search_ef,
+                    "recall_target": recall_target,
+                    "num_threads": num_threads,
                 }
             ),
         )
@@ -281,3 +287,34 @@ class FastAPI(API):
         except requests.HTTPError as e:
             raise (Exception(resp.text))
         return resp.json()
+
+    def warm_up(self, collection_names=None, queries=10):
+        """Loads, pins and warms up the indexes of collections on the server"""
+        resp = requests.post(
+            self._api_url + "/warm_up",
+            data=json.dumps({"collection_names": collection_names, "queries": queries}),
+        )
+        try:
+            resp.raise_for_status()
+        except requests.HTTPError as e:
+            raise (Exception(resp.text))
+        return resp.json()
+
+    def index_status(self):
+        """Returns whether the index of each collection is loaded on the server, and pinned"""
+        resp = requests.get(self._api_url + "/index_status")
+        resp.raise_for_status()
+        return resp.json()
+
+    def calibrate_index(self, collection_name: str, recall_targets=None):
+        """Measures the search_ef needed for each recall target on a collection's index"""
+        resp = requests.post(
+            self._api_url + "/collections/" + collection_name + "/calibrate_index",
+            data=json.dumps({"recall_targets": recall_targets}),
+        )
+        try:
+            resp.raise_for_status()
+        except requests.HTTPError as e:
+            raise (Exception(resp.text))
+        # json object keys are strings
+        return {float(target): ef for target, ef in resp.json().items()}
@@ -1,7 +1,8 @@
 import json
 import uuid
 import time
-from typing import Dict, List, Optional, Sequence, Callable, Type, cast
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Callable, Type, cast
 from chromadb.api import API
 from chromadb.db import DB
 from chromadb.api.types import (
@@ -107,6 +108,13 @@ class LocalAPI(API):
     def delete_collection(self, name: str):
         return self._db.delete_collection(name)
 
+    @contextmanager
+    def _collection(self, collection_name: str) -> Iterator[str]:
+        """The uuid of a collection, whose rows stay loaded until the block is done"""
+        collection_uuid = self._db.get_collection_uuid_from_name(collection_name)
+        with self._db.collection_in_use(collection_uuid):
+            yield collection_uuid
+
     #
     # ITEM METHODS
     #
@@ -120,17 +128,17 @@ class LocalAPI(API):
         increment_index: bool = True,
     ):
 
-        collection_uuid = self._db.get_collection_uuid_from_name(collection_name)
-        added_uuids = self._db.add(
-            collection_uuid,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            documents=documents,
-            ids=ids,
-        )
+        with self._collection(collection_name) as collection_uuid:
+            added_uuids = self._db.add(
+                collection_uuid,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                documents=documents,
+                ids=ids,
+            )
 
-        if increment_index:
-            self._db.add_incremental(collection_uuid, added_uuids, embeddings)
+            if increment_index:
+                self._db.add_incremental(collection_uuid, added_uuids, embeddings, metadatas)
 
         return True  # NIT: should this return the ids of the succesfully added items?
 
@@ -142,8 +150,8 @@ class LocalAPI(API):
         metadatas: Optional[Metadatas] = None,
         documents: Optional[Documents] = None,
     ):
-        collection_uuid = self._db.get_collection_uuid_from_name(collection_name)
-        self._db.update(collection_uuid, ids, embeddings, metadatas, documents)
+        with self._collection(collection_name) as collection_uuid:
+            self._db.update(collection_uuid, ids, embeddings, metadatas, documents)
 
         return True
 
@@ -178,16 +186,17 @@ class LocalAPI(API):
         db_columns = [column[:-1] for column in include] + ["id"]
         column_index = {column_name: index for index, column_name in enumerate(db_columns)}
 
-        db_result = self._db.get(
-            collection_name=collection_name,
-            ids=ids,
-            where=where,
-            sort=sort,
-            limit=limit,
-            offset=offset,
-            where_document=where_document,
-            columns=db_columns,
-        )
+        with self._collection(collection_name) as collection_uuid:
+            db_result = self._db.get(
+                collection_uuid=collection_uuid,
+                ids=ids,
+                where=where,
+                sort=sort,
+                limit=limit,
+                offset=offset,
+                where_document=where_document,
+                columns=db_columns,
+            )
 
         get_result = GetResult(
             ids=[],
@@ -213,13 +222,15 @@ class LocalAPI(API):
         if where_document is None:
             where_document = {}
 
-        deleted_uuids = self._db.delete(
-            collection_name=collection_name, where=where, ids=ids, where_document=where_document
-        )
+        with self._collection(collection_name) as collection_uuid:
+            deleted_uuids = self._db.delete(
+                collection_uuid=collection_uuid, where=where, ids=ids, where_document=where_document
+            )
         return deleted_uuids
 
     def _count(self, collection_name):
-        return self._db.count(collection_name=collection_name)
+        with self._collection(collection_name):
+            return self._db.count(collection_name=collection_name)
 
     def reset(self):
         self._db.reset()
@@ -233,13 +244,46 @@ class LocalAPI(API):
         where={},
         where_document={},
         include: Include = ["documents", "metadatas", "distances"],
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
+    ):
+        # the rows of the neighbors are read after the search, the collection stays loaded until
+        # they are
+        with self._collection(collection_name) as collection_uuid:
+            return self._query_collection(
+                collection_uuid,
+                query_embeddings,
+                n_results,
+                where,
+                where_document,
+                include,
+                search_ef,
+                recall_target,
+                num_threads,
+            )
+
+    def _query_collection(
+        self,
+        collection_uuid,
+        query_embeddings,
+        n_results,
+        where,
+        where_document,
+        include: Include,
+        search_ef,
+        recall_target,
+        num_threads,
     ):
         uuids, distances = self._db.get_nearest_neighbors(
-            collection_name=collection_name,
+            collection_uuid=collection_uuid,
             where=where,
             where_document=where_document,
             embeddings=query_embeddings,
             n_results=n_results,
+            search_ef=search_ef,
+            recall_target=recall_target,
+            num_threads=num_threads,
         )
 
         include_embeddings = "embeddings" in include
@@ -293,10 +337,34 @@ class LocalAPI(API):
         return self._db.raw_sql(raw_sql)
 
     def create_index(self, collection_name: str):
-        collection_uuid = self._db.get_collection_uuid_from_name(collection_name)
-        self._db.create_index(collection_uuid=collection_uuid)
+        with self._collection(collection_name) as collection_uuid:
+            self._db.create_index(collection_uuid=collection_uuid)
         return True
 
+    def calibrate_index(self, collection_name: str, recall_targets=None):
+        with self._collection(collection_name) as collection_uuid:
+            return self._db.calibrate_index(collection_uuid, recall_targets)
+
+    def _collection_uuids(self, collection_names=None) -> Dict[str, str]:
+        if collection_names is None or list(collection_names) == ["all"]:
+            return {c[1]: c[0] for c in self._db.list_collections()}
+        return {name: self._db.get_collection_uuid_from_name(name) for name in collection_names}
+
+    def warm_up(self, collection_names=None, queries=10):
+        if collection_names is None or list(collection_names) == ["all"]:
+            collection_names = [c[1] for c in self._db.list_collections()]
+        # looked up by name, which loads the rows of a collection where they are loaded on use
+        return {
+            name: self._db.warm_up_index(self._db.get_collection_uuid_from_name(name), queries)
+            for name in collection_names
+        }
+
+    def index_status(self):
+        return {
+            name: self._db.index_status(collection_uuid)
+            for name, collection_uuid in self._collection_uuids().items()
+        }
+
     def _peek(self, collection_name, n=10):
         return self._get(
             collection_name=collection_name,
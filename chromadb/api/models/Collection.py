@@ -162,6 +162,9 @@ class Collection(BaseModel):
         where: Optional[Where] = None,
         where_document: Optional[WhereDocument] = None,
         include: Include = ["metadatas", "documents", "distances"],
+        search_ef: Optional[int] = None,
+        recall_target: Optional[float] = None,
+        num_threads: Optional[int] = None,
     ) -> QueryResult:
         """Get the n_results nearest neighbor embeddings for provided query_embeddings or query_texts.
 
@@ -172,6 +175,9 @@ class Collection(BaseModel):
             where: A Where type dict used to filter results by. E.g. {"color" : "red", "price": 4.20}. Optional.
             where_document: A WhereDocument type dict used to filter by the documents. E.g. {$contains: {"text": "hello"}}. Optional.
             include: A list of what to include in the results. Can contain "embeddings", "metadatas", "documents", "distances". Ids are always included. Defaults to ["metadatas", "documents", "distances"]. Optional.
+            search_ef: The size of the candidate list of the index search, larger is slower and finds more of the true nearest neighbors. By default it is derived from n_results and the size of the collection. Optional.
+            recall_target: The fraction of the true nearest neighbors the search should find, e.g. 0.95. The index is calibrated for it on first use. Cannot be combined with search_ef. Optional.
+            num_threads: The most threads to split the query_embeddings across. A single query, or a batch too small to be worth splitting, runs on one thread. By default the server's chroma_query_num_threads setting, or else the collection's "hnsw:num_threads". Optional.
         """
         where = validate_where(where) if where else None
         where_document = validate_where_document(where_document) if where_document else None
@@ -179,6 +185,15 @@ class Collection(BaseModel):
         query_texts = maybe_cast_one_to_many(query_texts) if query_texts else None
         include = validate_include(include, allow_distances=True)
 
+        if search_ef is not None and recall_target is not None:
+            raise ValueError("You can provide search_ef or recall_target, but not both")
+        if search_ef is not None and (not isinstance(search_ef, int) or search_ef < 1):
+            raise ValueError(f"Expected search_ef to be a positive integer, got {search_ef}")
+        if recall_target is not None and not 0 < recall_target <= 1:
+            raise ValueError(f"Expected recall_target to be between 0 and 1, got {recall_target}")
+        if num_threads is not None and (not isinstance(num_threads, int) or num_threads < 1):
+            raise ValueError(f"Expected num_threads to be a positive integer, got {num_threads}")
+
         # If neither query_embeddings nor query_texts are provided, or both are provided, raise an error
         if (query_embeddings is None and query_texts is None) or (
             query_embeddings is not None and query_texts is not None
@@ -207,6 +222,9 @@ class Collection(BaseModel):
             where=where,
             where_document=where_document,
             include=include,
+            search_ef=search_ef,
+            recall_target=recall_target,
+            num_threads=num_threads,
         )
 
     def modify(self, name: Optional[str] = None, metadata=None):
@@ -293,3 +311,15 @@ class Collection(BaseModel):
 
     def create_index(self):
         self._client.create_index(self.name)
+
+    def calibrate_index(self, recall_targets: Optional[List[float]] = None) -> Dict[float, int]:
+        """Measure the search_ef that reaches each recall target on this collection, for queries
+        that ask for a recall_target. Worth rerunning after the collection has changed a lot.
+
+        Args:
+            recall_targets: The recall targets to measure. Defaults to 0.9, 0.95 and 0.99. Optional.
+
+        Returns:
+            The search_ef for each recall target
+        """
+        return self._client.calibrate_index(self.name, recall_targets)
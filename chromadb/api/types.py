@@ -47,10 +47,31 @@ class QueryResult(TypedDict):
     distances: Optional[List[List[float]]]
 
 
+class EfCalibration(TypedDict):
+    k: int
+    elements: int
+    ef: Dict[float, int]
+
+
 class IndexMetadata(TypedDict):
     dimensionality: int
     elements: int
+    deleted: int
+    capacity: int
     time_created: float
+    wal_sequence: int
+    space: str
+    M: int
+    ef_construction: int
+    ef: int
+    num_threads: int
+    index_type: str
+    rerank: int
+    pq_subvectors: Optional[int]
+    nlist: Optional[int]
+    shards: int
+    backend: str
+    ef_calibration: Optional[EfCalibration]
 
 
 class EmbeddingFunction(Protocol):
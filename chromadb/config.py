@@ -1,3 +1,4 @@
+from typing import List, Optional
 from pydantic import BaseSettings, Field
 
 
@@ -17,6 +18,46 @@ class Settings(BaseSettings):
     chroma_server_ssl_enabled: bool = False
     chroma_server_grpc_port: str = None
 
+    chroma_index_cache_bytes: int = 2 * 1024 * 1024 * 1024
+    chroma_index_growth_factor: float = 2.0
+    chroma_index_write_behind: bool = False
+    chroma_index_flush_interval: float = 5.0
+    chroma_index_flush_threshold: int = 100000
+    chroma_index_compaction_threshold: float = 0.3
+    chroma_index_build_chunk_size: int = 10000
+    chroma_index_flat_threshold: int = 50000
+    # saved snapshots of each index kept for processes that may still be loading them
+    chroma_index_snapshots_kept: int = 2
+    # collection names, or ["all"], whose indexes the server loads, pins and warms up at start
+    chroma_index_preload: List[str] = []
+    chroma_index_warmup_queries: int = 10
+    # elements a value of a collection's index:partition_key needs for a sub-index of its own,
+    # smaller partitions share one
+    chroma_index_partition_min_size: int = 1000
+
+    # how duckdb+parquet stores its data: "parquet" files loaded into memory at startup, or a
+    # duckdb database "file" read from as it is queried
+    chroma_db_storage: str = "parquet"
+
+    # segments of a persisted duckdb database past which they are merged in the background
+    chroma_db_max_segments: int = 8
+
+    # bytes of collection rows a duckdb+parquet database keeps loaded, past which the least
+    # recently used collections are detached until next used; 0 for no limit
+    chroma_db_memory_budget: int = 0
+
+    # rows times dimensions of the vectors a filtered query scans exactly whatever the size of the
+    # index, 512 vectors of 128 dimensions; larger scans are weighed against searching the index
+    chroma_query_exact_threshold: int = 65536
+    # what reading a vector out of an hnsw graph for an exact scan costs, in nodes expanded by a
+    # filtered search of the graph: about 12us against 4us at 128 dimensions
+    chroma_query_exact_scan_cost: float = 3.0
+    chroma_query_postfilter_selectivity: float = 0.5
+    # threads a batch of queries is split across, the collection's hnsw:num_threads if None,
+    # and the fewest queries worth starting a thread for
+    chroma_query_num_threads: Optional[int] = None
+    chroma_query_min_queries_per_thread: int = 16
+
     def __getitem__(self, item):
         return getattr(self, item)
 
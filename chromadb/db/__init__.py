@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List, Sequence, Optional, Tuple
+from typing import ContextManager, Dict, List, Sequence, Optional, Tuple
 from uuid import UUID
 import numpy.typing as npt
 from chromadb.api.types import Embeddings, Documents, IDs, Metadatas, Where, WhereDocument
@@ -50,7 +50,13 @@ class DB(ABC):
         pass
 
     @abstractmethod
-    def add_incremental(self, collection_uuid: str, ids: List[UUID], embeddings: Embeddings):
+    def add_incremental(
+        self,
+        collection_uuid: str,
+        ids: List[UUID],
+        embeddings: Embeddings,
+        metadatas: Optional[Metadatas] = None,
+    ):
         pass
 
     @abstractmethod
@@ -100,7 +106,15 @@ class DB(ABC):
 
     @abstractmethod
     def get_nearest_neighbors(
-        self, collection_name, where, embeddings, n_results, where_document
+        self,
+        collection_name,
+        where,
+        embeddings,
+        n_results,
+        where_document,
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
     ) -> Tuple[List[List[UUID]], npt.NDArray]:
         pass
 
@@ -108,6 +122,10 @@ class DB(ABC):
     def get_by_ids(self, uuids, columns=None) -> Sequence:
         pass
 
+    @abstractmethod
+    def collection_in_use(self, collection_uuid: str) -> ContextManager:
+        pass
+
     @abstractmethod
     def raw_sql(self, raw_sql):
         pass
@@ -116,10 +134,22 @@ class DB(ABC):
     def create_index(self, collection_uuid: str):
         pass
 
+    @abstractmethod
+    def calibrate_index(self, collection_uuid: str, recall_targets=None):
+        pass
+
     @abstractmethod
     def has_index(self, collection_name):
         pass
 
+    @abstractmethod
+    def warm_up_index(self, collection_uuid: str, queries: int = 10) -> bool:
+        pass
+
+    @abstractmethod
+    def index_status(self, collection_uuid: str) -> Dict[str, bool]:
+        pass
+
     @abstractmethod
     def persist(self):
         pass
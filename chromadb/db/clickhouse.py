@@ -1,6 +1,6 @@
 from chromadb.api.types import Documents, Embeddings, IDs, Metadatas, Where, WhereDocument
 from chromadb.db import DB
-from chromadb.db.index.hnswlib import Hnswlib
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
 from chromadb.errors import (
     NoDatapointsException,
     InvalidDimensionException,
@@ -8,9 +8,11 @@ from chromadb.errors import (
 )
 import uuid
 import time
+import numpy as np
 import numpy.typing as npt
 import json
-from typing import Dict, Optional, Sequence, List, Tuple, cast
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence, List, Tuple, cast
 import clickhouse_connect
 from clickhouse_connect.driver.client import Client
 from clickhouse_connect import common
@@ -85,7 +87,9 @@ class Clickhouse(DB):
     #  UTILITY METHODS
     #
     def persist(self):
-        raise NotImplementedError("Clickhouse is a persistent database, this method is not needed")
+        # the database itself is persistent, only index writes held back by the
+        # write-behind mode need saving
+        self._idx.persist()
 
     def get_collection_uuid_from_name(self, name: str) -> str:
         res = self._get_conn().query(
@@ -95,6 +99,19 @@ class Clickhouse(DB):
         )
         return res.result_rows[0][0]
 
+    def _get_index_params(self, collection_uuid: str) -> Dict:
+        res = (
+            self._get_conn()
+            .query(
+                f"""
+            SELECT metadata FROM collections WHERE uuid = '{collection_uuid}'
+        """
+            )
+            .result_rows
+        )
+        metadata = json.loads(res[0][0]) if len(res) > 0 else None
+        return index_params_from_metadata(metadata)
+
     def _create_where_clause(
         self,
         collection_uuid: str,
@@ -133,6 +150,7 @@ class Clickhouse(DB):
             else:
                 raise ValueError(f"Collection with name {name} already exists")
 
+        index_params_from_metadata(metadata)  # validate the index configuration
         collection_uuid = uuid.uuid4()
         data_to_insert = [[collection_uuid, name, json.dumps(metadata)]]
 
@@ -163,8 +181,11 @@ class Clickhouse(DB):
     ):
         if new_name is None:
             new_name = current_name
+        collection_uuid, _, metadata = self.get_collection(current_name)[0]
         if new_metadata is None:
-            new_metadata = self.get_collection(current_name)[0][2]
+            new_metadata = metadata
+        # an index already built is kept in line with its configuration, or the change refused
+        self._idx.reconfigure(collection_uuid, index_params_from_metadata(new_metadata))
 
         return self._get_conn().command(
             f"""
@@ -263,15 +284,31 @@ class Clickhouse(DB):
         existing_items = self.get(collection_uuid=collection_uuid, ids=ids)
         if len(existing_items) != len(ids):
             raise ValueError(f"Could not find {len(ids) - len(existing_items)} items for update")
+        # in the order of ids, which the new values are given in
+        keys = db_schema_to_keys()
+        by_id = {item[keys.index("id")]: item for item in existing_items}
+        existing_items = [by_id[id] for id in ids]
 
         # Update the db
         self._update(collection_uuid, ids, embeddings, metadatas, documents)
 
-        # Update the index
-        if embeddings is not None:
-            update_uuids = [x[1] for x in existing_items]
-            self._idx.delete_from_index(collection_uuid, update_uuids)
-            self._idx.add_incremental(collection_uuid, update_uuids, embeddings)
+        # Update the index, moving elements whose partition changes to their new partition
+        partition_key = self._idx.partition_key(collection_uuid)
+        if embeddings is not None or (partition_key is not None and metadatas is not None):
+            update_uuids = [x[keys.index("uuid")] for x in existing_items]
+            if embeddings is None:
+                embeddings = [x[keys.index("embedding")] for x in existing_items]
+            old_metadatas = [x[keys.index("metadata")] for x in existing_items]
+            self._idx.delete_from_index(
+                collection_uuid, update_uuids, self._partitions(partition_key, old_metadatas)
+            )
+            self._add_to_index(
+                collection_uuid,
+                update_uuids,
+                embeddings,
+                metadatas if metadatas is not None else old_metadatas,
+                partition_key,
+            )
 
     def _get(self, where={}, columns: Optional[List] = None):
         select_columns = db_schema_to_keys() if columns is None else columns
@@ -440,9 +477,19 @@ class Clickhouse(DB):
             where_document=where_document,
         )
 
+        partition_key = self._idx.partition_key(collection_uuid)
+        partition_of = {}
+        if partition_key is not None:
+            for row_uuid, metadata in self._get(where=where_str, columns=["uuid", "metadata"]):
+                partition_of[row_uuid] = (metadata or {}).get(partition_key)
+
         deleted_uuids = self._delete(where_str)
 
-        self._idx.delete_from_index(collection_uuid, deleted_uuids)
+        self._idx.delete_from_index(
+            collection_uuid,
+            deleted_uuids,
+            [partition_of.get(u) for u in deleted_uuids] if partition_key is not None else None,
+        )
 
         return deleted_uuids
 
@@ -464,6 +511,12 @@ class Clickhouse(DB):
 
         return response
 
+    @contextmanager
+    def collection_in_use(self, collection_uuid: str):
+        """Keep the rows of a collection loaded while the block runs, so that a call on it reads
+        and writes them all along; the rows are always at hand here"""
+        yield
+
     def get_nearest_neighbors(
         self,
         where: Where,
@@ -472,6 +525,9 @@ class Clickhouse(DB):
         n_results: int,
         collection_name=None,
         collection_uuid=None,
+        search_ef: Optional[int] = None,
+        recall_target: Optional[float] = None,
+        num_threads: Optional[int] = None,
     ) -> Tuple[List[List[uuid.UUID]], npt.NDArray]:
 
         # Either the collection name or the collection uuid must be provided
@@ -481,21 +537,33 @@ class Clickhouse(DB):
         if collection_name is not None:
             collection_uuid = self.get_collection_uuid_from_name(collection_name)
 
-        self._idx.load_if_not_loaded(collection_uuid)
-
-        idx_metadata = self._idx.get_metadata()
+        idx_metadata = self._idx.get_metadata(collection_uuid)
         # Check query embeddings dimensionality
         if idx_metadata["dimensionality"] != len(embeddings[0]):
             raise InvalidDimensionException(
                 f"Query embeddings dimensionality {len(embeddings[0])} does not match index dimensionality {idx_metadata['dimensionality']}"
             )
 
-        # Check number of requested results
-        if n_results > idx_metadata["elements"]:
+        # Check number of requested results, against the elements that have not been deleted
+        elements = idx_metadata["elements"] - idx_metadata["deleted"]
+        if n_results > elements:
             raise NotEnoughElementsException(
-                f"Number of requested results {n_results} cannot be greater than number of elements in index {idx_metadata['elements']}"
+                f"Number of requested results {n_results} cannot be greater than number of elements in index {elements}"
             )
 
+        # a query for a single value of the partition key is answered from its sub-index, with no
+        # filter at all if the value has a sub-index of its own
+        index_uuid = collection_uuid
+        route = (
+            self._idx.partition_route(collection_uuid, where) if len(where_document) == 0 else None
+        )
+        if route is not None:
+            index_uuid, filtered = route
+            if not filtered:
+                idx_metadata = self._idx.get_metadata(index_uuid)
+                n_results = min(n_results, idx_metadata["elements"] - idx_metadata["deleted"])
+                where = {}
+
         if len(where) != 0 or len(where_document) != 0:
             results = self.get(
                 collection_uuid=collection_uuid, where=where, where_document=where_document
@@ -510,7 +578,7 @@ class Clickhouse(DB):
         else:
             ids = None
         uuids, distances = self._idx.get_nearest_neighbors(
-            collection_uuid, embeddings, n_results, ids
+            index_uuid, embeddings, n_results, ids, search_ef, recall_target, num_threads
         )
 
         return uuids, distances
@@ -523,19 +591,100 @@ class Clickhouse(DB):
         Returns:
             None
         """
-        get = self.get(collection_uuid=collection_uuid)
+        params = self._get_index_params(collection_uuid)
+        self._idx.build(
+            collection_uuid,
+            self._count_embeddings(collection_uuid),
+            self._stream_embeddings(
+                collection_uuid,
+                self._settings.chroma_index_build_chunk_size,
+                params["partition_key"],
+            ),
+            params,
+        )
+
+    def _count_embeddings(self, collection_uuid) -> int:
+        return self._count(collection_uuid=collection_uuid)[0][0]
+
+    def _stream_embeddings(
+        self, collection_uuid, chunk_size: int, partition_key: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        """Read only the uuids and embeddings of a collection, in blocks of at most chunk_size
+        rows, each with its embeddings as one float32 array, and the values of partition_key
+        if one is given"""
+        columns = "uuid, embedding" if partition_key is None else "uuid, embedding, metadata"
+        with self._get_conn().query_column_block_stream(
+            f"SELECT {columns} FROM embeddings WHERE collection_uuid = '{collection_uuid}'",
+            settings={"max_block_size": chunk_size},
+        ) as stream:
+            for block in stream:
+                uuids, embeddings = list(block[0]), np.asarray(block[1], dtype=np.float32)
+                if partition_key is None:
+                    yield uuids, embeddings
+                else:
+                    metadatas = [json.loads(m) if m else None for m in block[2]]
+                    yield uuids, embeddings, self._partitions(partition_key, metadatas)
 
-        uuids = [x[1] for x in get]
-        embeddings = [x[2] for x in get]
+    def calibrate_index(self, collection_uuid: str, recall_targets=None):
+        """Measure the search ef that reaches each recall target for a collection's index.
+        Args:
+            collection_uuid (str): The collection_uuid whose index to calibrate
+            recall_targets (List[float], optional): The recall targets to measure. Defaults to 0.9, 0.95 and 0.99.
+        Returns:
+            Dict[float, int]: The ef for each recall target
+        """
+        if recall_targets is None:
+            return self._idx.calibrate(collection_uuid)
+        return self._idx.calibrate(collection_uuid, recall_targets)
+
+    def add_incremental(self, collection_uuid, uuids, embeddings, metadatas=None):
+        # the index configuration is only needed when the first add creates the index
+        if self._idx.has_index(collection_uuid):
+            params = None
+            partition_key = self._idx.partition_key(collection_uuid)
+        else:
+            params = self._get_index_params(collection_uuid)
+            partition_key = params["partition_key"]
+        self._add_to_index(collection_uuid, uuids, embeddings, metadatas, partition_key, params)
 
-        self._idx.run(collection_uuid, uuids, embeddings)
+    def _add_to_index(
+        self, collection_uuid, uuids, embeddings, metadatas, partition_key, params=None
+    ):
+        if partition_key is None:
+            self._idx.add_incremental(collection_uuid, uuids, embeddings, params)
+            return
+
+        def members(value):
+            # the elements of a partition, to move to a sub-index of its own once it is large enough
+            rows = self.get(
+                collection_uuid=collection_uuid, where={partition_key: value}, columns=["uuid"]
+            )
+            return [row[0] for row in rows]
+
+        self._idx.add_incremental(
+            collection_uuid,
+            uuids,
+            embeddings,
+            params,
+            self._partitions(partition_key, metadatas or [None] * len(uuids)),
+            members,
+        )
 
-    def add_incremental(self, collection_uuid, uuids, embeddings):
-        self._idx.add_incremental(collection_uuid, uuids, embeddings)
+    def _partitions(self, partition_key: Optional[str], metadatas) -> Optional[List]:
+        """The values of the partition key of each element, None if the index is not partitioned"""
+        if partition_key is None:
+            return None
+        return [(metadata or {}).get(partition_key) for metadata in metadatas]
 
     def has_index(self, collection_uuid: str):
         return self._idx.has_index(collection_uuid)
 
+    def warm_up_index(self, collection_uuid: str, queries: int = 10) -> bool:
+        return self._idx.warm_up(collection_uuid, queries)
+
+    def index_status(self, collection_uuid: str) -> Dict[str, bool]:
+        return self._idx.index_status(collection_uuid)
+
     def reset(self):
         conn = self._get_conn()
         conn.command("DROP TABLE collections")
@@ -544,6 +693,7 @@ class Clickhouse(DB):
         self._create_table_embeddings(conn)
 
         self._idx.reset()
+        self._idx.stop()
         self._idx = Hnswlib(self._settings)
 
     def raw_sql(self, sql):
@@ -1,6 +1,7 @@
 from chromadb.api.types import Documents, Embeddings, IDs, Metadatas
 from chromadb.db import DB
-from chromadb.db.index.hnswlib import Hnswlib
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+from chromadb.db.segments import Segments, latest_rows
 from chromadb.db.clickhouse import (
     Clickhouse,
     db_array_schema_to_clickhouse_schema,
@@ -8,7 +9,8 @@ from chromadb.db.clickhouse import (
     db_schema_to_keys,
     COLLECTION_TABLE_SCHEMA,
 )
-from typing import List, Optional, Sequence, Dict
+from typing import Iterator, List, Optional, Sequence, Dict, Tuple
+import numpy as np
 import pandas as pd
 import json
 import duckdb
@@ -16,6 +18,13 @@ import uuid
 import time
 import itertools
 import logging
+import os
+import shutil
+import threading
+import atexit
+import weakref
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
 
 logger = logging.getLogger(__name__)
 
@@ -36,16 +45,23 @@ def clickhouse_to_duckdb_schema(table_schema):
     return table_schema
 
 
+def _embedding_column(embeddings) -> List:
+    """The embeddings as rows of a float64 matrix, which duckdb reads as lists without a python
+    float per element, or as they are if they differ in length"""
+    try:
+        matrix = np.asarray(embeddings, dtype=np.float64)
+    except ValueError:
+        return list(embeddings)
+    return list(matrix) if matrix.ndim == 2 else list(embeddings)
+
+
 # TODO: inherits ClickHouse for convenience of copying behavior, not
 # because it's logically a subtype. Factoring out the common behavior
 # to a third superclass they both extend would be preferable.
 class DuckDB(Clickhouse):
     # duckdb has a different way of connecting to the database
     def __init__(self, settings):
-
-        logger.warning("Using embedded DuckDB without persistence: data will be transient")
-
-        self._conn = duckdb.connect()
+        self._conn = self._connect(settings)
         self._create_table_collections()
         self._create_table_embeddings()
         self._idx = Hnswlib(settings)
@@ -55,9 +71,28 @@ class DuckDB(Clickhouse):
         self._conn.execute("INSTALL 'json';")
         self._conn.execute("LOAD 'json';")
 
+    def _connect(self, settings):
+        logger.warning("Using embedded DuckDB without persistence: data will be transient")
+        return duckdb.connect()
+
+    @property
+    def _conn(self):
+        """The connection of the calling thread to the database. Results, registered views and
+        transactions belong to a connection, threads sharing one would read each other's results
+        and run their statements in each other's transactions"""
+        local = self._local
+        if not hasattr(local, "conn"):
+            local.conn = self._database.cursor()
+        return local.conn
+
+    @_conn.setter
+    def _conn(self, conn):
+        self._database = conn
+        self._local = threading.local()
+
     def _create_table_collections(self):
         self._conn.execute(
-            f"""CREATE TABLE collections (
+            f"""CREATE TABLE IF NOT EXISTS collections (
             {db_array_schema_to_clickhouse_schema(clickhouse_to_duckdb_schema(COLLECTION_TABLE_SCHEMA))}
         ) """
         )
@@ -65,7 +100,7 @@ class DuckDB(Clickhouse):
     # duckdb has different types, so we want to convert the clickhouse schema to duckdb schema
     def _create_table_embeddings(self):
         self._conn.execute(
-            f"""CREATE TABLE embeddings (
+            f"""CREATE TABLE IF NOT EXISTS embeddings (
             {db_array_schema_to_clickhouse_schema(clickhouse_to_duckdb_schema(EMBEDDING_TABLE_SCHEMA))}
         ) """
         )
@@ -73,11 +108,28 @@ class DuckDB(Clickhouse):
     #
     #  UTILITY METHODS
     #
+    @contextmanager
+    def _view(self, rows: pd.DataFrame) -> Iterator[str]:
+        """Register rows as a view of the calling thread's connection, under a name of its own"""
+        name = f"rows_{uuid.uuid4().hex}"
+        self._conn.register(name, rows)
+        try:
+            yield name
+        finally:
+            self._conn.unregister(name)
+
     def get_collection_uuid_from_name(self, name):
         return self._conn.execute(
             f"""SELECT uuid FROM collections WHERE name = ?""", [name]
         ).fetchall()[0][0]
 
+    def _get_index_params(self, collection_uuid):
+        res = self._conn.execute(
+            f"""SELECT metadata FROM collections WHERE uuid = ?""", [str(collection_uuid)]
+        ).fetchall()
+        metadata = json.loads(res[0][0]) if len(res) > 0 else None
+        return index_params_from_metadata(metadata)
+
     #
     #  COLLECTION METHODS
     #
@@ -93,6 +145,7 @@ class DuckDB(Clickhouse):
             else:
                 raise ValueError(f"Collection with name {name} already exists")
 
+        index_params_from_metadata(metadata)  # validate the index configuration
         self._conn.execute(
             f"""INSERT INTO collections (uuid, name, metadata) VALUES (?, ?, ?)""",
             [str(uuid.uuid4()), name, json.dumps(metadata)],
@@ -121,8 +174,11 @@ class DuckDB(Clickhouse):
     ):
         if new_name is None:
             new_name = current_name
+        collection_uuid, _, metadata = self.get_collection(current_name)[0]
         if new_metadata is None:
-            new_metadata = self.get_collection(current_name)[0][2]
+            new_metadata = metadata
+        # an index already built is kept in line with its configuration, or the change refused
+        self._idx.reconfigure(collection_uuid, index_params_from_metadata(new_metadata))
 
         self._conn.execute(
             f"""UPDATE collections SET name = ?, metadata = ? WHERE name = ?""",
@@ -134,27 +190,29 @@ class DuckDB(Clickhouse):
     #
     # the execute many syntax is different than clickhouse, the (?,?) syntax is different than clickhouse
     def add(self, collection_uuid, embeddings, metadatas, documents, ids):
-        data_to_insert = [
-            [
-                collection_uuid,
-                str(uuid.uuid4()),
-                embedding,
-                json.dumps(metadatas[i]) if metadatas else None,
-                documents[i] if documents else None,
-                ids[i],
-            ]
-            for i, embedding in enumerate(embeddings)
-        ]
+        uuids = [uuid.uuid4() for _ in range(len(embeddings))]
+        # inserted as a single columnar batch, a statement per row spends most of its time
+        # converting each row and its floats on the way in
+        batch = pd.DataFrame(
+            {
+                "collection_uuid": [collection_uuid] * len(uuids),
+                "uuid": [str(u) for u in uuids],
+                "embedding": _embedding_column(embeddings),
+                "metadata": [json.dumps(m) for m in metadatas] if metadatas else None,
+                "document": documents if documents else None,
+                "id": ids,
+            }
+        )
 
         insert_string = "collection_uuid, uuid, embedding, metadata, document, id"
 
-        self._conn.executemany(
-            f"""
-         INSERT INTO embeddings ({insert_string}) VALUES (?,?,?,?,?,?)""",
-            data_to_insert,
-        )
+        with self._view(batch) as view:
+            self._conn.execute(
+                f"""
+            INSERT INTO embeddings ({insert_string}) SELECT {insert_string} FROM {view}"""
+            )
 
-        return [uuid.UUID(x[1]) for x in data_to_insert]  # return uuids
+        return uuids
 
     def _count(self, collection_uuid):
         where_string = f"WHERE collection_uuid = '{collection_uuid}'"
@@ -164,6 +222,34 @@ class DuckDB(Clickhouse):
         collection_uuid = self.get_collection_uuid_from_name(collection_name)
         return self._count(collection_uuid=collection_uuid).fetchall()[0][0]
 
+    def _count_embeddings(self, collection_uuid) -> int:
+        return self._count(collection_uuid=collection_uuid).fetchall()[0][0]
+
+    def _stream_embeddings(
+        self, collection_uuid, chunk_size: int, partition_key: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        # a cursor of its own, so that the stream is not cut short by other queries
+        cursor = self._conn.cursor()
+        columns = "uuid, embedding" if partition_key is None else "uuid, embedding, metadata"
+        cursor.execute(
+            f"SELECT {columns} FROM embeddings WHERE collection_uuid = ?", [str(collection_uuid)]
+        )
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    return
+                columns = list(zip(*rows))
+                uuids = [uuid.UUID(u) for u in columns[0]]
+                embeddings = np.asarray(columns[1], dtype=np.float32)
+                if partition_key is None:
+                    yield uuids, embeddings
+                else:
+                    metadatas = [json.loads(m) if m else None for m in columns[2]]
+                    yield uuids, embeddings, self._partitions(partition_key, metadatas)
+        finally:
+            cursor.close()
+
     def _format_where(self, where, result):
         for key, value in where.items():
             # Shortcut for $eq
@@ -348,11 +434,15 @@ class DuckDB(Clickhouse):
         self._create_table_embeddings()
 
         self._idx.reset()
+        self._idx.stop()
         self._idx = Hnswlib(self._settings)
 
     def __del__(self):
         logger.info("Exiting: Cleaning up .chroma directory")
-        self._idx.reset()
+        # only the indexes of this database's collections, other databases in the same process
+        # may share the directory and still be using theirs
+        for (collection_uuid,) in self._conn.execute("SELECT uuid FROM collections").fetchall():
+            self._idx.delete_index(collection_uuid)
 
     def persist(self):
         raise NotImplementedError(
@@ -360,7 +450,28 @@ class DuckDB(Clickhouse):
         )
 
 
+def _persist_at_exit(ref):
+    db = ref()
+    if db is not None and not db._persisted_at_exit:
+        db.persist()
+        db._persisted_at_exit = True
+
+
 class PersistentDuckDB(DuckDB):
+    """A DuckDB database saved to parquet files in the persist directory.
+
+    The rows of each collection are saved in segments of their own, under embeddings/<uuid>/,
+    and the collections table in the file named by chroma-manifest.json. Only the collections
+    table is loaded at startup. The rows of a collection are loaded, attached, the first time
+    its name is looked up, which every call on a collection does. Past chroma_db_memory_budget
+    bytes of attached rows the least recently used collections are persisted and detached, to
+    be attached again when next used. A collection in use, by a call on it or by raw_sql, is not
+    detached until the call is done.
+
+    Once a collection has more than chroma_db_max_segments segments they are merged in the
+    background.
+    """
+
     _save_folder = None
 
     def __init__(self, settings):
@@ -372,7 +483,34 @@ class PersistentDuckDB(DuckDB):
             )
 
         self._save_folder = settings.persist_directory
+        self._max_segments = max(settings.chroma_db_max_segments, 1)
+        self._memory_budget = settings.chroma_db_memory_budget
+        # changes are tagged with the generation of the next persist, which writes every change
+        # up to its own generation, leaving those made meanwhile to the persist after it
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self._collections_changed = False
+        self._create_tables_changes()
+        # held by persists and detaches, which both write the changes of collections
+        self._persist_lock = threading.RLock()
+        self._manifest: Optional[Dict] = None
+        # the files of a database saved before collections had segments of their own, replaced
+        # by the first persist
+        self._legacy_files: List[str] = []
+        self._segments: Dict[str, Segments] = {}
+        # the collections whose rows are loaded, least recently used first
+        self._attached: "OrderedDict[str, bool]" = OrderedDict()
+        # the collections in use by queries, counting them, which are not detached meanwhile
+        self._in_use: Dict[str, int] = {}
+        self._attach_lock = threading.RLock()
+        self._deleted_collections: List[str] = []
+        self._merging: Optional[threading.Thread] = None
+        self._merging_lock = threading.Lock()
         self.load()
+        # persisted at exit rather than when collected, the files cannot be written once the
+        # interpreter is shutting down
+        self._persisted_at_exit = False
+        atexit.register(_persist_at_exit, weakref.ref(self))
 
     def set_save_folder(self, path):
         self._save_folder = path
@@ -380,42 +518,334 @@ class PersistentDuckDB(DuckDB):
     def get_save_folder(self):
         return self._save_folder
 
+    def _create_tables_changes(self):
+        for table in ["changed_rows", "deleted_rows"]:
+            self._conn.execute(
+                f"CREATE TABLE {table} (collection_uuid STRING, uuid STRING, generation BIGINT)"
+            )
+
+    def _next_generation(self) -> int:
+        with self._generation_lock:
+            self._generation += 1
+            return self._generation - 1
+
+    def _track(self, table: str, collection_uuids, uuids):
+        """Record rows as changed or deleted since the last persist"""
+        if len(uuids) == 0:
+            return
+        with self._generation_lock:
+            tracked = pd.DataFrame(
+                {
+                    "collection_uuid": [str(c) for c in collection_uuids],
+                    "uuid": [str(u) for u in uuids],
+                }
+            )
+            tracked["generation"] = self._generation
+            with self._view(tracked) as view:
+                self._conn.execute(
+                    f"INSERT INTO {table} SELECT collection_uuid, uuid, generation FROM {view}"
+                )
+
+    #
+    #  ATTACHING COLLECTIONS
+    #
+    def _segments_of(self, collection_uuid: str) -> Segments:
+        if collection_uuid not in self._segments:
+            self._segments[collection_uuid] = Segments(
+                f"{self._save_folder}/embeddings/{collection_uuid}"
+            )
+        return self._segments[collection_uuid]
+
+    def _attach(self, collection_uuid: str):
+        """Load the rows of a collection if they are not loaded yet, and mark it as used"""
+        with self._attach_lock:
+            if collection_uuid in self._attached:
+                self._attached.move_to_end(collection_uuid)
+                return
+            segments = self._segments_of(collection_uuid)
+            with segments.lock:
+                rows = segments.rows()
+                if rows is not None:
+                    self._conn.execute(f"INSERT INTO embeddings {rows}")
+            self._attached[collection_uuid] = True
+            logger.debug(
+                f"Attached collection {collection_uuid} from {segments.segments()} segments"
+            )
+            self._detach_over_budget()
+
+    def _detach_over_budget(self):
+        """Detach the least recently used collections until the rows attached fit the budget,
+        keeping the most recently used one whatever its size"""
+        if self._memory_budget <= 0 or len(self._attached) <= 1:
+            return
+        # roughly the bytes of each row: its embedding, strings, and two uuids
+        sizes = dict(
+            self._conn.execute(
+                """SELECT collection_uuid, SUM(8 * len(embedding) + strlen(coalesce(document, ''))
+                    + strlen(coalesce(metadata, '')) + strlen(id) + 72)
+                FROM embeddings GROUP BY collection_uuid"""
+            ).fetchall()
+        )
+        attached = sum(sizes.values())
+        for collection_uuid in list(self._attached)[:-1]:
+            if attached <= self._memory_budget:
+                break
+            if collection_uuid in self._in_use:
+                continue
+            self._detach(collection_uuid)
+            attached -= sizes.get(collection_uuid, 0)
+
+    def _detach(self, collection_uuid: str):
+        """Persist the changes of a collection and unload its rows"""
+        with self._persist_lock:
+            if self._manifest is None:
+                # a database not yet saved with segments per collection is saved whole first, a
+                # collection saved alone would be missed by the next load
+                self.persist()
+            generation = self._next_generation()
+            self._persist_collection(collection_uuid, generation)
+            for table in ["changed_rows", "deleted_rows"]:
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE collection_uuid = ? AND generation <= {generation}",
+                    [collection_uuid],
+                )
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE collection_uuid = ?", [collection_uuid]
+            )
+            self._attached.pop(collection_uuid, None)
+        logger.debug(f"Detached collection {collection_uuid}")
+
+    @contextmanager
+    def collection_in_use(self, collection_uuid: str):
+        with self._attach_lock:
+            self._in_use[collection_uuid] = self._in_use.get(collection_uuid, 0) + 1
+        try:
+            # attached again if it was detached before it was marked
+            self._attach(collection_uuid)
+            yield
+        finally:
+            with self._attach_lock:
+                self._in_use[collection_uuid] -= 1
+                if self._in_use[collection_uuid] == 0:
+                    del self._in_use[collection_uuid]
+
+    def get_collection_uuid_from_name(self, name):
+        collection_uuid = super().get_collection_uuid_from_name(name)
+        self._attach(collection_uuid)
+        return collection_uuid
+
+    def raw_sql(self, sql):
+        # every collection is attached and kept in use, whatever the budget, until the sql is done
+        with ExitStack() as stack:
+            for (collection_uuid,) in self._conn.execute("SELECT uuid FROM collections").fetchall():
+                stack.enter_context(self.collection_in_use(collection_uuid))
+            return super().raw_sql(sql)
+
+    #
+    #  CHANGE TRACKING
+    #
+    def create_collection(
+        self, name: str, metadata: Optional[Dict] = None, get_or_create: bool = False
+    ) -> Sequence:
+        self._collections_changed = True
+        return super().create_collection(name, metadata, get_or_create)
+
+    def update_collection(
+        self, current_name: str, new_name: str, new_metadata: Optional[Dict] = None
+    ):
+        self._collections_changed = True
+        super().update_collection(current_name, new_name, new_metadata)
+
+    def delete_collection(self, name: str):
+        collection_uuid = DuckDB.get_collection_uuid_from_name(self, name)
+        with self._attach_lock:
+            # marked as attached rather than loaded, its rows are deleted with its folder
+            self._attached[collection_uuid] = True
+            super().delete_collection(name)
+            self._attached.pop(collection_uuid, None)
+        for table in ["changed_rows", "deleted_rows"]:
+            self._conn.execute(f"DELETE FROM {table} WHERE collection_uuid = ?", [collection_uuid])
+        self._collections_changed = True
+        self._deleted_collections.append(collection_uuid)
+
+    def add(self, collection_uuid, embeddings, metadatas, documents, ids):
+        uuids = super().add(collection_uuid, embeddings, metadatas, documents, ids)
+        self._track("changed_rows", [collection_uuid] * len(uuids), uuids)
+        return uuids
+
+    def _update(
+        self,
+        collection_uuid,
+        ids: IDs,
+        embeddings: Optional[Embeddings],
+        metadatas: Optional[Metadatas],
+        documents: Optional[Documents],
+    ):
+        super()._update(collection_uuid, ids, embeddings, metadatas, documents)
+        with self._view(pd.DataFrame({"id": list(ids)})) as view:
+            updated = self._conn.execute(
+                "SELECT uuid FROM embeddings WHERE collection_uuid = ? "
+                f"AND id IN (SELECT id FROM {view})",
+                [str(collection_uuid)],
+            ).fetchall()
+        self._track("changed_rows", [collection_uuid] * len(updated), [row[0] for row in updated])
+
+    def _delete(self, where_str: Optional[str] = None):
+        deleted = self._conn.execute(
+            f"SELECT collection_uuid, uuid FROM embeddings {where_str}"
+        ).fetchall()
+        uuids = super()._delete(where_str)
+        self._track("deleted_rows", [row[0] for row in deleted], [row[1] for row in deleted])
+        return uuids
+
+    #
+    #  PERSISTENCE
+    #
+    def _file(self, name: str) -> str:
+        return f"{self._save_folder}/{name}"
+
+    def _read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(self._file("chroma-manifest.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self, manifest: Dict):
+        path = self._file("chroma-manifest.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+        self._manifest = manifest
+
+    def _persist_collection(self, collection_uuid: str, generation: int, whole: bool = False):
+        """Save the changes of a collection up to a generation, or all of its rows if whole"""
+        rows = f"SELECT * FROM embeddings WHERE collection_uuid = '{collection_uuid}'"
+        if whole:
+            self._segments_of(collection_uuid).append(self._conn, rows, replace=True)
+            return
+        changed = f"""{rows} AND uuid IN (SELECT uuid FROM changed_rows
+            WHERE collection_uuid = '{collection_uuid}' AND generation <= {generation})"""
+        deleted = f"""SELECT DISTINCT uuid FROM deleted_rows
+            WHERE collection_uuid = '{collection_uuid}' AND generation <= {generation}"""
+        self._segments_of(collection_uuid).append(self._conn, changed, deleted)
+
     def persist(self):
         """
         Persist the database to disk
         """
-        logger.info("Persisting DB to disk, putting it in the save folder", self._save_folder)
+        logger.info(f"Persisting DB to disk, putting it in the save folder {self._save_folder}")
         if self._conn is None:
             return
 
-        # if the db is empty, dont save
-        if self._conn.query(f"SELECT COUNT() FROM embeddings") == 0:
-            return
+        self._idx.persist()
 
-        self._conn.execute(
-            f"""
-            COPY
-                (SELECT * FROM embeddings)
-            TO '{self._save_folder}/chroma-embeddings.parquet'
-                (FORMAT PARQUET);
-        """
-        )
+        with self._persist_lock:
+            generation = self._next_generation()
+            os.makedirs(self._save_folder, exist_ok=True)
+            whole = self._manifest is None
+            if whole:
+                # the first persist, or the first since the database was saved without segments
+                # per collection, saves every collection whole
+                changed = self._conn.execute(
+                    "SELECT DISTINCT collection_uuid FROM embeddings"
+                ).fetchall()
+            else:
+                changed = self._conn.execute(
+                    f"""SELECT collection_uuid FROM changed_rows WHERE generation <= {generation}
+                    UNION SELECT collection_uuid FROM deleted_rows WHERE generation <= {generation}"""
+                ).fetchall()
+            for (collection_uuid,) in changed:
+                self._persist_collection(collection_uuid, generation, whole)
 
-        self._conn.execute(
-            f"""
-            COPY
-                (SELECT * FROM collections)
-            TO '{self._save_folder}/chroma-collections.parquet'
-                (FORMAT PARQUET);
-        """
-        )
+            manifest = dict(self._manifest or {"sequence": 0, "collections": None})
+            superseded = list(self._legacy_files)
+            if self._collections_changed or manifest["collections"] is None:
+                self._collections_changed = False
+                if manifest["collections"] is not None:
+                    superseded.append(manifest["collections"])
+                manifest["sequence"] += 1
+                manifest["collections"] = f"chroma-collections-{manifest['sequence']:06d}.parquet"
+                path = self._file(manifest["collections"])
+                self._conn.execute(
+                    f"COPY (SELECT * FROM collections) TO '{path}.tmp' (FORMAT PARQUET)"
+                )
+                os.replace(f"{path}.tmp", path)
+            if manifest != self._manifest:
+                self._write_manifest(manifest)
+
+            for table in ["changed_rows", "deleted_rows"]:
+                self._conn.execute(f"DELETE FROM {table} WHERE generation <= {generation}")
+            for collection_uuid in self._deleted_collections:
+                shutil.rmtree(self._segments_of(collection_uuid).folder, ignore_errors=True)
+                self._segments.pop(collection_uuid, None)
+            self._deleted_collections = []
+            for name in superseded:
+                # a legacy collections file may have the name of the one just written
+                if name != manifest["collections"] and os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self._legacy_files = []
+
+        merging = [s for s in self._segments.values() if s.segments() > self._max_segments]
+        if len(merging) > 0:
+            self._merge_in_background(merging)
+
+    def _merge_in_background(self, merging: List[Segments]):
+        with self._merging_lock:
+            if self._merging is not None and self._merging.is_alive():
+                return
+            self._merging = threading.Thread(target=self._merge, args=(merging,), daemon=True)
+            self._merging.start()
+
+    def _merge(self, merging: List[Segments]):
+        for segments in merging:
+            # a cursor of its own, the database stays in use meanwhile
+            cursor = self._conn.cursor()
+            try:
+                segments.merge(cursor)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                cursor.close()
 
     def load(self):
         """
-        Load the database from disk
+        Load the collections of the database from disk, their rows are loaded as they are used
         """
-        import os
+        manifest = self._read_manifest()
+        if manifest is None:
+            self._load_parquet()
+        elif "segments" in manifest:
+            self._load_segments(manifest)
+        else:
+            path = self._file(manifest["collections"])
+            self._conn.execute(f"INSERT INTO collections SELECT * FROM read_parquet('{path}');")
+            self._manifest = manifest
+            logger.info(
+                f"""loaded in {self._conn.query(f"SELECT COUNT() FROM collections").fetchall()[0][0]} collections"""
+            )
+            return
+        # a database saved before collections had segments of their own is loaded whole
+        for (collection_uuid,) in self._conn.execute("SELECT uuid FROM collections").fetchall():
+            self._attached[collection_uuid] = True
 
+    def _load_segments(self, manifest: Dict):
+        """Load a database saved as segments of every collection at once"""
+        segments = [segment["file"] for segment in manifest["segments"]]
+        if len(segments) > 0:
+            self._conn.execute(
+                f"INSERT INTO embeddings {latest_rows(self._save_folder, segments, manifest['tombstones'])}"
+            )
+        path = self._file(manifest["collections"])
+        self._conn.execute(f"INSERT INTO collections SELECT * FROM read_parquet('{path}');")
+        self._legacy_files = segments + manifest["tombstones"] + [manifest["collections"]]
+        logger.info(
+            f"""loaded in {self._conn.query(f"SELECT COUNT() FROM embeddings").fetchall()[0][0]} embeddings from {len(segments)} segments"""
+        )
+
+    def _load_parquet(self):
+        """Load a database saved as single files, before there were segments"""
+        self._legacy_files = ["chroma-embeddings.parquet", "chroma-collections.parquet"]
         # load in the embeddings
         if not os.path.exists(f"{self._save_folder}/chroma-embeddings.parquet"):
             logger.info(f"No existing DB found in {self._save_folder}, skipping load")
@@ -437,14 +867,165 @@ class PersistentDuckDB(DuckDB):
             )
 
     def __del__(self):
+        if self._persisted_at_exit:
+            return
         logger.info("PersistentDuckDB del, about to run persist")
         self.persist()
 
     def reset(self):
+        if self._merging is not None:
+            self._merging.join()
         super().reset()
+        self._conn.execute("DROP TABLE changed_rows")
+        self._conn.execute("DROP TABLE deleted_rows")
+        self._create_tables_changes()
+        self._manifest = None
+        self._legacy_files = []
+        self._segments = {}
+        self._attached.clear()
+        self._deleted_collections = []
+        self._collections_changed = False
         # empty the save folder
-        import shutil
-        import os
-
         shutil.rmtree(self._save_folder)
         os.mkdir(self._save_folder)
+
+
+class FileDuckDB(DuckDB):
+    """A DuckDB database stored in a database file of the persist directory.
+
+    Rows are read from the file as queries need them rather than loaded at startup, opening the
+    database reads only its catalog, so that neither the time to start nor the memory used grows
+    with the store. Each write is a transaction, in the write-ahead log of the file once it
+    returns, so persist() only checkpoints the log into the file and saves the indexes.
+
+    A store saved as parquet files, in any of the layouts of PersistentDuckDB, is copied into the
+    database file the first time it is opened, and its parquet files removed.
+    """
+
+    def __init__(self, settings):
+        if settings.persist_directory == ".chroma":
+            raise ValueError(
+                "You cannot use chroma's cache directory .chroma/, please set a different directory"
+            )
+
+        self._save_folder = settings.persist_directory
+        self._persisted_at_exit = False
+        super().__init__(settings=settings)
+        atexit.register(_persist_at_exit, weakref.ref(self))
+
+    def _connect(self, settings):
+        os.makedirs(settings.persist_directory, exist_ok=True)
+        path = f"{settings.persist_directory}/chroma.duckdb"
+        if not os.path.exists(path):
+            self._migrate(path)
+        logger.info(f"Using DuckDB database file {path}")
+        return duckdb.connect(path)
+
+    def _migrate(self, path: str):
+        """Copy a store saved as parquet files into a new database file at path"""
+        manifest_path = f"{self._save_folder}/chroma-manifest.json"
+        embeddings = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            collections = manifest["collections"]
+            saved = [collections, "chroma-manifest.json"]
+            if "segments" in manifest:
+                # segments of every collection at once
+                segments = [segment["file"] for segment in manifest["segments"]]
+                if len(segments) > 0:
+                    embeddings.append(
+                        latest_rows(self._save_folder, segments, manifest["tombstones"])
+                    )
+                saved += segments + manifest["tombstones"]
+            elif os.path.exists(f"{self._save_folder}/embeddings"):
+                for collection_uuid in sorted(os.listdir(f"{self._save_folder}/embeddings")):
+                    rows = Segments(f"{self._save_folder}/embeddings/{collection_uuid}").rows()
+                    if rows is not None:
+                        embeddings.append(rows)
+        elif os.path.exists(f"{self._save_folder}/chroma-collections.parquet"):
+            if os.path.exists(f"{self._save_folder}/chroma-embeddings.parquet"):
+                embeddings.append(
+                    f"SELECT * FROM read_parquet('{self._save_folder}/chroma-embeddings.parquet')"
+                )
+            collections = "chroma-collections.parquet"
+            saved = ["chroma-embeddings.parquet", collections]
+        else:
+            return
+
+        s = time.time()
+        # written under another name and moved into place once complete, so that a migration
+        # cut short is started over
+        if os.path.exists(f"{path}.migrating"):
+            os.remove(f"{path}.migrating")
+        self._conn = duckdb.connect(f"{path}.migrating")
+        try:
+            self._create_table_collections()
+            self._create_table_embeddings()
+            self._conn.execute(
+                f"INSERT INTO collections SELECT * FROM read_parquet('{self._save_folder}/{collections}')"
+            )
+            for rows in embeddings:
+                self._conn.execute(f"INSERT INTO embeddings {rows}")
+            rows = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchall()[0][0]
+            self._conn.execute("CHECKPOINT")
+        finally:
+            self._conn.close()
+            self._database.close()
+        os.replace(f"{path}.migrating", path)
+        for name in saved:
+            if os.path.exists(f"{self._save_folder}/{name}"):
+                os.remove(f"{self._save_folder}/{name}")
+        shutil.rmtree(f"{self._save_folder}/embeddings", ignore_errors=True)
+        logger.info(
+            f"Migrated {rows} embeddings from parquet files to {path} in {time.time() - s:.2f}s"
+        )
+
+    @contextmanager
+    def _transaction(self):
+        """Commit the statements the calling thread runs inside as a single transaction, or none
+        of them, on the thread's own connection"""
+        self._conn.begin()
+        try:
+            yield
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+
+    def add(self, collection_uuid, embeddings, metadatas, documents, ids):
+        with self._transaction():
+            return super().add(collection_uuid, embeddings, metadatas, documents, ids)
+
+    def _update(
+        self,
+        collection_uuid,
+        ids: IDs,
+        embeddings: Optional[Embeddings],
+        metadatas: Optional[Metadatas],
+        documents: Optional[Documents],
+    ):
+        with self._transaction():
+            super()._update(collection_uuid, ids, embeddings, metadatas, documents)
+
+    def delete_collection(self, name: str):
+        with self._transaction():
+            super().delete_collection(name)
+
+    def persist(self):
+        """
+        Persist the database to disk
+        """
+        logger.info(f"Checkpointing DB file in the save folder {self._save_folder}")
+        self._idx.persist()
+        self._conn.execute("CHECKPOINT")
+
+    def __del__(self):
+        # the indexes are kept with the database file, rather than cleaned up as in memory
+        if self._persisted_at_exit:
+            return
+        self.persist()
+
+    def reset(self):
+        super().reset()
+        self._conn.execute("CHECKPOINT")
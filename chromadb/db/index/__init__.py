@@ -27,5 +27,14 @@ class Index(ABC):
         pass
 
     @abstractmethod
-    def get_nearest_neighbors(self, collection_name, embedding, n_results, ids):
+    def get_nearest_neighbors(
+        self,
+        collection_name,
+        embedding,
+        n_results,
+        ids,
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
+    ):
         pass
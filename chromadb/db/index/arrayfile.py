@@ -0,0 +1,68 @@
+import json
+import os
+import struct
+from typing import Any, Dict, Sequence, Tuple, Union
+import numpy as np
+
+# a file of named arrays: the magic, the length of a json header, the header describing each
+# array and carrying small metadata, then the arrays, each starting on a page boundary so that
+# it can be memory mapped and its pages shared between processes
+MAGIC = b"CHROMAIX"
+PAGE_SIZE = 4096
+
+# an array, or the parts of one to be written one after the other along its first axis
+ArrayParts = Union[np.ndarray, Sequence[np.ndarray]]
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // PAGE_SIZE) * PAGE_SIZE
+
+
+def save_arrays(path: str, arrays: Dict[str, ArrayParts], metadata: Dict[str, Any]):
+    """Write arrays and metadata to a new file and rename it into place, so that a process
+    that has the previous file mapped keeps reading consistent data"""
+    parts = {
+        name: [value] if isinstance(value, np.ndarray) else list(value)
+        for name, value in arrays.items()
+    }
+    header: Dict[str, Any] = {"metadata": metadata, "arrays": {}}
+    offset = 0
+    for name, chunks in parts.items():
+        first = chunks[0]
+        shape = (sum(len(chunk) for chunk in chunks),) + first.shape[1:]
+        header["arrays"][name] = {"dtype": first.dtype.str, "shape": shape, "offset": offset}
+        offset = _aligned(offset + sum(chunk.nbytes for chunk in chunks))
+    encoded = json.dumps(header).encode()
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        for name, chunks in parts.items():
+            f.seek(start + header["arrays"][name]["offset"])
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk).tobytes())
+        f.truncate(start + offset)
+    os.replace(path + ".tmp", path)
+
+
+def load_arrays(path: str) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Map the arrays of a file copy-on-write: pages are read as they are touched, shared with
+    other processes mapping the file until they are written, and changes stay private"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an index array file")
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    start = _aligned(len(MAGIC) + 8 + length)
+
+    arrays = {}
+    for name, description in header["arrays"].items():
+        dtype = np.dtype(description["dtype"])
+        shape = tuple(description["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="c", offset=start + description["offset"], shape=shape
+            )
+    return arrays, header["metadata"]
@@ -0,0 +1,238 @@
+from abc import ABC, abstractmethod
+import glob
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, cast
+import hnswlib
+import numpy as np
+from chromadb.db.index.filters import label_filter
+from chromadb.db.index.flat import FlatIndex
+from chromadb.db.index.ivf import MAX_DATA_FILES, IVFIndex
+from chromadb.db.index.params import AUTO, FLAT, HNSW, IVF, PQ, SQ8
+from chromadb.db.index.planner import EXACT, FILTERED, exact_scan_fits, plan_filtered_query
+from chromadb.db.index.quantized import (
+    TRAINING_SIZE,
+    ProductQuantizedIndex,
+    QuantizedIndex,
+    ScalarQuantizedIndex,
+)
+from chromadb.db.index.sharded import ShardedIndex
+
+# the vectors of a collection resident in memory: an hnswlib index, or one that mirrors it
+VectorIndex = Union[hnswlib.Index, ShardedIndex, FlatIndex, QuantizedIndex, IVFIndex]
+
+
+class Backend(ABC):
+    """One kind of index of a collection's vectors: how an index of the kind is made and built,
+    how a filtered query is run on it, and when it has outgrown itself.
+
+    The elements, files and locks of an index are managed alike whatever its kind, by
+    ResidentIndex, which asks the backend of each index for the rest. name is the kind the
+    index metadata records.
+    """
+
+    name: str
+
+    def __init__(self, settings):
+        self._exact_threshold = settings.chroma_query_exact_threshold
+        self._build_chunk_size = settings.chroma_index_build_chunk_size
+
+    @abstractmethod
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        """An empty index configured by params, whose file is saved and loaded at path"""
+        pass
+
+    def build(self, index: VectorIndex, rows, read: Callable[[Any], np.ndarray]):
+        """Add the vectors read from rows to a new index in chunks, labelled by their position"""
+        for start in range(0, len(rows), self._build_chunk_size):
+            stop = min(start + self._build_chunk_size, len(rows))
+            index.add_items(read(rows[start:stop]), np.arange(start, stop))
+
+    def rows(self, index: VectorIndex, labels: np.ndarray) -> Tuple[Any, Callable]:
+        """The rows of the elements of labels to build a copy of an index from, and how to read
+        their vectors, taken under the lock of the index"""
+        return np.asarray(index.get_items(labels), dtype=np.float32), np.asarray
+
+    def outgrown(self, index: VectorIndex, metadata: Dict, elements: int) -> Optional[str]:
+        """The backend to build an index holding elements live elements again as, once it has
+        outgrown how it was built, or None"""
+        return None
+
+    def plan(self, filter_size: int, index_size: int, dimensionality: int, ef: int) -> str:
+        """How to run a query whose results must come from filter_size of the index_size
+        elements. An index that is a scan, filtered or not, answers a small enough filter
+        cheaper exactly."""
+        if exact_scan_fits(filter_size, dimensionality, self._exact_threshold):
+            return EXACT
+        return FILTERED
+
+    def filtered_search(self, index: VectorIndex, query, labels, k, threads):
+        allowed = np.zeros(index.get_max_elements(), dtype=bool)
+        allowed[labels] = True
+        return index.knn_query(query, k=k, filter=allowed, num_threads=threads)
+
+    def nbytes(self, index: VectorIndex, dimensionality: int) -> int:
+        return index.nbytes()
+
+    def files(self, path: str) -> List[str]:
+        """The files indexes made with path write besides it"""
+        return []
+
+    def discard(self, index: VectorIndex):
+        """Remove the files of an index that has been replaced, other than its snapshots"""
+        pass
+
+
+class FlatBackend(Backend):
+    """An exact scan, which an auto index starts as until it holds more than
+    chroma_index_flat_threshold elements and becomes an hnsw graph"""
+
+    name = FLAT
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self._flat_threshold = settings.chroma_index_flat_threshold
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        return FlatIndex(space=params["space"], dim=dimensionality)
+
+    def outgrown(self, index: VectorIndex, metadata: Dict, elements: int) -> Optional[str]:
+        if metadata["index_type"] == AUTO and elements > self._flat_threshold:
+            return HNSW
+        return None
+
+    def plan(self, filter_size: int, index_size: int, dimensionality: int, ef: int) -> str:
+        return EXACT
+
+
+class HnswBackend(Backend):
+    """An hnswlib graph.
+
+    hnswlib reads the whole graph into memory when it loads it and cannot search a memory
+    mapped file, so unlike the flat, quantized and ivf indexes, whose files processes map and
+    share through the page cache, an hnsw index is loaded in full by every process serving it.
+    """
+
+    name = HNSW
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self._exact_scan_cost = settings.chroma_query_exact_scan_cost
+        self._postfilter_selectivity = settings.chroma_query_postfilter_selectivity
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        # possible spaces are l2, cosine or ip
+        return hnswlib.Index(space=params["space"], dim=dimensionality)
+
+    def plan(self, filter_size: int, index_size: int, dimensionality: int, ef: int) -> str:
+        return plan_filtered_query(
+            filter_size,
+            index_size,
+            dimensionality,
+            ef,
+            self._exact_threshold,
+            self._exact_scan_cost,
+            self._postfilter_selectivity,
+        )
+
+    def filtered_search(self, index: VectorIndex, query, labels, k, threads):
+        filter_function = label_filter(labels, index.get_max_elements())
+        # hnswlib takes the GIL for every filter call, the threads of a batch wait on each other
+        # there but compute their distances in parallel
+        return index.knn_query(query, k=k, filter=filter_function, num_threads=threads)
+
+    def nbytes(self, index: VectorIndex, dimensionality: int) -> int:
+        """Estimate the memory held by an index, following hnswlib's memory layout"""
+        max_elements = index.get_max_elements()
+        # level 0 holds the vector, 2*M links plus their count and the label
+        level0 = dimensionality * 4 + index.M * 2 * 4 + 4 + 8
+        # on average 1/(M-1) upper level link lists per element, plus the label lookup table
+        upper = (index.M * 4 + 4) // max(index.M - 1, 1) + 40
+        return max_elements * (level0 + upper)
+
+
+class ShardedBackend(HnswBackend):
+    """An hnsw index split into hnsw:shards graphs, recorded as hnsw in the index metadata"""
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        return ShardedIndex(space=params["space"], dim=dimensionality, shards=params["shards"])
+
+    def filtered_search(self, index: VectorIndex, query, labels, k, threads):
+        return Backend.filtered_search(self, index, query, labels, k, threads)
+
+
+class QuantizedBackend(Backend, ABC):
+    """A scan over quantized codes of the vectors, trained again once it holds four times as
+    many elements as it was trained on"""
+
+    def outgrown(self, index: VectorIndex, metadata: Dict, elements: int) -> Optional[str]:
+        if cast(QuantizedIndex, index).trained_on < min(elements, TRAINING_SIZE) / 4:
+            return self.name
+        return None
+
+
+class ScalarQuantizedBackend(QuantizedBackend):
+    name = SQ8
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        return ScalarQuantizedIndex(
+            space=params["space"], dim=dimensionality, rerank=params["rerank"]
+        )
+
+
+class ProductQuantizedBackend(QuantizedBackend):
+    name = PQ
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        return ProductQuantizedIndex(
+            space=params["space"],
+            dim=dimensionality,
+            rerank=params["rerank"],
+            subvectors=params["pq_subvectors"],
+        )
+
+
+class IVFBackend(Backend):
+    """An inverted file of clustered vectors kept on disk, clustered again once it holds four
+    times as many elements as it was clustered for or reads from too many vectors files"""
+
+    name = IVF
+
+    def make(self, params: Dict, dimensionality: int, path: str) -> VectorIndex:
+        return IVFIndex(space=params["space"], dim=dimensionality, path=path, nlist=params["nlist"])
+
+    def build(self, index: VectorIndex, rows, read: Callable[[Any], np.ndarray]):
+        # cluster a sample, then add the vectors list by list so that each list is contiguous
+        ivf = cast(IVFIndex, index)
+        rng = np.random.default_rng(0)
+        sample = rng.choice(
+            len(rows), size=min(len(rows), ivf.training_size(len(rows))), replace=False
+        )
+        ivf.train(read(rows[np.sort(sample)]))
+        lists = np.concatenate(
+            [
+                ivf.assign(read(rows[start : start + self._build_chunk_size]))
+                for start in range(0, len(rows), self._build_chunk_size)
+            ]
+        )
+        order = np.argsort(lists, kind="stable")
+        for start in range(0, len(rows), self._build_chunk_size):
+            chunk = order[start : start + self._build_chunk_size]
+            ivf.add_items(read(rows[chunk]), chunk, lists=lists[chunk])
+
+    def rows(self, index: VectorIndex, labels: np.ndarray) -> Tuple[Any, Callable]:
+        # rows of an ivf index are never overwritten, so they can be read once the lock is
+        # released, without holding every vector in memory
+        ivf = cast(IVFIndex, index)
+        return ivf.rows_of(labels), ivf.read_rows
+
+    def outgrown(self, index: VectorIndex, metadata: Dict, elements: int) -> Optional[str]:
+        ivf = cast(IVFIndex, index)
+        if ivf.clustered_for < elements / 4 or len(ivf.data_files) > MAX_DATA_FILES:
+            return self.name
+        return None
+
+    def files(self, path: str) -> List[str]:
+        return glob.glob(f"{os.path.splitext(path)[0]}.*.ivf")
+
+    def discard(self, index: VectorIndex):
+        cast(IVFIndex, index).discard()
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple
+import numpy as np
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def pairwise_distances(queries: np.ndarray, vectors: np.ndarray, space: str) -> np.ndarray:
+    """Distances between every query and every vector, as hnswlib defines them for each space:
+    squared euclidean for l2, and 1 - dot product for ip and for cosine on normalized vectors"""
+    if space == "l2":
+        distances = (
+            np.einsum("ij,ij->i", queries, queries)[:, None]
+            - 2 * queries @ vectors.T
+            + np.einsum("ij,ij->i", vectors, vectors)[None, :]
+        )
+        return np.maximum(distances, 0)
+    if space == "cosine":
+        queries = normalize(queries)
+        vectors = normalize(vectors)
+    return 1 - queries @ vectors.T
+
+
+def top_k(distances: np.ndarray, labels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k smallest distances of each row, in increasing order, and their labels"""
+    if k < distances.shape[1]:
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        nearest = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+    order = np.argsort(nearest_distances, axis=1)
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    return labels[nearest], np.take_along_axis(nearest_distances, order, axis=1)
+
+
+def brute_force_knn(
+    queries: np.ndarray, vectors: np.ndarray, labels: np.ndarray, k: int, space: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact k nearest neighbors of each query among vectors, returning labels and distances"""
+    distances = pairwise_distances(queries, vectors, space).astype(np.float32)
+    return top_k(distances, labels, k)
+
+
+def search_in_threads(
+    search: Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]],
+    queries: np.ndarray,
+    num_threads: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Run search, from a block of queries to their labels and distances, over num_threads
+    blocks of the queries at once. numpy releases the GIL in the matrix products and partial
+    sorts that most of a search is spent in, so the blocks run in parallel."""
+    if num_threads <= 1 or len(queries) <= 1:
+        return search(queries)
+    blocks = np.array_split(queries, min(num_threads, len(queries)))
+    with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+        results = list(executor.map(search, blocks))
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
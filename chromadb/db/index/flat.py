@@ -0,0 +1,174 @@
+from typing import Any, Callable, Dict, Optional, Union
+import numpy as np
+from chromadb.db.index.arrayfile import load_arrays, save_arrays
+from chromadb.db.index.distances import normalize, search_in_threads, top_k
+
+# a filter is hnswlib's callable from label to allowed, or a boolean mask indexed by label
+Filter = Union[Callable[[int], int], np.ndarray]
+
+
+class FlatIndex:
+    """An exact index: a contiguous float32 matrix of vectors, searched with one matrix multiply
+    per batch of queries and a partial sort of the distances.
+
+    It mirrors the parts of hnswlib.Index that the index uses, with labels as row numbers, so
+    that collections too small to be worth a graph can use it in its place. Distances are
+    defined as hnswlib defines them for each space. The index file is memory mapped on load, so
+    processes serving the same collection share one copy of it in the page cache.
+    """
+
+    def __init__(self, space: str, dim: int):
+        self.space = space
+        self.dim = dim
+        self.M = 0
+        self.ef = 10
+        self.num_threads = 1
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        # squared norms of the vectors, for l2 distances
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._present = np.zeros(0, dtype=bool)
+        self._deleted = np.zeros(0, dtype=bool)
+        self.element_count = 0
+        # labels are row numbers, rows from the highest label in use onwards are all free
+        self._used = 0
+
+    def init_index(self, max_elements: int, **kwargs):
+        self.resize_index(max_elements)
+
+    def set_ef(self, ef: int):
+        self.ef = ef
+
+    def set_num_threads(self, num_threads: int):
+        self.num_threads = num_threads
+
+    def get_max_elements(self) -> int:
+        return len(self._present)
+
+    def nbytes(self) -> int:
+        return (
+            self._vectors.nbytes + self._norms.nbytes + self._present.nbytes + self._deleted.nbytes
+        )
+
+    def resize_index(self, new_size: int):
+        if new_size < self._used:
+            raise RuntimeError(
+                "Cannot resize, max element is less than the current number of elements"
+            )
+        self._resize_storage(new_size)
+        self._present = _resized(self._present, new_size, self._used)
+        self._deleted = _resized(self._deleted, new_size, self._used)
+
+    def _resize_storage(self, new_size: int):
+        self._vectors = _resized(self._vectors, new_size, self._used)
+        self._norms = _resized(self._norms, new_size, self._used)
+
+    def add_items(self, data, ids=None, num_threads: int = -1, replace_deleted: bool = False):
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        labels = np.arange(len(data)) if ids is None else np.asarray(ids, dtype=np.int64)
+        if len(labels) == 0:
+            return
+        if labels.max() >= self.get_max_elements():
+            raise RuntimeError("The number of elements exceeds the specified limit")
+        if self.space == "cosine":
+            data = normalize(data)
+        self._store(labels, data)
+        self.element_count += int(np.count_nonzero(~self._present[labels]))
+        self._used = max(self._used, int(labels.max()) + 1)
+        self._present[labels] = True
+        self._deleted[labels] = False
+
+    def _store(self, labels: np.ndarray, data: np.ndarray):
+        self._vectors[labels] = data
+        self._norms[labels] = np.einsum("ij,ij->i", data, data)
+
+    def mark_deleted(self, label: int):
+        if label >= len(self._present) or not self._present[label]:
+            raise RuntimeError("Label not found")
+        if self._deleted[label]:
+            raise RuntimeError("The requested to delete element is already deleted")
+        self._deleted[label] = True
+
+    def get_items(self, ids, return_type: str = "numpy"):
+        vectors = self._vectors[np.asarray(ids, dtype=np.int64)]
+        return vectors if return_type == "numpy" else vectors.tolist()
+
+    def knn_query(self, data, k: int = 1, num_threads: int = -1, filter: Optional[Filter] = None):
+        queries = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        if self.space == "cosine":
+            queries = normalize(queries)
+        # scan every row that has been used, masking out the ones that may not be returned
+        used = self._used
+        excluded = ~self._present[:used] | self._deleted[:used]
+        if isinstance(filter, np.ndarray):
+            excluded |= ~filter[:used]
+        elif filter is not None:
+            excluded |= ~np.fromiter(map(filter, range(used)), dtype=bool, count=used)
+        if used - np.count_nonzero(excluded) < k:
+            raise RuntimeError(
+                "Cannot return the results in a contigious 2D array. Probably ef or M is too small"
+            )
+
+        available = used - int(np.count_nonzero(excluded))
+
+        def search(block):
+            distances = self._scan(block, used)
+            distances[:, excluded] = np.inf
+            return self._nearest(block, distances, k, available)
+
+        labels, distances = search_in_threads(
+            search, queries, self.num_threads if num_threads < 0 else num_threads
+        )
+        return labels.astype(np.uint64), distances
+
+    def _nearest(self, queries: np.ndarray, distances: np.ndarray, k: int, available: int):
+        """The k nearest rows of each query given its distances to every row, of which available
+        rows are not excluded"""
+        return top_k(distances, np.arange(distances.shape[1]), k)
+
+    def _scan(self, queries: np.ndarray, used: int) -> np.ndarray:
+        """Distances from each query to each of the first used rows"""
+        return self._distances(queries, self._vectors[:used], self._norms[:used])
+
+    def _distances(self, queries: np.ndarray, vectors: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        if self.space == "l2":
+            distances = np.einsum("ij,ij->i", queries, queries)[:, None] - 2 * queries @ vectors.T
+            distances += norms[None, :]
+            return np.maximum(distances, 0, out=distances)
+        return 1 - queries @ vectors.T
+
+    def save_index(self, path: str):
+        save_arrays(path, self._arrays(), self._metadata())
+        # map the saved arrays in place of the ones in memory, so that only pages written from
+        # now on are private to this process
+        self._restore(*load_arrays(path))
+
+    def load_index(self, path: str, max_elements: int = 0, **kwargs):
+        self._restore(*load_arrays(path))
+        if max_elements > self.get_max_elements():
+            self.resize_index(max_elements)
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        """The arrays saved in the index file, by name, at full capacity like hnswlib does"""
+        return {
+            "present": self._present,
+            "deleted": self._deleted,
+            "vectors": self._vectors,
+            "norms": self._norms,
+        }
+
+    def _metadata(self) -> Dict[str, Any]:
+        return {"used": self._used, "elements": self.element_count}
+
+    def _restore(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+        self._present = arrays["present"]
+        self._deleted = arrays["deleted"]
+        self._vectors = arrays["vectors"]
+        self._norms = arrays["norms"]
+        self._used = metadata["used"]
+        self.element_count = metadata["elements"]
+
+
+def _resized(array: np.ndarray, size: int, used: int) -> np.ndarray:
+    resized = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+    resized[:used] = array[:used]
+    return resized
@@ -0,0 +1,196 @@
+import os
+from typing import List, Optional, Sequence
+import uuid
+import numpy as np
+
+# labels in the hash table at or above zero are live, these mark free slots
+_EMPTY = -1
+_TOMBSTONE = -2
+
+_TABLE_DTYPE = np.dtype([("key", "<u8", (2,)), ("label", "<i8")])
+
+# 64 bit golden ratio, for Fibonacci hashing of the uuid bits
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+_MAX_LOAD_FACTOR = 0.5
+
+
+def uuids_to_array(uuids: Sequence[uuid.UUID]) -> np.ndarray:
+    """Pack uuids into an (n, 16) uint8 array"""
+    return np.frombuffer(b"".join(u.bytes for u in uuids), dtype=np.uint8).reshape(-1, 16)
+
+
+def _save_atomic(path: str, array: np.ndarray):
+    # write to a new file and rename it into place, so a process that has the old file
+    # memory mapped keeps reading consistent data
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+class IdMap:
+    """A compact two-way mapping between integer index labels and uuids.
+
+    Uuids are kept in a contiguous (capacity, 16) byte array indexed by label, with the nil
+    uuid marking unused labels. The reverse lookup is an open-addressing hash table with
+    linear probing. Both are plain NumPy arrays, saved as .npy files that can be memory
+    mapped on load, and all lookups work on whole batches at once.
+    """
+
+    def __init__(
+        self,
+        uuids: Optional[np.ndarray] = None,
+        table: Optional[np.ndarray] = None,
+        count: Optional[int] = None,
+    ):
+        if uuids is None:
+            uuids = np.zeros((0, 16), dtype=np.uint8)
+        if table is None:
+            table = np.zeros(16, dtype=_TABLE_DTYPE)
+            table["label"] = _EMPTY
+        self._uuids = uuids
+        self._table = table
+        # counting the entries of a mapped table reads all of it, so a known count is taken
+        # as given and the slots in use are only counted once something is inserted
+        self._count = int(np.count_nonzero(self._table["label"] >= 0)) if count is None else count
+        self._used: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def nbytes(self) -> int:
+        return self._uuids.nbytes + self._table.nbytes
+
+    def add(self, uuids: Sequence[uuid.UUID], labels: Sequence[int]):
+        """Map each uuid to the label at the same position"""
+        rows = uuids_to_array(uuids)
+        labels = np.asarray(labels, dtype=np.int64)
+        if len(labels) == 0:
+            return
+
+        highest = int(labels.max())
+        if highest >= len(self._uuids):
+            capacity = max(highest + 1, 2 * len(self._uuids))
+            grown = np.zeros((capacity, 16), dtype=np.uint8)
+            grown[: len(self._uuids)] = self._uuids
+            self._uuids = grown
+        self._uuids[labels] = rows
+
+        keys = rows.view("<u8")
+        slots = self._find(keys)
+        existing = slots >= 0
+        self._table["label"][slots[existing]] = labels[existing]
+        self._insert(keys[~existing], labels[~existing])
+
+    def remove(self, uuids: Sequence[uuid.UUID]) -> np.ndarray:
+        """Unmap uuids, returning their labels"""
+        keys = uuids_to_array(uuids).view("<u8")
+        slots = self._find(keys)
+        if np.any(slots < 0):
+            missing = [str(u) for u, s in zip(uuids, slots) if s < 0]
+            raise KeyError(f"uuids not found in index: {missing}")
+        labels = self._table["label"][slots].copy()
+        self._table["label"][slots] = _TOMBSTONE
+        self._uuids[labels] = 0
+        self._count -= len(slots)
+        return labels
+
+    def labels_for(self, uuids: Sequence[uuid.UUID]) -> np.ndarray:
+        """Return the label of each uuid, -1 where a uuid is not mapped"""
+        keys = uuids_to_array(uuids).view("<u8")
+        slots = self._find(keys)
+        labels = np.full(len(slots), -1, dtype=np.int64)
+        found = slots >= 0
+        labels[found] = self._table["label"][slots[found]]
+        return labels
+
+    def uuids_for(self, labels: np.ndarray) -> List[List[uuid.UUID]]:
+        """Translate a (queries, k) array of labels to lists of uuids"""
+        labels = np.atleast_2d(np.asarray(labels, dtype=np.int64))
+        packed = self._uuids[labels].tobytes()
+        k = labels.shape[1]
+        return [
+            [uuid.UUID(bytes=packed[(q * k + i) * 16 : (q * k + i + 1) * 16]) for i in range(k)]
+            for q in range(labels.shape[0])
+        ]
+
+    def live_labels(self) -> np.ndarray:
+        table = self._table
+        return np.sort(table["label"][table["label"] >= 0])
+
+    def _slots(self, keys: np.ndarray) -> np.ndarray:
+        bits = int(len(self._table)).bit_length() - 1
+        mixed = (keys[:, 0] ^ keys[:, 1]) * _HASH_MULTIPLIER
+        return (mixed >> np.uint64(64 - bits)).astype(np.int64)
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """Return the table slot holding each key, -1 for keys that are not present"""
+        mask = len(self._table) - 1
+        result = np.full(len(keys), -1, dtype=np.int64)
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            probe = slots[pending]
+            entries = self._table[probe]
+            match = (
+                (entries["label"] >= 0)
+                & (entries["key"][:, 0] == keys[pending, 0])
+                & (entries["key"][:, 1] == keys[pending, 1])
+            )
+            result[pending[match]] = probe[match]
+            pending = pending[~(match | (entries["label"] == _EMPTY))]
+            slots[pending] = (slots[pending] + 1) & mask
+        return result
+
+    def _insert(self, keys: np.ndarray, labels: np.ndarray):
+        """Insert keys known not to be in the table"""
+        if len(keys) == 0:
+            return
+        if self._used is None:
+            self._used = int(np.count_nonzero(self._table["label"] != _EMPTY))
+        if self._used + len(keys) > _MAX_LOAD_FACTOR * len(self._table):
+            self._rehash(self._count + len(keys))
+
+        mask = len(self._table) - 1
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            probe = slots[pending]
+            free = self._table["label"][probe] < 0
+            # several keys may probe the same free slot, the first one claims it
+            claimed, first = np.unique(probe[free], return_index=True)
+            winners = pending[free][first]
+            self._used += int(np.count_nonzero(self._table["label"][claimed] == _EMPTY))
+            self._table["key"][claimed] = keys[winners]
+            self._table["label"][claimed] = labels[winners]
+
+            pending = np.setdiff1d(pending, winners, assume_unique=True)
+            slots[pending] = (slots[pending] + 1) & mask
+        self._count += len(keys)
+
+    def _rehash(self, entries: int):
+        size = 16
+        while entries > _MAX_LOAD_FACTOR * size / 2:
+            size *= 2
+        live = self._table[self._table["label"] >= 0]
+        self._table = np.zeros(size, dtype=_TABLE_DTYPE)
+        self._table["label"] = _EMPTY
+        self._count = 0
+        self._used = 0
+        self._insert(live["key"], live["label"])
+
+    def save(self, uuids_path: str, table_path: str):
+        _save_atomic(uuids_path, self._uuids)
+        _save_atomic(table_path, self._table)
+
+    @classmethod
+    def load(cls, uuids_path: str, table_path: str, count: Optional[int] = None) -> "IdMap":
+        # copy-on-write mappings: pages are read lazily and changes stay private until saved
+        return cls(np.load(uuids_path, mmap_mode="c"), np.load(table_path, mmap_mode="c"), count)
+
+    @classmethod
+    def from_dict(cls, id_to_uuid) -> "IdMap":
+        """Build a mapping from the label to uuid dict of the previous pickle format"""
+        ids = cls()
+        ids.add(list(id_to_uuid.values()), list(id_to_uuid.keys()))
+        return ids
@@ -0,0 +1,373 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple
+import uuid
+import numpy as np
+from chromadb.db.index.arrayfile import load_arrays, save_arrays
+from chromadb.db.index.distances import normalize, pairwise_distances, search_in_threads, top_k
+from chromadb.db.index.flat import Filter, _resized
+from chromadb.db.index.kmeans import kmeans
+
+# training vectors per list, enough for k-means to place the centroids
+TRAINING_PER_LIST = 32
+# rows appended since the posting lists were last sorted, past which they are sorted again
+UNSORTED_ROWS = 1024
+BLOCK_SIZE = 65536
+# vectors files an index reads from, past which a rebuild writes its rows out as one again
+MAX_DATA_FILES = 8
+
+
+class IVFIndex:
+    """An inverted file index: vectors are assigned to the nearest of nlist k-means centroids,
+    and a query scans only the vectors of the nprobe lists whose centroids are nearest to it.
+
+    Only the centroids and a few integers per vector are held in memory, in an index file that
+    is memory mapped on load. The vectors themselves are appended to files named after the path
+    the index is created with, grouped by list within each batch, and memory mapped too, so
+    that a query reads only the pages of the lists it probes and a collection does not have to
+    fit in memory. Rows are never overwritten: an updated vector is appended again and its old
+    row is dropped from its list.
+
+    A vectors file is only appended to by the index that created it. An index loaded from disk,
+    in this process or another, appends to a new file of its own after the ones it was saved
+    with, so that the rows a snapshot names never change under a process reading them.
+    Rebuilding the index clusters it again and writes a single new file with each list
+    contiguous.
+
+    It mirrors the parts of hnswlib.Index that the index uses, with ef as the number of lists
+    probed, widened for a query until it finds k results.
+    """
+
+    def __init__(self, space: str, dim: int, path: str, nlist: Optional[int] = None):
+        self.space = space
+        self.dim = dim
+        self.M = 0
+        self.ef = 10
+        self.num_threads = 1
+        self.nlist = nlist
+        # the number of elements the centroids were trained for
+        self.clustered_for = 0
+        self._centroids = np.zeros((0, dim), dtype=np.float32)
+
+        # by label
+        self._present = np.zeros(0, dtype=bool)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._label_rows = np.zeros(0, dtype=np.int64)
+        self.element_count = 0
+        self._used = 0
+
+        # by row of the vectors files, the label of each row, or -1 once it is superseded
+        self._row_labels = np.zeros(0, dtype=np.int64)
+        self._row_lists = np.zeros(0, dtype=np.int32)
+        self._base = os.path.splitext(path)[0]
+        # the vectors files, oldest first, with their number of rows, and the file the last one
+        # is appended through if this index created it
+        self._data_files: List[Tuple[str, int]] = []
+        self._file = None
+        # the map of each file and the row each one ends at, replaced together
+        self._mapped: Tuple[List[np.ndarray], np.ndarray] = ([], np.zeros(0, dtype=np.int64))
+        self._rows = 0
+        # live rows sorted by list with the offset of each list, up to the given row
+        self._postings = (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), 0)
+
+    @property
+    def data_files(self) -> List[str]:
+        return [path for path, _ in self._data_files]
+
+    def init_index(self, max_elements: int, **kwargs):
+        self.resize_index(max_elements)
+
+    def set_ef(self, ef: int):
+        self.ef = ef
+
+    def set_num_threads(self, num_threads: int):
+        self.num_threads = num_threads
+
+    def get_max_elements(self) -> int:
+        return len(self._present)
+
+    def nbytes(self) -> int:
+        return (
+            self._present.nbytes
+            + self._deleted.nbytes
+            + self._label_rows.nbytes
+            + self._row_labels.nbytes
+            + self._row_lists.nbytes
+            + self._postings[1].nbytes
+            + self._centroids.nbytes
+        )
+
+    def resize_index(self, new_size: int):
+        if new_size < self._used:
+            raise RuntimeError(
+                "Cannot resize, max element is less than the current number of elements"
+            )
+        self._present = _resized(self._present, new_size, self._used)
+        self._deleted = _resized(self._deleted, new_size, self._used)
+        label_rows = _resized(self._label_rows, new_size, self._used)
+        label_rows[self._used :] = -1
+        self._label_rows = label_rows
+
+    def train(self, data: np.ndarray):
+        """Cluster a sample of the vectors into the centroids of the lists"""
+        data = np.asarray(data, dtype=np.float32)
+        if self.space == "cosine":
+            data = normalize(data)
+        elements = max(self.get_max_elements(), len(data))
+        nlist = min(self.nlist or max(int(round(np.sqrt(elements))), 1), len(data))
+        sample = np.random.default_rng(0).permutation(len(data))[: nlist * TRAINING_PER_LIST]
+        self._centroids = kmeans(data[sample], nlist, iterations=10)
+        self.clustered_for = elements
+        self._sort_postings()
+
+    def training_size(self, elements: int) -> int:
+        return (self.nlist or max(int(round(np.sqrt(elements))), 1)) * TRAINING_PER_LIST
+
+    def assign(self, data: np.ndarray) -> np.ndarray:
+        """The list of each vector, the one of the nearest centroid"""
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        if self.space == "cosine":
+            data = normalize(data)
+        lists = np.empty(len(data), dtype=np.int32)
+        for start in range(0, len(data), BLOCK_SIZE):
+            distances = self._centroid_distances(data[start : start + BLOCK_SIZE])
+            lists[start : start + BLOCK_SIZE] = np.argmin(distances, axis=1)
+        return lists
+
+    def _centroid_distances(self, vectors: np.ndarray) -> np.ndarray:
+        # vectors of the cosine space are normalized already
+        return pairwise_distances(
+            vectors, self._centroids, "ip" if self.space == "cosine" else self.space
+        )
+
+    def add_items(
+        self, data, ids=None, num_threads: int = -1, replace_deleted: bool = False, lists=None
+    ):
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        labels = np.arange(len(data)) if ids is None else np.asarray(ids, dtype=np.int64)
+        if len(labels) == 0:
+            return
+        if labels.max() >= self.get_max_elements():
+            raise RuntimeError("The number of elements exceeds the specified limit")
+        if len(self._centroids) == 0:
+            self.train(data)
+        if lists is None:
+            lists = self.assign(data)
+        if self.space == "cosine":
+            data = normalize(data)
+
+        # append the rows grouped by list, so that each list of the batch is read in one run
+        order = np.argsort(lists, kind="stable")
+        data, labels, lists = data[order], labels[order], np.asarray(lists)[order]
+        data_files = list(self._data_files)
+        if self._file is None:
+            os.makedirs(os.path.dirname(self._base), exist_ok=True)
+            data_files.append((f"{self._base}.{uuid.uuid4().hex[:8]}.ivf", 0))
+            self._file = open(data_files[-1][0], "xb")
+        self._file.write(data.tobytes())
+        self._file.flush()
+        data_files[-1] = (data_files[-1][0], data_files[-1][1] + len(data))
+
+        start = self._rows
+        rows = np.arange(start, start + len(data))
+        if rows[-1] >= len(self._row_labels):
+            capacity = max(rows[-1] + 1, 2 * len(self._row_labels))
+            self._row_labels = _resized(self._row_labels, capacity, start)
+            self._row_lists = _resized(self._row_lists, capacity, start)
+        self._row_labels[rows] = labels
+        self._row_lists[rows] = lists
+        # the rows these labels were at before are superseded
+        previous = self._label_rows[labels]
+        self._row_labels[previous[previous >= 0]] = -1
+        self._label_rows[labels] = rows
+
+        self.element_count += int(np.count_nonzero(~self._present[labels]))
+        self._used = max(self._used, int(labels.max()) + 1)
+        self._present[labels] = True
+        self._deleted[labels] = False
+        self._map(data_files)
+        if start + len(data) - self._postings[2] > max(UNSORTED_ROWS, self._postings[2] // 8):
+            self._sort_postings()
+
+    def _map(self, data_files: List[Tuple[str, int]]):
+        """Map the rows of each vectors file, keeping the maps of the files that did not grow"""
+        previous = dict(zip(self._data_files, self._mapped[0]))
+        maps = []
+        for path, rows in data_files:
+            mapped = previous.get((path, rows))
+            if mapped is None and rows == 0:
+                mapped = np.zeros((0, self.dim), dtype=np.float32)
+            elif mapped is None:
+                mapped = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+            maps.append(mapped)
+        ends = np.cumsum([rows for _, rows in data_files], dtype=np.int64)
+        self._data_files = list(data_files)
+        self._mapped = (maps, ends)
+        self._rows = int(ends[-1]) if len(ends) > 0 else 0
+
+    def _gather(self, rows: np.ndarray, mapped=None) -> np.ndarray:
+        """The vectors of the given rows, read from whichever files hold them"""
+        maps, ends = self._mapped if mapped is None else mapped
+        if len(maps) == 1:
+            return np.asarray(maps[0][rows], dtype=np.float32)
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        files = np.searchsorted(ends, rows, side="right")
+        for f in np.unique(files):
+            at = files == f
+            vectors[at] = maps[f][rows[at] - (ends[f - 1] if f > 0 else 0)]
+        return vectors
+
+    def _sort_postings(self):
+        rows = self._rows
+        live = np.flatnonzero(self._row_labels[:rows] >= 0)
+        lists = self._row_lists[live]
+        order = np.argsort(lists, kind="stable")
+        offsets = np.zeros(len(self._centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=len(self._centroids)), out=offsets[1:])
+        self._postings = (offsets, live[order], rows)
+
+    def _candidates(self, lists: np.ndarray, rows: int) -> np.ndarray:
+        """Rows of the given lists among the first rows of the file"""
+        offsets, sorted_rows, sorted_upto = self._postings
+        parts = [sorted_rows[offsets[l] : offsets[l + 1]] for l in lists]
+        unsorted = np.arange(min(sorted_upto, rows), rows)
+        parts.append(unsorted[np.isin(self._row_lists[unsorted], lists)])
+        candidates = np.concatenate(parts)
+        return candidates[candidates < rows]
+
+    def mark_deleted(self, label: int):
+        if label >= len(self._present) or not self._present[label]:
+            raise RuntimeError("Label not found")
+        if self._deleted[label]:
+            raise RuntimeError("The requested to delete element is already deleted")
+        self._deleted[label] = True
+
+    def rows_of(self, labels) -> np.ndarray:
+        """The rows of the vectors files holding the given labels, which stay valid however the
+        index is changed later"""
+        return self._label_rows[np.asarray(labels, dtype=np.int64)].copy()
+
+    def read_rows(self, rows) -> np.ndarray:
+        return self._gather(np.asarray(rows, dtype=np.int64))
+
+    def get_items(self, ids, return_type: str = "numpy"):
+        vectors = self.read_rows(self.rows_of(ids))
+        return vectors if return_type == "numpy" else vectors.tolist()
+
+    def knn_query(self, data, k: int = 1, num_threads: int = -1, filter: Optional[Filter] = None):
+        queries = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        if self.space == "cosine":
+            queries = normalize(queries)
+        used = self._used
+        allowed = self._present[:used] & ~self._deleted[:used]
+        if isinstance(filter, np.ndarray):
+            allowed &= filter[:used]
+        elif filter is not None:
+            allowed &= np.fromiter(map(filter, range(used)), dtype=bool, count=used)
+        if np.count_nonzero(allowed) < k:
+            raise RuntimeError(
+                "Cannot return the results in a contigious 2D array. Probably ef or M is too small"
+            )
+
+        mapped = self._mapped
+        mapped_rows = int(mapped[1][-1]) if len(mapped[1]) > 0 else 0
+        nlist = len(self._centroids)
+
+        def search(block):
+            probe_order = np.argsort(self._centroid_distances(block), axis=1)
+            labels = np.empty((len(block), k), dtype=np.uint64)
+            distances = np.empty((len(block), k), dtype=np.float32)
+            for i, query in enumerate(block):
+                # probe more lists until enough allowed elements are found
+                probes = min(self.ef, nlist)
+                while True:
+                    rows = self._candidates(probe_order[i, :probes], mapped_rows)
+                    row_labels = self._row_labels[rows]
+                    keep = (row_labels >= 0) & (row_labels < used)
+                    keep[keep] = allowed[row_labels[keep]]
+                    if np.count_nonzero(keep) >= k or probes == nlist:
+                        break
+                    probes = min(2 * probes, nlist)
+
+                # read the rows in file order, touching each page once
+                rows = np.sort(rows[keep])
+                space = "ip" if self.space == "cosine" else self.space
+                found = pairwise_distances(
+                    query[None, :], self._gather(rows, mapped), space
+                ).astype(np.float32)
+                nearest, nearest_distances = top_k(found, self._row_labels[rows], k)
+                labels[i], distances[i] = nearest[0], nearest_distances[0]
+            return labels, distances
+
+        return search_in_threads(
+            search, queries, self.num_threads if num_threads < 0 else num_threads
+        )
+
+    def save_index(self, path: str):
+        offsets, sorted_rows, sorted_upto = self._postings
+        arrays = {
+            "present": self._present,
+            "deleted": self._deleted,
+            "label_rows": self._label_rows,
+            "row_labels": self._row_labels,
+            "row_lists": self._row_lists,
+            "centroids": self._centroids,
+            "offsets": offsets,
+            "sorted_rows": sorted_rows,
+        }
+        metadata = {
+            "used": self._used,
+            "elements": self.element_count,
+            "rows": self._rows,
+            "sorted_upto": sorted_upto,
+            "clustered_for": self.clustered_for,
+            "nlist": self.nlist,
+            # the vectors files live next to the index file
+            "data_files": [[os.path.basename(path), rows] for path, rows in self._data_files],
+        }
+        save_arrays(path, arrays, metadata)
+        # map the saved arrays in place of the ones in memory
+        self._restore(*load_arrays(path))
+
+    def load_index(self, path: str, max_elements: int = 0, **kwargs):
+        self._restore(*load_arrays(path))
+        if max_elements > self.get_max_elements():
+            self.resize_index(max_elements)
+
+    def _restore(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+        self._present = arrays["present"]
+        self._deleted = arrays["deleted"]
+        self._label_rows = arrays["label_rows"]
+        self._row_labels = arrays["row_labels"]
+        self._row_lists = arrays["row_lists"]
+        self._centroids = np.asarray(arrays["centroids"])
+        self._postings = (arrays["offsets"], arrays["sorted_rows"], metadata["sorted_upto"])
+        self._used = metadata["used"]
+        self.element_count = metadata["elements"]
+        self.clustered_for = metadata["clustered_for"]
+        self.nlist = metadata["nlist"]
+        # the vectors files are kept beside the index files rather than in a snapshot of them,
+        # as they are only ever appended to; rows appended after the index file was saved are
+        # not part of the index, and left alone
+        folder = os.path.dirname(self._base)
+        if "data_files" in metadata:
+            data_files = [
+                (os.path.join(folder, name), rows) for name, rows in metadata["data_files"]
+            ]
+        else:
+            # indexes saved before there could be several vectors files
+            data_files = [(os.path.join(folder, metadata["data_file"]), metadata["rows"])]
+        if self._file is not None and data_files[-1][0] != self._file.name:
+            self._file.close()
+            self._file = None
+        self._map(data_files)
+
+    def discard(self):
+        """Remove the vectors files of an index that has been replaced"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for path in self.data_files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def squared_distances(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Squared euclidean distance from every point to every centroid"""
+    distances = (
+        np.einsum("ij,ij->i", points, points)[:, None]
+        - 2 * points @ centroids.T
+        + np.einsum("ij,ij->i", centroids, centroids)[None, :]
+    )
+    return np.maximum(distances, 0)
+
+
+def _seed(
+    data: np.ndarray, k: int, rng: np.random.Generator, sample_size: int = 10000
+) -> np.ndarray:
+    """Pick k starting centroids with k-means++ seeding on a sample of the points"""
+    sample = data[rng.choice(len(data), size=min(sample_size, len(data)), replace=False)]
+    centroids = np.empty((k, data.shape[1]), dtype=np.float32)
+    centroids[0] = sample[rng.integers(len(sample))]
+    nearest = squared_distances(sample, centroids[:1])[:, 0]
+    for i in range(1, k):
+        total = nearest.sum()
+        if total > 0:
+            centroids[i] = sample[rng.choice(len(sample), p=nearest / total)]
+        else:
+            centroids[i] = sample[rng.integers(len(sample))]
+        nearest = np.minimum(nearest, squared_distances(sample, centroids[i : i + 1])[:, 0])
+    return centroids
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """Cluster data into at most k centroids with Lloyd's algorithm, seeded with k-means++.
+    Centroids left without points are reseeded from the points farthest from their centroid."""
+    data = np.asarray(data, dtype=np.float32)
+    k = min(k, len(data))
+    rng = np.random.default_rng(seed)
+    centroids = _seed(data, k, rng)
+    for _ in range(iterations):
+        distances = squared_distances(data, centroids)
+        assignment = np.argmin(distances, axis=1)
+        counts = np.bincount(assignment, minlength=k)
+        # sum the points of each cluster in one pass over the points sorted by cluster
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        sums = np.add.reduceat(data[order], starts[filled], axis=0)
+
+        empty = np.flatnonzero(~filled)
+        centroids[filled] = sums / counts[filled, None]
+        if len(empty) > 0:
+            farthest = np.argsort(distances[np.arange(len(data)), assignment])[::-1]
+            centroids[empty] = data[farthest[: len(empty)]]
+    return centroids
+
+
+def assign(data: np.ndarray, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """The nearest centroid of each point, computed in blocks to bound memory"""
+    assignment = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = np.asarray(data[start : start + block_size], dtype=np.float32)
+        assignment[start : start + block_size] = np.argmin(
+            squared_distances(block, centroids), axis=1
+        )
+    return assignment
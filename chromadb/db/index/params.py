@@ -0,0 +1,83 @@
+from typing import Dict, Optional
+
+# collection metadata keys that configure the index, and the index metadata fields they set
+INDEX_PARAM_KEYS = {
+    "hnsw:space": "space",
+    "hnsw:M": "M",
+    "hnsw:construction_ef": "ef_construction",
+    "hnsw:search_ef": "ef",
+    "hnsw:num_threads": "num_threads",
+    "index:type": "index_type",
+    "index:rerank": "rerank",
+    "pq:subvectors": "pq_subvectors",
+    "ivf:nlist": "nlist",
+    "hnsw:shards": "shards",
+    "index:partition_key": "partition_key",
+}
+DEFAULT_INDEX_PARAMS = {
+    "space": "l2",
+    "M": 16,
+    "ef_construction": 100,
+    "ef": 10,
+    "num_threads": 4,
+    "index_type": "auto",
+    "rerank": 4,
+    "pq_subvectors": None,
+    "nlist": None,
+    "shards": 1,
+    "partition_key": None,
+}
+# index parameters of searches, the others are fixed once the index is built
+SEARCH_PARAMS = ["ef", "num_threads"]
+SPACES = ["l2", "cosine", "ip"]
+
+# a collection's index is an exact scan or an hnsw graph, or starts as a scan and becomes a
+# graph once it holds more than chroma_index_flat_threshold elements, or is a scan over
+# scalar (sq8) or product (pq) quantized codes of the vectors, or an inverted file (ivf) of
+# clustered vectors kept on disk
+FLAT = "flat"
+HNSW = "hnsw"
+AUTO = "auto"
+SQ8 = "sq8"
+PQ = "pq"
+IVF = "ivf"
+INDEX_TYPES = [AUTO, FLAT, HNSW, SQ8, PQ, IVF]
+
+
+def index_params_from_metadata(metadata: Optional[Dict]) -> Dict:
+    """Read the index configuration from a collection's metadata, filling in defaults.
+    Raises ValueError for unknown spaces or index types, or non-positive integer parameters.
+    A rerank of 0 turns off re-ranking of quantized results. A partition key keeps a sub-index
+    for each value of that metadata key, see Partitions."""
+    params = dict(DEFAULT_INDEX_PARAMS)
+    choices = {"space": SPACES, "index_type": INDEX_TYPES}
+    for key, param in INDEX_PARAM_KEYS.items():
+        if metadata is None or key not in metadata:
+            continue
+        value = metadata[key]
+        if param in choices:
+            if value not in choices[param]:
+                raise ValueError(
+                    f"Expected {key} to be one of {', '.join(choices[param])}, got {value}"
+                )
+        elif param == "partition_key":
+            if not isinstance(value, str) or len(value) == 0:
+                raise ValueError(f"Expected {key} to be a metadata key, got {value}")
+        elif param == "rerank":
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"Expected {key} to be a non-negative integer, got {value}")
+        elif not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f"Expected {key} to be a positive integer, got {value}")
+        params[param] = value
+    return params
+
+
+def check_unchanged(built: Dict, params: Dict):
+    """Raise ValueError if params change any parameter of an index built as built, other than
+    the search parameters, as the index would have to be built again"""
+    for param, key in INDEX_PARAM_KEYS.items():
+        if key not in SEARCH_PARAMS and params[key] != built[key]:
+            raise ValueError(
+                f"Cannot change {param} of a collection once its index is built, "
+                f"from {built[key]} to {params[key]}"
+            )
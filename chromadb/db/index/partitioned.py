@@ -0,0 +1,361 @@
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, cast
+import uuid
+from chromadb.api.types import IndexMetadata
+import numpy as np
+from chromadb.db.index import Index
+from chromadb.db.index.distances import top_k
+from chromadb.db.index.params import SEARCH_PARAMS, check_unchanged
+from chromadb.db.index.partitions import Partitions, encode, group
+from chromadb.db.index.resident import DEFAULT_RECALL_TARGETS, ResidentIndex
+from chromadb.errors import NoDatapointsException, NoIndexException
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionedIndex(Index):
+    """The indexes of collections partitioned by a metadata key, a sub-index of the resident
+    index for each large enough value of the key and one shared by the others, see Partitions.
+
+    The sub-indexes are kept by resident as collections of their own, the elements and files
+    of the partitioned collection are only its partition table.
+    """
+
+    def __init__(self, settings, resident: ResidentIndex):
+        self._resident = resident
+        self._partition_min_size = settings.chroma_index_partition_min_size
+        # the partition tables of partitioned collections, None for the other indexes
+        self._partition_tables: Dict[str, Optional[Partitions]] = {}
+
+    def _table(self, collection_uuid) -> Partitions:
+        table = self._partitions(collection_uuid)
+        if table is None:
+            raise NoIndexException(f"Index {collection_uuid} is not partitioned")
+        return table
+
+    def run(self, collection_uuid, uuids, embeddings, params: Optional[Dict] = None):
+        self.build(collection_uuid, len(uuids), [(uuids, embeddings)], params)
+
+    def build(self, collection_uuid, elements: int, chunks, params: Optional[Dict] = None):
+        """Build the sub-indexes of a partitioned collection, chunks also carry the values of
+        the partition key of their elements"""
+        self._build_partitions(collection_uuid, chunks, params)
+
+    def add_incremental(
+        self,
+        collection_uuid,
+        uuids,
+        embeddings,
+        params: Optional[Dict] = None,
+        partitions: Optional[Sequence] = None,
+        members: Optional[Callable[[object], List[uuid.UUID]]] = None,
+    ):
+        """Add embeddings to a partitioned collection, creating its partition table with params
+        if it has none. partitions are the values of the partition key of the embeddings, and
+        members gives the uuids of the elements of a value, to move them to a sub-index of
+        their own once there are enough of them."""
+        table = self._partitions(collection_uuid)
+        if table is None:
+            table = self._create_partitions(collection_uuid, params)
+        self._add_partitioned(collection_uuid, table, uuids, embeddings, partitions, members)
+
+    def delete_from_index(self, collection_uuid, uuids, partitions: Optional[Sequence] = None):
+        """Delete elements from a partitioned collection. partitions are the values of the
+        partition key of the elements, without them every sub-index is searched for the
+        elements."""
+        self._delete_partitioned(collection_uuid, self._table(collection_uuid), uuids, partitions)
+
+    def delete(self, collection_uuid):
+        """Delete the sub-indexes and partition table of a collection"""
+        table = self._partitions(collection_uuid)
+        if table is None:
+            return
+        for key in table.indexes(collection_uuid):
+            self._resident.delete(key)
+        os.remove(self._resident._path("partitions", collection_uuid, "json"))
+        self._partition_tables.pop(str(collection_uuid), None)
+
+    def delete_index(self, collection_uuid):
+        """Drop the sub-indexes of a collection from memory, the resident index removes the
+        files named after it"""
+        table = self._partition_tables.pop(str(collection_uuid), None)
+        if table is None:
+            return
+        for key in table.indexes(collection_uuid):
+            self._resident._drop(key)
+
+    def reset(self):
+        self._partition_tables.clear()
+
+    def has_index(self, collection_uuid):
+        return self._partitions(collection_uuid) is not None
+
+    def get_metadata(self, collection_uuid) -> IndexMetadata:
+        """The configuration of the first sub-index, counting the elements of them all"""
+        table = self._table(collection_uuid)
+        for key in table.indexes(collection_uuid):
+            if self._resident.has_index(key):
+                metadata = dict(
+                    self._resident.get_metadata(key), elements=table.elements(), deleted=0
+                )
+                return cast(IndexMetadata, metadata)
+        raise NoIndexException("Index is not initialized")
+
+    def compact(self, collection_uuid):
+        for key in self._table(collection_uuid).indexes(collection_uuid):
+            self._resident.compact(key)
+
+    def calibrate(
+        self,
+        collection_uuid,
+        recall_targets=DEFAULT_RECALL_TARGETS,
+        k=10,
+        sample_size=100,
+        merge=False,
+    ) -> Dict[float, int]:
+        """Calibrate each sub-index, returning the largest ef of each target"""
+        ef_for: Dict[float, int] = {}
+        for key in self._table(collection_uuid).indexes(collection_uuid):
+            if self._resident.has_index(key):
+                calibration = self._resident.calibrate(key, recall_targets, k, sample_size, merge)
+                for target, ef in calibration.items():
+                    ef_for[target] = max(ef, ef_for.get(target, 0))
+        return ef_for
+
+    def warm_up(self, collection_uuid, queries=10, k=10) -> bool:
+        indexes = self._table(collection_uuid).indexes(collection_uuid)
+        warmed = [self._resident.warm_up(key, queries, k) for key in indexes]
+        return any(warmed)
+
+    def reconfigure(self, collection_uuid, params: Dict):
+        """Apply the search ef and threads of a collection's changed configuration to its
+        sub-indexes, changing any other parameter raises ValueError"""
+        table = self._table(collection_uuid)
+        check_unchanged(dict(table.params, partition_key=table.key), params)
+        with self._resident._load_lock(collection_uuid):
+            table.params.update({key: params[key] for key in SEARCH_PARAMS})
+            table.save(self._resident._path("partitions", collection_uuid, "json"))
+        for key in table.indexes(collection_uuid):
+            if self._resident.has_index(key):
+                self._resident.reconfigure(key, dict(params, partition_key=None))
+
+    def index_status(self, collection_uuid) -> Dict[str, bool]:
+        """Whether every sub-index of a collection is resident in memory, and pinned there"""
+        statuses = [
+            self._resident.index_status(key)
+            for key in self._table(collection_uuid).indexes(collection_uuid)
+            if self._resident.has_index(key)
+        ]
+        return {
+            "loaded": len(statuses) > 0 and all(status["loaded"] for status in statuses),
+            "pinned": len(statuses) > 0 and all(status["pinned"] for status in statuses),
+        }
+
+    def partition_key(self, collection_uuid) -> Optional[str]:
+        """The metadata key a collection's index is partitioned by, None if it is not"""
+        table = self._partitions(collection_uuid)
+        return table.key if table is not None else None
+
+    def partition_route(self, collection_uuid, where) -> Optional[Tuple[str, bool]]:
+        """The sub-index holding every element that matches where, and whether its search must
+        still be filtered to them, or None unless where is an equality on the partition key"""
+        table = self._partitions(collection_uuid)
+        if table is None or list(where.keys()) != [table.key]:
+            return None
+        value = where[table.key]
+        if isinstance(value, dict):
+            if list(value.keys()) != ["$eq"]:
+                return None
+            value = value["$eq"]
+        encoded = encode(value)
+        return table.index_for(collection_uuid, encoded), encoded not in table.own
+
+    def _partitions(self, collection_uuid) -> Optional[Partitions]:
+        """The partition table of a collection, None if its index is not partitioned"""
+        key = str(collection_uuid)
+        if key not in self._partition_tables:
+            path = self._resident._path("partitions", key, "json")
+            table = Partitions.load(path) if os.path.isfile(path) else None
+            self._partition_tables.setdefault(key, table)
+        return self._partition_tables[key]
+
+    def _create_partitions(self, collection_uuid, params) -> Partitions:
+        with self._resident._load_lock(collection_uuid):
+            table = self._partitions(collection_uuid)
+            if table is None:
+                # the sub-indexes are configured as the collection, but not partitioned again
+                table = Partitions(
+                    params["partition_key"],
+                    dict(params, partition_key=None),
+                    self._partition_min_size,
+                )
+                os.makedirs(self._resident._save_folder, exist_ok=True)
+                table.save(self._resident._path("partitions", collection_uuid, "json"))
+                self._partition_tables[str(collection_uuid)] = table
+            return table
+
+    def _build_partitions(self, collection_uuid, chunks, params):
+        """Build the sub-indexes of a partitioned collection from chunks of uuids, embeddings
+        and the values of the partition key, added one chunk at a time"""
+        self._resident.delete(collection_uuid)
+        table = self._create_partitions(collection_uuid, params)
+        # the uuids of each partition in the shared sub-index, to move once it outgrows it
+        shared: Dict[str, List[uuid.UUID]] = {}
+        added = 0
+        s = time.time()
+        for chunk in chunks:
+            uuids, embeddings = chunk[0], chunk[1]
+            if len(uuids) == 0:
+                continue
+            values = chunk[2] if len(chunk) > 2 else [None] * len(uuids)
+            self._add_partitioned(
+                collection_uuid,
+                table,
+                uuids,
+                embeddings,
+                values,
+                lambda value: shared.get(encode(value), []),
+            )
+            for encoded, rows in group(values):
+                if encoded in table.own:
+                    shared.pop(encoded, None)
+                else:
+                    shared.setdefault(encoded, []).extend(uuids[i] for i in rows)
+            added += len(uuids)
+
+        if added == 0:
+            self._resident.delete(collection_uuid)
+            raise NoDatapointsException(f"No embeddings to index for {collection_uuid}")
+        logger.info(
+            f"Indexed {added} embeddings of {collection_uuid} in {len(table.own)} partitions of "
+            f"their own and a shared index in {time.time() - s:.2f}s"
+        )
+
+    def _add_partitioned(
+        self, collection_uuid, table: Partitions, uuids, embeddings, partitions, members
+    ):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        values = partitions if partitions is not None else [None] * len(uuids)
+        with self._resident._load_lock(collection_uuid):
+            for encoded, rows in group(values):
+                partition_uuids = [uuids[i] for i in rows]
+                if members is not None and table.outgrown(encoded, len(rows)):
+                    self._move_partition(
+                        collection_uuid, table, encoded, partition_uuids, embeddings[rows], members
+                    )
+                else:
+                    self._resident.add_incremental(
+                        table.index_for(collection_uuid, encoded),
+                        partition_uuids,
+                        embeddings[rows],
+                        table.params,
+                    )
+                table.sizes[encoded] = table.sizes.get(encoded, 0) + len(rows)
+            table.save(self._resident._path("partitions", collection_uuid, "json"))
+
+    def _move_partition(
+        self, collection_uuid, table: Partitions, encoded, uuids, embeddings, members
+    ):
+        """Give a partition that has outgrown the shared sub-index one of its own, holding the
+        elements it has there and the ones being added"""
+        shared = table.shared(collection_uuid)
+        added = set(uuids)
+        candidates = [u for u in members(json.loads(encoded)) if u not in added]
+        moved: List[uuid.UUID] = []
+        vectors = np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+        with self._resident._reading(shared) as loaded:
+            if loaded is not None and len(candidates) > 0:
+                labels = loaded.ids.labels_for(candidates)
+                moved = [u for u, label in zip(candidates, labels) if label >= 0]
+                if len(moved) > 0:
+                    vectors = np.asarray(
+                        loaded.index.get_items(labels[labels >= 0]), dtype=np.float32
+                    )
+
+        table.own.add(encoded)
+        try:
+            self._resident.add_incremental(
+                table.index_for(collection_uuid, encoded),
+                moved + list(uuids),
+                np.concatenate([vectors, embeddings]),
+                table.params,
+            )
+        except:
+            table.own.discard(encoded)
+            raise
+        if len(moved) > 0:
+            self._resident.delete_from_index(shared, moved)
+        logger.info(
+            f"Moved partition {encoded} of {collection_uuid} to an index of its own, "
+            f"with {len(moved) + len(uuids)} elements"
+        )
+
+    def _delete_partitioned(self, collection_uuid, table: Partitions, uuids, partitions):
+        if len(uuids) == 0:
+            return
+        with self._resident._load_lock(collection_uuid):
+            if partitions is None:
+                # without the values the counts of the partitions are left as they are
+                for key in table.indexes(collection_uuid):
+                    loaded = self._resident._get(key)
+                    if loaded is None:
+                        continue
+                    held = [
+                        u for u, label in zip(uuids, loaded.ids.labels_for(uuids)) if label >= 0
+                    ]
+                    if len(held) > 0:
+                        self._resident.delete_from_index(key, held)
+                return
+
+            for encoded, rows in group(partitions):
+                self._resident.delete_from_index(
+                    table.index_for(collection_uuid, encoded), [uuids[i] for i in rows]
+                )
+                table.sizes[encoded] = table.sizes.get(encoded, 0) - len(rows)
+                if table.sizes[encoded] <= 0:
+                    del table.sizes[encoded]
+            table.save(self._resident._path("partitions", collection_uuid, "json"))
+
+    def get_nearest_neighbors(
+        self,
+        collection_uuid,
+        query,
+        k,
+        uuids=None,
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
+    ):
+        """Search every sub-index holding elements that may be returned, and merge the nearest
+        of each"""
+        query = np.asarray(query, dtype=np.float32)
+        table = self._table(collection_uuid)
+        found = []
+        distances = []
+        for key in table.indexes(collection_uuid):
+            loaded = self._resident._get(key)
+            if loaded is None:
+                continue
+            if uuids is None or len(uuids) == 0:
+                available = len(loaded.ids)
+            else:
+                available = int(np.count_nonzero(loaded.ids.labels_for(uuids) >= 0))
+            if available == 0:
+                continue
+            result, result_distances = self._resident.get_nearest_neighbors(
+                key, query, min(k, available), uuids, search_ef, recall_target, num_threads
+            )
+            found.append(result)
+            distances.append(np.asarray(result_distances))
+
+        if len(found) == 0:
+            raise NoIndexException("Index not found, please create an instance before querying")
+        if len(found) == 1:
+            return found[0], distances[0]
+        candidates = [[u for result in found for u in result[i]] for i in range(len(query))]
+        all_distances = np.concatenate(distances, axis=1)
+        positions, nearest = top_k(all_distances, np.arange(all_distances.shape[1]), k)
+        return [[row[p] for p in position] for row, position in zip(candidates, positions)], nearest
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# the sub-index holding the elements of every partition too small for a sub-index of its own
+SHARED = "shared"
+
+
+def encode(value: Any) -> str:
+    """The key a partition value is tracked under, json so that 1 and "1" stay apart"""
+    return json.dumps(value)
+
+
+def group(values: Sequence[Any]) -> Iterator[Tuple[str, List[int]]]:
+    """The positions of each distinct partition value, by encoded value"""
+    groups: Dict[str, List[int]] = {}
+    for i, value in enumerate(values):
+        groups.setdefault(encode(value), []).append(i)
+    return iter(groups.items())
+
+
+class Partitions:
+    """Which sub-index each value of a collection's partition key lives in.
+
+    A partition holding at least min_size elements has a sub-index of its own, searched
+    without a filter by queries for its value. Smaller partitions share a single sub-index,
+    searched with the filter of the elements of the value, so that a key with many rare values
+    does not make as many tiny indexes. A partition is moved to a sub-index of its own once it
+    grows past min_size, and is never moved back.
+
+    The table is saved as json next to the sub-indexes, it holds a count per value and the
+    params the sub-indexes are created with.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        params: Dict,
+        min_size: int,
+        sizes: Optional[Dict[str, int]] = None,
+        own: Optional[List[str]] = None,
+    ):
+        self.key = key
+        self.params = params
+        self.min_size = min_size
+        self.sizes = sizes if sizes is not None else {}
+        self.own = set(own if own is not None else [])
+
+    def shared(self, collection_uuid) -> str:
+        return f"{collection_uuid}-{SHARED}"
+
+    def index_for(self, collection_uuid, encoded: str) -> str:
+        """The key of the sub-index holding the partition of an encoded value"""
+        if encoded not in self.own:
+            return self.shared(collection_uuid)
+        return f"{collection_uuid}-{hashlib.sha1(encoded.encode()).hexdigest()[:16]}"
+
+    def indexes(self, collection_uuid) -> List[str]:
+        return [self.shared(collection_uuid)] + [
+            self.index_for(collection_uuid, encoded) for encoded in sorted(self.own)
+        ]
+
+    def outgrown(self, encoded: str, added: int) -> bool:
+        """Whether a shared partition reaches min_size with added more elements; elements
+        without the key are never given a sub-index, they cannot be queried by value"""
+        return (
+            encoded not in self.own
+            and encoded != encode(None)
+            and self.sizes.get(encoded, 0) + added >= self.min_size
+        )
+
+    def elements(self) -> int:
+        return sum(self.sizes.values())
+
+    def save(self, path: str):
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(
+                {
+                    "key": self.key,
+                    "params": self.params,
+                    "min_size": self.min_size,
+                    "sizes": self.sizes,
+                    "own": sorted(self.own),
+                },
+                f,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "Partitions":
+        with open(path) as f:
+            table = json.load(f)
+        return cls(table["key"], table["params"], table["min_size"], table["sizes"], table["own"])
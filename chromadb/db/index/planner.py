@@ -0,0 +1,78 @@
+import math
+from typing import Dict, Optional
+
+# ways of running a k-nn query restricted to a subset of the index
+EXACT = "exact"  # brute force distance scan over the allowed vectors only
+FILTERED = "filtered"  # graph search that skips disallowed elements
+POSTFILTER = "postfilter"  # unfiltered graph search for more than k results, then filtered
+
+
+def exact_scan_fits(filter_size: int, dim: int, exact_threshold: int) -> bool:
+    """Whether scanning the allowed vectors is cheap enough to answer a query exactly.
+
+    The cost of a scan is the vectors it reads: filter_size of them of dim components each,
+    which an hnsw graph hands out one at a time. exact_threshold bounds that product, so that
+    the same budget admits fewer wide vectors than narrow ones.
+    """
+    return filter_size * dim <= exact_threshold
+
+
+def plan_filtered_query(
+    filter_size: int,
+    index_size: int,
+    dim: int,
+    ef: int,
+    exact_threshold: int,
+    exact_scan_cost: float,
+    postfilter_selectivity: float,
+) -> str:
+    """Pick how to run a query at search ef whose results must come from filter_size of the
+    index_size elements of dim components.
+
+    Small candidate sets are cheapest and exact to scan directly. A filtered graph search
+    passes over index_size / filter_size elements for each allowed one, so it expands about
+    ef * index_size / filter_size nodes: past the threshold, the scan is still picked while
+    it reads fewer vectors than that at exact_scan_cost nodes each. When most of the index
+    passes the filter, an unfiltered search that asks for a few more results than needed
+    will almost always find enough allowed ones. In between, the graph search is filtered.
+    """
+    if exact_scan_fits(filter_size, dim, exact_threshold):
+        return EXACT
+    if exact_scan_cost * filter_size * filter_size <= ef * index_size:
+        return EXACT
+    if index_size > 0 and filter_size / index_size >= postfilter_selectivity:
+        return POSTFILTER
+    return FILTERED
+
+
+def oversampled_k(k: int, filter_size: int, index_size: int, factor: float = 2.0) -> int:
+    """How many unfiltered results to ask for, so that about factor * k pass the filter"""
+    return min(index_size, math.ceil(k * factor * index_size / max(filter_size, 1)))
+
+
+def default_search_ef(k: int, elements: int, ef_floor: int) -> int:
+    """The size of the candidate list for a search that asks for no particular recall.
+
+    Recall at a fixed ef falls as k grows, and as the graph gets larger and deeper, so the
+    list holds half as many candidates again as results plus a few per level of a graph of
+    this size. The configured ef of the index is the lower bound.
+    """
+    ef = math.ceil(1.5 * k) + math.ceil(math.log2(max(elements, 2)))
+    return max(ef_floor, min(ef, max(elements, k)))
+
+
+def calibrated_ef(calibration: Dict, recall_target: float, k: int) -> Optional[int]:
+    """The ef a calibration measured for the lowest target at or above recall_target, scaled
+    from the k it was measured at, or None when no calibrated target is high enough"""
+    targets = [target for target in calibration["ef"] if target >= recall_target]
+    if len(targets) == 0:
+        return None
+    ef = calibration["ef"][min(targets)]
+    return max(k, math.ceil(ef * k / calibration["k"]))
+
+
+def query_threads(queries: int, num_threads: int, min_queries_per_thread: int) -> int:
+    """How many threads to split a batch of queries across: at most num_threads, each with at
+    least min_queries_per_thread queries, so that a single query or a small batch runs on the
+    calling thread rather than paying to start threads it cannot keep busy"""
+    return max(1, min(num_threads, queries // max(min_queries_per_thread, 1)))
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IndexPool:
+    """A least-recently-used pool of resident indexes, bounded by an estimated memory budget
+    in bytes rather than by the number of entries.
+
+    Every entry is stored with its size. When inserting or growing an entry pushes the pool
+    over budget, the least recently used entries are evicted until it fits again. The entry
+    that was just touched is never evicted, so a single index larger than the budget can
+    still be served. Pinned keys are never evicted either, though their entries count toward
+    the budget.
+
+    The pool is safe to use from several threads. The eviction callback runs after the
+    pool's own lock has been released, so it may take other locks.
+    """
+
+    def __init__(self, max_bytes: int, on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self._max_bytes = max_bytes
+        self._on_evict = on_evict
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._total_bytes = 0
+        # pins outlive their entries, so an index replaced under the same key stays pinned
+        self._pinned: Set[Hashable] = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the entry for key and mark it most recently used, counting a hit or a miss"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Return the entry for key without touching its recency or the counters"""
+        return self._entries.get(key)
+
+    def put(self, key: Hashable, entry: Any, nbytes: int):
+        """Insert or replace an entry, evicting least recently used entries to stay in budget"""
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._sizes[key]
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._sizes[key] = nbytes
+            self._total_bytes += nbytes
+            evicted = self._evict(keep=key)
+        self._notify(evicted)
+
+    def resize(self, key: Hashable, nbytes: int):
+        """Update the recorded size of an entry after it has grown or shrunk"""
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._total_bytes += nbytes - self._sizes[key]
+            self._sizes[key] = nbytes
+            evicted = self._evict(keep=key)
+        self._notify(evicted)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """Remove an entry without calling the eviction callback"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._total_bytes -= self._sizes.pop(key)
+            return self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._pinned.clear()
+            self._total_bytes = 0
+
+    def pin(self, key: Hashable):
+        """Keep the entry for key resident until it is unpinned"""
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, key: Hashable):
+        with self._lock:
+            self._pinned.discard(key)
+
+    def is_pinned(self, key: Hashable) -> bool:
+        return key in self._pinned
+
+    def _evict(self, keep: Hashable) -> List[Tuple[Hashable, Any]]:
+        evicted = []
+        while self._total_bytes > self._max_bytes:
+            victim = next((k for k in self._entries if k != keep and k not in self._pinned), None)
+            if victim is None:
+                break
+            evicted.append((victim, self.pop(victim)))
+            self.evictions += 1
+            logger.debug(f"Evicted index {victim} from the index pool")
+        return evicted
+
+    def _notify(self, evicted: List[Tuple[Hashable, Any]]):
+        if self._on_evict is None:
+            return
+        for key, entry in evicted:
+            self._on_evict(key, entry)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "pinned": len(self._pinned),
+                "bytes": self._total_bytes,
+                "max_bytes": self._max_bytes,
+            }
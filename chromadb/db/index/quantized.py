@@ -0,0 +1,223 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+import numpy as np
+from chromadb.db.index.distances import top_k
+from chromadb.db.index.flat import FlatIndex, _resized
+from chromadb.db.index.kmeans import assign, kmeans
+
+# vectors sampled to train a quantizer, more add little to the codebooks but cost training time
+TRAINING_SIZE = 8192
+# rows decoded or looked up at a time when scanning the codes
+BLOCK_SIZE = 65536
+
+
+class QuantizedIndex(FlatIndex, ABC):
+    """A scan over compressed codes of the vectors instead of the vectors themselves.
+
+    The quantizer is trained on the first vectors added. The full precision vectors are kept
+    in the index file too, and as the file is memory mapped they cost page cache rather than
+    resident memory. They are used to re-rank the rerank * k nearest candidates of the scan by
+    their exact distances. With rerank 0 results are ordered by their approximate distances
+    alone.
+    """
+
+    def __init__(self, space: str, dim: int, rerank: int = 4):
+        super().__init__(space, dim)
+        self.rerank = rerank
+        self.trained_on = 0
+        self._codes = np.zeros((0, self.code_size()), dtype=np.uint8)
+        self._full = np.zeros((0, dim), dtype=np.float32)
+
+    @abstractmethod
+    def code_size(self) -> int:
+        pass
+
+    def nbytes(self) -> int:
+        return self._codes.nbytes + self._norms.nbytes + self._present.nbytes + self._deleted.nbytes
+
+    def _resize_storage(self, new_size: int):
+        self._codes = _resized(self._codes, new_size, self._used)
+        self._full = _resized(self._full, new_size, self._used)
+
+    def _store(self, labels: np.ndarray, data: np.ndarray):
+        if self.trained_on == 0:
+            self._train(data[np.random.default_rng(0).permutation(len(data))[:TRAINING_SIZE]])
+            self.trained_on = min(len(data), TRAINING_SIZE)
+        self._codes[labels] = self._encode(data)
+        self._full[labels] = data
+
+    def get_items(self, ids, return_type: str = "numpy"):
+        vectors = np.asarray(self._full[np.asarray(ids, dtype=np.int64)])
+        return vectors if return_type == "numpy" else vectors.tolist()
+
+    def _nearest(self, queries: np.ndarray, distances: np.ndarray, k: int, available: int):
+        if self.rerank == 0:
+            return super()._nearest(queries, distances, k, available)
+        candidates = min(max(self.ef, k * self.rerank), available)
+        labels, _ = top_k(distances, np.arange(distances.shape[1]), candidates)
+        vectors = self.get_items(labels.ravel()).reshape(len(queries), candidates, self.dim)
+        if self.space == "l2":
+            exact = np.einsum(
+                "ijk,ijk->ij", vectors - queries[:, None, :], vectors - queries[:, None, :]
+            )
+        else:
+            exact = 1 - np.einsum("ijk,ik->ij", vectors, queries)
+        positions, exact = top_k(exact, np.arange(candidates), k)
+        return np.take_along_axis(labels, positions, axis=1), exact
+
+    @abstractmethod
+    def _train(self, data: np.ndarray):
+        pass
+
+    @abstractmethod
+    def _encode(self, data: np.ndarray) -> np.ndarray:
+        pass
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "present": self._present,
+            "deleted": self._deleted,
+            "codes": self._codes,
+            "vectors": self._full,
+        }
+
+    def _metadata(self) -> Dict[str, Any]:
+        return dict(super()._metadata(), trained_on=self.trained_on)
+
+    def _restore(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+        self._present = arrays["present"]
+        self._deleted = arrays["deleted"]
+        self._codes = arrays["codes"]
+        self._full = arrays["vectors"]
+        self._used = metadata["used"]
+        self.element_count = metadata["elements"]
+        self.trained_on = metadata["trained_on"]
+
+
+class ScalarQuantizedIndex(QuantizedIndex):
+    """Each dimension quantized to a byte, evenly between its smallest and largest value in the
+    training vectors, for a quarter of the memory of float32 vectors"""
+
+    def __init__(self, space: str, dim: int, rerank: int = 4):
+        super().__init__(space, dim, rerank)
+        self._low = np.zeros(dim, dtype=np.float32)
+        self._scale = np.ones(dim, dtype=np.float32)
+
+    def code_size(self) -> int:
+        return self.dim
+
+    def _train(self, data: np.ndarray):
+        self._low = data.min(axis=0)
+        scale = (data.max(axis=0) - self._low) / 255
+        scale[scale == 0] = 1
+        self._scale = scale.astype(np.float32)
+
+    def _encode(self, data: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((data - self._low) / self._scale), 0, 255).astype(np.uint8)
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes * self._scale + self._low
+
+    def _resize_storage(self, new_size: int):
+        super()._resize_storage(new_size)
+        # squared norms of the decoded vectors, for l2 distances
+        self._norms = _resized(self._norms, new_size, self._used)
+
+    def _store(self, labels: np.ndarray, data: np.ndarray):
+        super()._store(labels, data)
+        decoded = self._decode(self._codes[labels])
+        self._norms[labels] = np.einsum("ij,ij->i", decoded, decoded)
+
+    def _scan(self, queries: np.ndarray, used: int) -> np.ndarray:
+        distances = np.empty((len(queries), used), dtype=np.float32)
+        for start in range(0, used, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, used)
+            decoded = self._decode(self._codes[start:stop])
+            distances[:, start:stop] = self._distances(queries, decoded, self._norms[start:stop])
+        return distances
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        return dict(super()._arrays(), norms=self._norms, low=self._low, scale=self._scale)
+
+    def _restore(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+        super()._restore(arrays, metadata)
+        self._norms = arrays["norms"]
+        self._low = np.asarray(arrays["low"])
+        self._scale = np.asarray(arrays["scale"])
+
+
+class ProductQuantizedIndex(QuantizedIndex):
+    """Vectors split into subvectors, each replaced by the byte numbering its nearest of 256
+    centroids trained for its subspace. Distances are looked up per subspace in tables computed
+    once per query. With a quarter as many subvectors as dimensions, the default, codes take a
+    sixteenth of the memory of float32 vectors."""
+
+    def __init__(self, space: str, dim: int, rerank: int = 4, subvectors: Optional[int] = None):
+        if subvectors is None:
+            subvectors = max(d for d in range(1, max(dim // 4, 1) + 1) if dim % d == 0)
+        if dim % subvectors != 0:
+            raise ValueError(
+                f"Expected the number of subvectors to divide the dimensionality {dim}, "
+                f"got {subvectors}"
+            )
+        self.subvectors = subvectors
+        super().__init__(space, dim, rerank)
+        self._codebooks = np.zeros((subvectors, 1, dim // subvectors), dtype=np.float32)
+
+    def code_size(self) -> int:
+        return self.subvectors
+
+    def _split(self, data: np.ndarray) -> np.ndarray:
+        """Vectors as (vectors, subvectors, subvector dimensions)"""
+        return data.reshape(len(data), self.subvectors, -1)
+
+    def _train(self, data: np.ndarray):
+        subvectors = self._split(data)
+        self._codebooks = np.stack(
+            [kmeans(subvectors[:, j], 256, iterations=10) for j in range(self.subvectors)]
+        )
+
+    def _encode(self, data: np.ndarray) -> np.ndarray:
+        subvectors = self._split(data)
+        codes = np.empty((len(data), self.subvectors), dtype=np.uint8)
+        for j in range(self.subvectors):
+            codes[:, j] = assign(subvectors[:, j], self._codebooks[j])
+        return codes
+
+    def _scan(self, queries: np.ndarray, used: int) -> np.ndarray:
+        # distance from each query subvector to each centroid of its subspace
+        subvectors = self._split(queries)
+        if self.space == "l2":
+            tables = np.stack(
+                [
+                    np.maximum(
+                        np.einsum("ij,ij->i", q, q)[:, None]
+                        - 2 * q @ c.T
+                        + np.einsum("ij,ij->i", c, c)[None, :],
+                        0,
+                    )
+                    for q, c in zip(subvectors.transpose(1, 0, 2), self._codebooks)
+                ],
+                axis=1,
+            )
+        else:
+            tables = np.einsum("qjd,jcd->qjc", subvectors, self._codebooks)
+        tables = tables.astype(np.float32)
+
+        distances = np.zeros((len(queries), used), dtype=np.float32)
+        for start in range(0, used, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, used)
+            codes = self._codes[start:stop]
+            block = distances[:, start:stop]
+            for j in range(self.subvectors):
+                block += tables[:, j, codes[:, j]]
+        if self.space != "l2":
+            distances = 1 - distances
+        return distances
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        return dict(super()._arrays(), codebooks=self._codebooks)
+
+    def _restore(self, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any]):
+        super()._restore(arrays, metadata)
+        self._codebooks = np.asarray(arrays["codebooks"])
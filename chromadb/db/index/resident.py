@@ -0,0 +1,1144 @@
+from abc import abstractmethod
+import atexit
+from contextlib import contextmanager
+import glob
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import uuid
+from chromadb.api.types import IndexMetadata
+import numpy as np
+from chromadb.db.index import Index
+from chromadb.db.index.backends import Backend, VectorIndex
+from chromadb.db.index.distances import brute_force_knn, search_in_threads, top_k
+from chromadb.db.index.idmap import IdMap
+from chromadb.db.index.lockfile import locked
+from chromadb.db.index.params import DEFAULT_INDEX_PARAMS, HNSW, SEARCH_PARAMS, check_unchanged
+from chromadb.db.index.planner import (
+    EXACT,
+    POSTFILTER,
+    calibrated_ef,
+    default_search_ef,
+    oversampled_k,
+    query_threads,
+)
+from chromadb.db.index.pool import IndexPool
+from chromadb.db.index.rwlock import ReadWriteLock
+from chromadb.db.index.wal import WriteAheadLog
+from chromadb.errors import NoDatapointsException, NoIndexException, InvalidDimensionException
+import logging
+
+logger = logging.getLogger(__name__)
+
+# recall targets measured by a calibration, besides any target a query asks for
+DEFAULT_RECALL_TARGETS = [0.9, 0.95, 0.99]
+
+
+class LoadedIndex:
+    """The index of a single collection's vectors, of any backend, and its id mapping, resident
+    in memory"""
+
+    def __init__(
+        self,
+        index: VectorIndex,
+        backend: Backend,
+        metadata: IndexMetadata,
+        ids: IdMap,
+        wal: Optional[WriteAheadLog] = None,
+    ):
+        self.index = index
+        self.backend = backend
+        self.metadata = metadata
+        self.ids = ids
+        self.wal = wal
+
+        # held for reading by queries, and for writing by mutations and saves
+        self.lock = ReadWriteLock()
+        # held for reading by queries at the ef the index is set to, and for writing by a query
+        # setting another one
+        self.ef_lock = ReadWriteLock()
+        # write-behind state: mutations not yet saved to the index files
+        self.dirty_since: Optional[float] = None
+        self.pending = 0
+
+        # labels of deleted elements, whose slots in the graph are reused by later adds
+        self._free_labels: Optional[List[int]] = None
+        # mutations made while a compacted copy is being built, replayed onto it before the swap
+        self.captured: Optional[List] = None
+        # set once a compacted copy has replaced this index
+        self.retired = False
+
+    @property
+    def free_labels(self) -> List[int]:
+        if self._free_labels is None:
+            labels = np.arange(self.metadata["elements"])
+            self._free_labels = np.setdiff1d(labels, self.ids.live_labels()).tolist()
+        return self._free_labels
+
+    def dead_ratio(self) -> float:
+        return self.metadata["deleted"] / max(self.metadata["elements"], 1)
+
+    def nbytes(self) -> int:
+        """Estimate the memory held by this index and its id mapping"""
+        return self.backend.nbytes(self.index, self.metadata["dimensionality"]) + self.ids.nbytes()
+
+
+class ResidentIndex(Index):
+    """Collection indexes resident in memory, whatever their backend: the pool they are cached
+    in, their locks, write-ahead logs, snapshots, write-behind saves and compactions, and how
+    queries are run on them.
+
+    Which backend indexes a collection is left to subclasses, through _pick_backend and
+    _backend; everything that differs between backends is asked of the Backend of each index.
+    """
+
+    def __init__(self, settings):
+        self._save_folder = settings.persist_directory + "/index"
+        self._pool = IndexPool(settings.chroma_index_cache_bytes, on_evict=self._on_evict)
+        self._growth_factor = max(settings.chroma_index_growth_factor, 1.0)
+        self._query_num_threads = settings.chroma_query_num_threads
+        self._min_queries_per_thread = settings.chroma_query_min_queries_per_thread
+
+        self._write_behind = settings.chroma_index_write_behind
+        self._flush_interval = settings.chroma_index_flush_interval
+        self._flush_threshold = settings.chroma_index_flush_threshold
+        self._compaction_threshold = settings.chroma_index_compaction_threshold
+        self._snapshots_kept = max(settings.chroma_index_snapshots_kept, 1)
+        # held while a collection's index is loaded or created, so that threads missing it at
+        # the same time share a single copy
+        self._load_locks: Dict[str, threading.RLock] = {}
+        self._load_locks_lock = threading.Lock()
+        # background compactions by collection, at most one each
+        self._compactions: Dict[str, threading.Thread] = {}
+        self._compactions_lock = threading.Lock()
+        self._flush_wakeup = threading.Event()
+        # dirty indexes evicted from the pool, waiting for the flusher to save them
+        self._evicted: Dict[str, LoadedIndex] = {}
+        self._flusher = None
+        self._stopped = False
+        if self._write_behind:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+            atexit.register(self.stop)
+
+    @abstractmethod
+    def _pick_backend(self, params: Dict, elements: int) -> str:
+        """The backend to index a collection of elements elements configured by params with"""
+        pass
+
+    @abstractmethod
+    def _backend(self, name: str, params: Dict) -> Backend:
+        """The backend an index recorded as name and configured by params is made by"""
+        pass
+
+    @abstractmethod
+    def _backends(self) -> Iterable[Backend]:
+        """Every backend an index may have been made by"""
+        pass
+
+    def _outgrown(self, loaded: LoadedIndex) -> Optional[str]:
+        """The backend to build an index again as once it has outgrown how it was built, such as
+        an automatically chosen flat index grown into a graph, or None"""
+        return loaded.backend.outgrown(loaded.index, loaded.metadata, len(loaded.ids))
+
+    def _new_index(self, collection_uuid, params, backend, dimensionality, capacity):
+        # more comments available at the source: https://github.com/nmslib/hnswlib
+        path = self._path("index", collection_uuid, "bin")
+        index = self._backend(backend, params).make(params, dimensionality, path)
+        index.init_index(
+            max_elements=max(capacity, 1), ef_construction=params["ef_construction"], M=params["M"]
+        )
+        index.set_ef(params["ef"])
+        index.set_num_threads(params["num_threads"])
+        return index
+
+    def _build(self, collection_uuid, params, backend, dimensionality, rows, read, capacity):
+        """Build an index of the vectors read from rows, labelled by their position"""
+        index = self._new_index(collection_uuid, params, backend, dimensionality, capacity)
+        if len(rows) > 0:
+            self._backend(backend, params).build(index, rows, read)
+        return index
+
+    def run(self, collection_uuid, uuids, embeddings, params: Optional[Dict] = None):
+        self.build(collection_uuid, len(uuids), [(uuids, embeddings)], params)
+
+    def build(
+        self,
+        collection_uuid,
+        elements: int,
+        chunks: Iterable[Tuple[Sequence[uuid.UUID], np.ndarray]],
+        params: Optional[Dict] = None,
+    ):
+        """Build a collection's index from chunks of uuids and their embeddings.
+
+        The index is sized for elements up front, so a collection read as a stream is indexed
+        without resizing and without holding more than one chunk of embeddings at a time.
+        Chunks are inserted using every core, and progress is logged along the way.
+        """
+        params = params if params is not None else DEFAULT_INDEX_PARAMS
+        backend = self._pick_backend(params, elements)
+        threads = os.cpu_count() or 1
+        index = None
+        ids = IdMap()
+        added = 0
+        s = time.time()
+        last_report = s
+        for uuids, embeddings in chunks:
+            if len(uuids) == 0:
+                continue
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if index is None:
+                dimensionality = embeddings.shape[1]
+                index = self._new_index(
+                    collection_uuid, params, backend, dimensionality, max(elements, len(uuids))
+                )
+            # rows added to the collection after it was counted
+            if added + len(uuids) > index.get_max_elements():
+                index.resize_index(
+                    max(added + len(uuids), int(index.get_max_elements() * self._growth_factor))
+                )
+
+            labels = np.arange(added, added + len(uuids))
+            ids.add(uuids, labels)
+            index.add_items(embeddings, labels, num_threads=threads)
+            added += len(uuids)
+
+            if time.time() - last_report >= 5:
+                last_report = time.time()
+                logger.info(
+                    f"Indexed {added} of {elements} embeddings of {collection_uuid}, "
+                    f"{added / (last_report - s):.0f} per second"
+                )
+
+        if index is None:
+            raise NoDatapointsException(f"No embeddings to index for {collection_uuid}")
+        logger.info(f"Indexed {added} embeddings of {collection_uuid} in {time.time() - s:.2f}s")
+
+        metadata: IndexMetadata = {
+            "dimensionality": dimensionality,
+            "elements": added,
+            "deleted": 0,
+            "capacity": index.get_max_elements(),
+            "time_created": time.time(),
+            "wal_sequence": 0,
+            "space": params["space"],
+            "M": params["M"],
+            "ef_construction": params["ef_construction"],
+            "ef": params["ef"],
+            "num_threads": params["num_threads"],
+            "index_type": params["index_type"],
+            "rerank": params["rerank"],
+            "pq_subvectors": params["pq_subvectors"],
+            "nlist": params["nlist"],
+            "shards": params["shards"],
+            "backend": backend,
+            "ef_calibration": None,
+        }
+
+        # a rebuilt index supersedes everything in the log of the previous one
+        previous = self._pool.pop(str(collection_uuid))
+        if previous is not None:
+            self._retire(previous)
+        wal = WriteAheadLog(self._path("wal", collection_uuid, "log"))
+        wal.truncate()
+        loaded = LoadedIndex(index, self._backend(backend, params), metadata, ids, wal)
+        # saved before it is visible to queries, saving remaps the files of a flat index
+        self._save(collection_uuid, loaded)
+        self._pool.put(str(collection_uuid), loaded, loaded.nbytes())
+        if previous is not None:
+            previous.backend.discard(previous.index)
+
+    def get_metadata(self, collection_uuid) -> IndexMetadata:
+        loaded = self._get(collection_uuid)
+        if loaded is None:
+            raise NoIndexException("Index is not initialized")
+        return loaded.metadata
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit, miss and eviction counters of the resident index pool"""
+        return self._pool.stats()
+
+    def warm_up(self, collection_uuid, queries=10, k=10) -> bool:
+        """Load a collection's index, pin it in the pool and run synthetic queries through it,
+        so that the first real queries do not pay for loading it or for faulting in its pages.
+        The queries are a sample of the collection's own vectors. Returns False if the
+        collection has no index."""
+        s = time.time()
+        with self._reading(collection_uuid) as loaded:
+            if loaded is None:
+                return False
+            self._pool.pin(str(collection_uuid))
+            labels = loaded.ids.live_labels()
+            rng = np.random.default_rng(0)
+            sample = rng.choice(labels, size=min(queries, len(labels)), replace=False)
+            vectors = np.asarray(loaded.index.get_items(sample), dtype=np.float32)
+
+        for vector in vectors:
+            self.get_nearest_neighbors(collection_uuid, vector[None, :], min(k, len(labels)))
+        logger.info(f"Warmed up index {collection_uuid} in {time.time() - s:.2f}s")
+        return True
+
+    def reconfigure(self, collection_uuid, params: Dict):
+        """Apply a collection's changed index configuration to its index. The search ef and
+        threads are applied to the index as it is; changing any other parameter raises
+        ValueError, as the index would have to be built again."""
+        loaded = self._get(collection_uuid)
+        if loaded is None:
+            return
+        check_unchanged(dict(loaded.metadata, partition_key=None), params)
+
+        with self._locked(collection_uuid) as loaded:
+            if loaded is None or all(loaded.metadata[p] == params[p] for p in SEARCH_PARAMS):
+                return
+            loaded.index.set_ef(params["ef"])
+            loaded.index.set_num_threads(params["num_threads"])
+            loaded.metadata.update({p: params[p] for p in SEARCH_PARAMS})
+            self._mark_dirty(collection_uuid, loaded, 0)
+
+    def index_status(self, collection_uuid) -> Dict[str, bool]:
+        """Whether a collection's index is resident in memory, and pinned there"""
+        key = str(collection_uuid)
+        return {
+            "loaded": key in self._pool or key in self._evicted,
+            "pinned": self._pool.is_pinned(key),
+        }
+
+    @contextmanager
+    def _locked(self, collection_uuid):
+        """Lock a collection's index for a mutation, or give None if it has no index.
+        An index retired by a compaction while waiting for its lock is skipped for its successor."""
+        while True:
+            loaded = self._get(collection_uuid)
+            if loaded is None:
+                yield None
+                return
+            with loaded.lock.write():
+                if not loaded.retired:
+                    yield loaded
+                    return
+
+    @contextmanager
+    def _reading(self, collection_uuid):
+        """Lock a collection's index for a query, or give None if it has no index. Any number
+        of queries hold the lock together, mutations wait for them."""
+        while True:
+            loaded = self._get(collection_uuid)
+            if loaded is None:
+                yield None
+                return
+            with loaded.lock.read():
+                if not loaded.retired:
+                    yield loaded
+                    return
+
+    def _load_lock(self, collection_uuid) -> threading.RLock:
+        with self._load_locks_lock:
+            return self._load_locks.setdefault(str(collection_uuid), threading.RLock())
+
+    def _retire(self, loaded: LoadedIndex):
+        """Take an index out of use once the queries and mutation holding it are done"""
+        with loaded.lock.write():
+            loaded.retired = True
+            if loaded.wal is not None:
+                loaded.wal.close()
+
+    def _create(self, collection_uuid, uuids, embeddings, params) -> bool:
+        """Create a collection's index from its first embeddings, unless another thread has"""
+        key = str(collection_uuid)
+        with self._load_lock(key):
+            if self._pool.peek(key) is not None or key in self._evicted or self.has_index(key):
+                return False
+            self.run(collection_uuid, uuids, embeddings, params)
+            return True
+
+    def add_incremental(
+        self,
+        collection_uuid,
+        uuids,
+        embeddings,
+        params: Optional[Dict] = None,
+        partitions: Optional[Sequence] = None,
+        members: Optional[Callable[[object], List[uuid.UUID]]] = None,
+    ):
+        """Add embeddings to a collection's index, creating it with params if it does not exist.
+        partitions and members are only used by partitioned collections."""
+        with self._locked(collection_uuid) as loaded:
+            if loaded is None:
+                if not self._create(collection_uuid, uuids, embeddings, params):
+                    self.add_incremental(
+                        collection_uuid, uuids, embeddings, params, partitions, members
+                    )
+                return
+
+            idx_dimension = loaded.metadata["dimensionality"]
+            # Check dimensionality
+            if idx_dimension != len(embeddings[0]):
+                raise InvalidDimensionException(
+                    f"Dimensionality of new embeddings ({len(embeddings[0])}) does not match index dimensionality ({idx_dimension})"
+                )
+
+            self._log(
+                loaded, "add", ([u.bytes for u in uuids], np.asarray(embeddings, dtype=np.float32))
+            )
+            self._add(loaded, uuids, embeddings)
+            self._pool.resize(str(collection_uuid), loaded.nbytes())
+            self._mark_dirty(collection_uuid, loaded, len(uuids))
+            outgrown = self._outgrown(loaded)
+
+        if outgrown:
+            self._compact_in_background(collection_uuid)
+
+    def _add(self, loaded: LoadedIndex, uuids, embeddings):
+        # fill the slots of deleted elements first, hnswlib updates a deleted element in place
+        # when its label is added again
+        free_labels = loaded.free_labels
+        reused = [free_labels.pop() for _ in range(min(len(free_labels), len(uuids)))]
+        if len(reused) > 0:
+            loaded.ids.add(uuids[: len(reused)], reused)
+            loaded.index.add_items(embeddings[: len(reused)], reused)
+            loaded.metadata["deleted"] -= len(reused)
+            uuids, embeddings = uuids[len(reused) :], embeddings[len(reused) :]
+
+        current_elements = loaded.metadata["elements"]
+        new_elements = len(uuids)
+        if new_elements == 0:
+            return
+
+        # grow geometrically, so that hnswlib reallocates its link lists only now and then
+        # rather than on every add
+        capacity = loaded.metadata.get("capacity", loaded.index.get_max_elements())
+        if current_elements + new_elements > capacity:
+            capacity = max(current_elements + new_elements, int(capacity * self._growth_factor))
+            loaded.index.resize_index(capacity)
+            loaded.metadata["capacity"] = capacity
+
+        # first map the uuids to ids, offset by the current number of elements
+        loaded.ids.add(uuids, np.arange(current_elements, current_elements + new_elements))
+
+        # add the new elements to the index
+        loaded.index.add_items(embeddings, range(current_elements, current_elements + new_elements))
+
+        # update the metadata
+        loaded.metadata["elements"] += new_elements
+
+    def delete(self, collection_uuid):
+        self._evicted.pop(str(collection_uuid), None)
+        self._pool.unpin(str(collection_uuid))
+        loaded = self._pool.pop(str(collection_uuid))
+        if loaded is not None:
+            self._retire(loaded)
+
+        # delete files, dont throw error if they dont exist
+        for kind, extension in [
+            ("id_to_uuid", "npy"),
+            ("uuid_to_id", "npy"),
+            ("id_to_uuid", "pkl"),
+            ("uuid_to_id", "pkl"),
+            ("index_metadata", "pkl"),
+            ("index", "bin"),
+            ("manifest", "json"),
+            ("publish", "lock"),
+            ("wal", "log"),
+        ]:
+            try:
+                os.remove(self._path(kind, collection_uuid, extension))
+            except FileNotFoundError:
+                pass
+        self._remove_snapshots(collection_uuid)
+        for backend in self._backends():
+            for path in backend.files(self._path("index", collection_uuid, "bin")):
+                os.remove(path)
+
+    def delete_from_index(self, collection_uuid, uuids, partitions: Optional[Sequence] = None):
+        """Delete elements from a collection's index. partitions are only used by partitioned
+        collections."""
+        with self._locked(collection_uuid) as loaded:
+            if loaded is None:
+                return
+            self._log(loaded, "delete", [u.bytes for u in uuids])
+            self._delete(loaded, uuids)
+            self._mark_dirty(collection_uuid, loaded, len(uuids))
+            dead_ratio = loaded.dead_ratio()
+
+        if dead_ratio >= self._compaction_threshold:
+            self._compact_in_background(collection_uuid)
+
+    def _delete(self, loaded: LoadedIndex, uuids):
+        labels = loaded.ids.remove(uuids)
+        for label in labels:
+            loaded.index.mark_deleted(int(label))
+        loaded.free_labels.extend(labels.tolist())
+        loaded.metadata["deleted"] += len(labels)
+
+    def _apply(self, loaded: LoadedIndex, operation, payload):
+        if operation == "add":
+            uuid_bytes, embeddings = payload
+            self._add(loaded, [uuid.UUID(bytes=b) for b in uuid_bytes], embeddings)
+        elif operation == "delete":
+            self._delete(loaded, [uuid.UUID(bytes=b) for b in payload])
+
+    def compact(self, collection_uuid):
+        """Rebuild the index without its deleted elements, as a graph if it is a flat index
+        that has outgrown the flat threshold, and retraining its quantizer if it is a quantized
+        index that has outgrown its training vectors. Otherwise shrink its capacity to the number
+        of elements it holds."""
+        with self._locked(collection_uuid) as loaded:
+            if loaded is None:
+                return
+            outgrown = self._outgrown(loaded)
+            backend = outgrown or loaded.metadata["backend"]
+            if loaded.metadata["deleted"] == 0 and not outgrown:
+                capacity = loaded.index.element_count
+                if capacity < loaded.index.get_max_elements():
+                    loaded.index.resize_index(capacity)
+                    loaded.metadata["capacity"] = capacity
+                    self._pool.resize(str(collection_uuid), loaded.nbytes())
+                    self._mark_dirty(collection_uuid, loaded, 0)
+                return
+        self._rebuild(collection_uuid, loaded, backend)
+
+    def _compact_in_background(self, collection_uuid):
+        key = str(collection_uuid)
+
+        def compact():
+            try:
+                self.compact(key)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self._compactions_lock:
+                    self._compactions.pop(key, None)
+
+        with self._compactions_lock:
+            if key in self._compactions or self._stopped:
+                return
+            self._compactions[key] = threading.Thread(target=compact, daemon=True)
+            self._compactions[key].start()
+
+    def _rebuild(self, collection_uuid, loaded: LoadedIndex, backend):
+        """Build a copy of the index holding only its live elements and swap it in.
+
+        Queries and mutations carry on against the current index while the copy is built.
+        Mutations made in the meantime are captured and replayed onto the copy, under the
+        lock, just before it replaces the current index in the pool.
+        """
+        key = str(collection_uuid)
+        with loaded.lock.write():
+            if loaded.retired or loaded.captured is not None:
+                return
+            labels = loaded.ids.live_labels()
+            uuids = loaded.ids.uuids_for(labels[None, :])[0] if len(labels) > 0 else []
+            rows, read = loaded.backend.rows(loaded.index, labels)
+            loaded.captured = []
+
+        s = time.time()
+        index = self._build(
+            key,
+            loaded.metadata,
+            backend,
+            loaded.metadata["dimensionality"],
+            rows,
+            read,
+            len(labels),
+        )
+        ids = IdMap()
+        ids.add(uuids, np.arange(len(labels)))
+
+        with loaded.lock.write():
+            captured, loaded.captured = loaded.captured, None
+            # the index was deleted, rebuilt or saved and dropped from memory in the meantime
+            if loaded.retired or (
+                self._pool.peek(key) is not loaded and self._evicted.get(key) is not loaded
+            ):
+                return
+            metadata = dict(
+                loaded.metadata,
+                elements=len(labels),
+                deleted=0,
+                capacity=len(labels),
+                backend=backend,
+            )
+            compacted = LoadedIndex(
+                index, self._backend(backend, metadata), metadata, ids, loaded.wal
+            )
+            for operation, payload in captured:
+                self._apply(compacted, operation, payload)
+
+            self._save(key, compacted)
+            if loaded.wal is not None:
+                loaded.wal.truncate()
+            loaded.retired = True
+            loaded.dirty_since = None
+            self._evicted.pop(key, None)
+            self._pool.put(key, compacted, compacted.nbytes())
+            loaded.backend.discard(loaded.index)
+        logger.info(
+            f"Compacted {loaded.metadata['backend']} index {key} of {loaded.metadata['elements']} "
+            f"elements to {backend} index of {metadata['elements']} elements "
+            f"in {time.time() - s:.2f}s"
+        )
+
+    def _log(self, loaded: LoadedIndex, operation, payload):
+        """Record a mutation before applying it: in the write-ahead log in write-behind mode,
+        and for the compacted copy of the index if one is being built"""
+        if loaded.captured is not None:
+            loaded.captured.append((operation, payload))
+        if not self._write_behind:
+            return
+        loaded.metadata["wal_sequence"] = loaded.metadata.get("wal_sequence", 0) + 1
+        loaded.wal.append(loaded.metadata["wal_sequence"], operation, payload)
+
+    def _mark_dirty(self, collection_uuid, loaded: LoadedIndex, elements):
+        if not self._write_behind:
+            self._save(collection_uuid, loaded)
+            return
+
+        if loaded.dirty_since is None:
+            loaded.dirty_since = time.time()
+        loaded.pending += elements
+        if loaded.pending >= self._flush_threshold:
+            self._flush_wakeup.set()
+
+    def _flush(self, collection_uuid, loaded: LoadedIndex):
+        with loaded.lock.write():
+            if loaded.dirty_since is None or loaded.retired:
+                return
+            self._save(collection_uuid, loaded)
+            loaded.wal.truncate()
+            loaded.dirty_since = None
+            loaded.pending = 0
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._flush_wakeup.wait(timeout=self._flush_interval)
+            self._flush_wakeup.clear()
+            self._flush_evicted()
+            now = time.time()
+            for key in self._pool.keys():
+                loaded = self._pool.peek(key)
+                if loaded is None or loaded.dirty_since is None:
+                    continue
+                if (
+                    now - loaded.dirty_since >= self._flush_interval
+                    or loaded.pending >= self._flush_threshold
+                ):
+                    try:
+                        self._flush(key, loaded)
+                    except Exception as e:
+                        logger.exception(e)
+
+    def _on_evict(self, collection_uuid, loaded: LoadedIndex):
+        # the eviction may happen while another index is locked for a mutation, so saving is
+        # left to the flusher rather than done here
+        if self._write_behind:
+            self._evicted[collection_uuid] = loaded
+            self._flush_wakeup.set()
+
+    def _flush_evicted(self):
+        for key in list(self._evicted.keys()):
+            loaded = self._evicted.get(key)
+            if loaded is None:
+                continue
+            try:
+                self._flush(key, loaded)
+            except Exception as e:
+                logger.exception(e)
+            if self._evicted.get(key) is loaded and loaded.dirty_since is None:
+                self._evicted.pop(key, None)
+
+    def persist(self):
+        """Save every index with mutations that have not been written to the index files yet"""
+        self._flush_evicted()
+        for key in self._pool.keys():
+            loaded = self._pool.peek(key)
+            if loaded is not None:
+                self._flush(key, loaded)
+
+    def stop(self):
+        """Stop the background flusher and save outstanding mutations, used at shutdown"""
+        self._stopped = True
+        with self._compactions_lock:
+            compactions = list(self._compactions.values())
+        for thread in compactions:
+            thread.join()
+        if self._flusher is None:
+            return
+        self._flush_wakeup.set()
+        self._flusher.join()
+        self._flusher = None
+        atexit.unregister(self.stop)
+        self.persist()
+
+    def _path(self, kind, collection_uuid, extension):
+        return f"{self._save_folder}/{kind}_{collection_uuid}.{extension}"
+
+    def _snapshot_path(self, collection_uuid, version):
+        return f"{self._save_folder}/snapshot_{collection_uuid}.{version}"
+
+    def _snapshot_version(self, collection_uuid) -> Optional[int]:
+        """The version of the snapshot published for a collection, None if it has none"""
+        try:
+            with open(self._path("manifest", collection_uuid, "json")) as f:
+                return json.load(f)["version"]
+        except FileNotFoundError:
+            return None
+
+    def _files(self, collection_uuid, version) -> Dict[str, str]:
+        """Paths of the files of a snapshot, or of the files indexes were saved as before there
+        were snapshots if version is None"""
+        if version is None:
+            return {
+                "index": self._path("index", collection_uuid, "bin"),
+                "id_to_uuid": self._path("id_to_uuid", collection_uuid, "npy"),
+                "uuid_to_id": self._path("uuid_to_id", collection_uuid, "npy"),
+                "index_metadata": self._path("index_metadata", collection_uuid, "pkl"),
+            }
+        return self._snapshot_files(self._snapshot_path(collection_uuid, version))
+
+    def _snapshot_files(self, snapshot) -> Dict[str, str]:
+        return {
+            "index": f"{snapshot}/index.bin",
+            "id_to_uuid": f"{snapshot}/id_to_uuid.npy",
+            "uuid_to_id": f"{snapshot}/uuid_to_id.npy",
+            "index_metadata": f"{snapshot}/index_metadata.pkl",
+        }
+
+    def _save(self, collection_uuid, loaded: LoadedIndex):
+        """Write the index as a new snapshot and publish it.
+
+        The files are written to a staging directory of their own, which is renamed into place
+        once complete, then the manifest is replaced to point at it. A save that fails part way
+        leaves the previous snapshot published, and a load reads one snapshot or the other,
+        never a mix of both. Publishing holds a lock file, so that processes saving the same
+        index take distinct versions and never remove a snapshot another one is publishing. The
+        last few snapshots are kept for processes that may still be loading them, older ones
+        are removed.
+        """
+        os.makedirs(self._save_folder, exist_ok=True)
+        staging = f"{self._snapshot_path(collection_uuid, 'tmp')}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(staging)
+        try:
+            files = self._snapshot_files(staging)
+            loaded.index.save_index(files["index"])
+            loaded.ids.save(files["id_to_uuid"], files["uuid_to_id"])
+            with open(files["index_metadata"], "wb") as f:
+                pickle.dump(loaded.metadata, f, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        with locked(self._path("publish", collection_uuid, "lock")):
+            # a snapshot left by a process that died before replacing the manifest is skipped
+            versions = [self._snapshot_version(collection_uuid) or 0] + self._versions(
+                collection_uuid
+            )
+            version = max(versions) + 1
+            snapshot = self._snapshot_path(collection_uuid, version)
+            os.rename(staging, snapshot)
+
+            manifest = self._path("manifest", collection_uuid, "json")
+            with open(f"{manifest}.tmp", "w") as f:
+                json.dump({"version": version}, f)
+            os.replace(f"{manifest}.tmp", manifest)
+            logger.debug(f"Index saved to {snapshot}")
+
+            self._remove_snapshots(collection_uuid, before=version - self._snapshots_kept + 1)
+        # the files of the format before snapshots, with mappings pickled before that, are
+        # superseded
+        for path in list(self._files(collection_uuid, None).values()) + [
+            self._path("id_to_uuid", collection_uuid, "pkl"),
+            self._path("uuid_to_id", collection_uuid, "pkl"),
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _versions(self, collection_uuid) -> List[int]:
+        """The versions of the snapshots of a collection on disk, published or not"""
+        prefix = self._snapshot_path(collection_uuid, "")
+        versions = [path[len(prefix) :] for path in glob.glob(f"{prefix}*")]
+        return [int(version) for version in versions if version.isdigit()]
+
+    def _remove_snapshots(self, collection_uuid, before=None):
+        """Remove the snapshots of a collection older than version before, or all of them and
+        any staging directory. Processes that have the files of a removed snapshot mapped keep
+        reading them."""
+        if before is None:
+            for path in glob.glob(f"{self._snapshot_path(collection_uuid, '*')}"):
+                shutil.rmtree(path, ignore_errors=True)
+            return
+        for version in self._versions(collection_uuid):
+            if version < before:
+                shutil.rmtree(self._snapshot_path(collection_uuid, version), ignore_errors=True)
+
+    def load_if_not_loaded(self, collection_uuid):
+        self._get(collection_uuid)
+
+    def _get(self, collection_uuid) -> Optional[LoadedIndex]:
+        """Return the resident index for a collection, loading it into the pool on a miss"""
+        loaded = self._pool.get(str(collection_uuid))
+        if loaded is not None:
+            return loaded
+        with self._load_lock(collection_uuid):
+            # loaded by another thread while this one waited
+            loaded = self._pool.peek(str(collection_uuid))
+            if loaded is not None:
+                return loaded
+            # an evicted index that has not been saved yet is newer than its files
+            loaded = self._evicted.get(str(collection_uuid))
+            if loaded is None:
+                loaded = self._load(collection_uuid)
+            if loaded is not None:
+                self._pool.put(str(collection_uuid), loaded, loaded.nbytes())
+        return loaded
+
+    def _load(self, collection_uuid) -> Optional[LoadedIndex]:
+        version = self._snapshot_version(collection_uuid)
+        snapshot = self._read_snapshot(collection_uuid, version)
+        # a process saving the index meanwhile may have removed the snapshot that was published
+        # when the manifest was read, the one it published in its place is loaded instead
+        while snapshot is None and self._snapshot_version(collection_uuid) != version:
+            version = self._snapshot_version(collection_uuid)
+            snapshot = self._read_snapshot(collection_uuid, version)
+        if snapshot is None:
+            return None
+
+        index, metadata, ids = snapshot
+        wal = WriteAheadLog(self._path("wal", collection_uuid, "log"))
+        loaded = LoadedIndex(
+            index, self._backend(metadata["backend"], metadata), metadata, ids, wal
+        )
+        self._recover(loaded)
+        return loaded
+
+    def _read_snapshot(self, collection_uuid, version):
+        files = self._files(collection_uuid, version)
+        try:
+            with open(files["index_metadata"], "rb") as f:
+                metadata = pickle.load(f)
+            if os.path.exists(files["id_to_uuid"]):
+                # the live elements are counted in the metadata, sparing a scan of the mapping
+                ids = IdMap.load(
+                    files["id_to_uuid"],
+                    files["uuid_to_id"],
+                    count=metadata["elements"] - metadata["deleted"]
+                    if "deleted" in metadata
+                    else None,
+                )
+            else:
+                # indexes saved before the array backed mapping pickled a dict of uuids
+                with open(self._path("id_to_uuid", collection_uuid, "pkl"), "rb") as f:
+                    ids = IdMap.from_dict(pickle.load(f))
+            # indexes saved before the parameters were configurable are all l2
+            for param, default in DEFAULT_INDEX_PARAMS.items():
+                metadata.setdefault(param, default)
+            metadata.setdefault("ef_calibration", None)
+            metadata.setdefault("deleted", metadata["elements"] - len(ids))
+            metadata.setdefault("backend", HNSW)
+            index = self._backend(metadata["backend"], metadata).make(
+                metadata, metadata["dimensionality"], self._path("index", collection_uuid, "bin")
+            )
+            index.load_index(
+                files["index"],
+                max_elements=metadata.get("capacity", metadata["elements"]),
+            )
+            index.set_ef(metadata["ef"])
+            index.set_num_threads(metadata["num_threads"])
+        except FileNotFoundError:
+            logger.debug("Index not found")
+            return None
+        except RuntimeError:
+            # hnswlib reports a missing file as a RuntimeError, any other is a corrupt index
+            if os.path.exists(files["index"]):
+                raise
+            logger.debug("Index not found")
+            return None
+        return index, metadata, ids
+
+    def _recover(self, loaded: LoadedIndex):
+        """Re-apply logged mutations that were acknowledged after the index files were saved"""
+        replayed = 0
+        for sequence, operation, payload in loaded.wal.replay():
+            if sequence <= loaded.metadata.get("wal_sequence", 0):
+                continue
+            self._apply(loaded, operation, payload)
+            replayed += len(payload[0]) if operation == "add" else len(payload)
+            loaded.metadata["wal_sequence"] = sequence
+
+        if replayed > 0:
+            logger.info(f"Recovered {replayed} index mutations from the write-ahead log")
+            loaded.dirty_since = time.time()
+            loaded.pending = replayed
+
+    def has_index(self, collection_uuid):
+        return os.path.isfile(self._path("manifest", collection_uuid, "json")) or os.path.isfile(
+            self._path("index", collection_uuid, "bin")
+        )
+
+    def get_nearest_neighbors(
+        self,
+        collection_uuid,
+        query,
+        k,
+        uuids=None,
+        search_ef=None,
+        recall_target=None,
+        num_threads=None,
+    ):
+        query = np.asarray(query, dtype=np.float32)
+        calibrated = False
+        while True:
+            with self._reading(collection_uuid) as loaded:
+                if loaded is None:
+                    raise NoIndexException(
+                        "Index not found, please create an instance before querying"
+                    )
+                ef = self._search_ef(loaded, k, search_ef, recall_target)
+                if ef is None and calibrated:
+                    ef = default_search_ef(k, len(loaded.ids), loaded.metadata["ef"])
+                if ef is not None:
+                    threads = self._query_threads(loaded, len(query), num_threads)
+                    return self._search(collection_uuid, loaded, query, k, uuids, ef, threads)
+            # calibrating writes to the index metadata, so it waits for the read lock to be released
+            self.calibrate(collection_uuid, DEFAULT_RECALL_TARGETS + [recall_target], merge=True)
+            calibrated = True
+
+    def _query_threads(self, loaded: LoadedIndex, queries, num_threads) -> int:
+        if num_threads is None:
+            num_threads = self._query_num_threads
+        if num_threads is None:
+            num_threads = loaded.metadata["num_threads"]
+        return query_threads(queries, num_threads, self._min_queries_per_thread)
+
+    @contextmanager
+    def _at_ef(self, loaded: LoadedIndex, ef):
+        """Hold the index at search ef until the block is done.
+
+        ef is set on the index rather than passed to each search, so searches at the ef the
+        index is set to run together, and a search at another ef waits for them to be done and
+        has the index to itself while it sets its ef and runs.
+        """
+        with loaded.ef_lock.read():
+            if loaded.index.ef == ef:
+                yield
+                return
+        with loaded.ef_lock.write():
+            if loaded.index.ef != ef:
+                loaded.index.set_ef(ef)
+            yield
+
+    def _search(self, collection_uuid, loaded: LoadedIndex, query, k, uuids, ef, threads):
+        logger.debug(f"searching {collection_uuid} with ef {ef} for {k} results")
+        if uuids is None or len(uuids) == 0:
+            s3 = time.time()
+            with self._at_ef(loaded, ef):
+                database_ids, distances = loaded.index.knn_query(query, k=k, num_threads=threads)
+            logger.debug(f"time to run knn query: {time.time() - s3}")
+            return loaded.ids.uuids_for(database_ids), distances
+
+        s2 = time.time()
+        # get the labels allowed by the filter
+        labels = loaded.ids.labels_for(uuids)
+        labels = labels[labels >= 0]
+        if len(labels) < k:
+            k = len(labels)
+
+        plan = loaded.backend.plan(
+            len(labels), len(loaded.ids), loaded.metadata["dimensionality"], ef
+        )
+        logger.debug(
+            f"query plan for {collection_uuid}: {plan}, "
+            f"{len(labels)} of {len(loaded.ids)} elements pass the filter"
+        )
+        logger.debug(f"time to pre process our knn query: {time.time() - s2}")
+
+        s3 = time.time()
+        if plan == EXACT:
+            database_ids, distances = self._exact_search(loaded, query, labels, k, threads)
+        elif plan == POSTFILTER:
+            with self._at_ef(loaded, ef):
+                database_ids, distances = self._postfiltered_search(
+                    loaded, query, labels, k, threads
+                )
+        else:
+            with self._at_ef(loaded, ef):
+                database_ids, distances = loaded.backend.filtered_search(
+                    loaded.index, query, labels, k, threads
+                )
+        logger.debug(f"time to run {plan} knn query: {time.time() - s3}")
+
+        return loaded.ids.uuids_for(database_ids), distances
+
+    def _search_ef(self, loaded: LoadedIndex, k, search_ef, recall_target) -> Optional[int]:
+        """The ef to search with, or None if the index must be calibrated for recall_target first"""
+        if search_ef is not None:
+            return max(search_ef, k)
+        if recall_target is None:
+            return default_search_ef(k, len(loaded.ids), loaded.metadata["ef"])
+
+        calibration = loaded.metadata["ef_calibration"]
+        # recall at a given ef drops as the index grows, so calibrate again once it has doubled
+        if calibration is not None and len(loaded.ids) <= 2 * calibration["elements"]:
+            return calibrated_ef(calibration, recall_target, k)
+        return None
+
+    def calibrate(
+        self,
+        collection_uuid,
+        recall_targets=DEFAULT_RECALL_TARGETS,
+        k=10,
+        sample_size=100,
+        merge=False,
+    ) -> Dict[float, int]:
+        """Find the smallest ef reaching each recall target and keep it in the index metadata.
+
+        Recall is measured against exact neighbors for a sample of the collection's own
+        vectors used as queries. Each target's ef is found by doubling until the target is
+        met, then bisecting.
+
+        With merge, only the targets missing from a calibration that still holds for the index
+        are measured and added to it, so queries asking for new targets do not measure every
+        target again. A calibration that no longer holds is replaced, keeping its targets.
+        """
+        with self._locked(collection_uuid) as loaded:
+            if loaded is None:
+                raise NoIndexException(
+                    "Index not found, please create an instance before calibrating"
+                )
+
+            labels = loaded.ids.live_labels()
+            if len(labels) == 0:
+                return {}
+            k = min(k, len(labels))
+            previous = loaded.metadata["ef_calibration"] if merge else None
+            if previous is not None and (
+                previous["k"] != k or len(loaded.ids) > 2 * previous["elements"]
+            ):
+                recall_targets = list(recall_targets) + list(previous["ef"])
+                previous = None
+            if previous is not None:
+                recall_targets = [t for t in recall_targets if t not in previous["ef"]]
+                # a concurrent query may have added them while this one waited for the lock
+                if len(recall_targets) == 0:
+                    return dict(previous["ef"])
+            rng = np.random.default_rng(0)
+            sample = rng.choice(labels, size=min(sample_size, len(labels)), replace=False)
+            queries = np.asarray(loaded.index.get_items(sample), dtype=np.float32)
+            truth = self._exact_neighbors(loaded, queries, labels, k)
+
+            recalls: Dict[int, float] = {}
+
+            def recall_at(ef):
+                if ef not in recalls:
+                    with self._at_ef(loaded, ef):
+                        found, _ = loaded.index.knn_query(queries, k=k)
+                    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+                    recalls[ef] = hits / truth.size
+                return recalls[ef]
+
+            ef_for = {}
+            for target in sorted(set(recall_targets)):
+                low, high = k, k
+                while recall_at(high) < target and high < len(labels):
+                    low, high = high, min(2 * high, len(labels))
+                while low < high:
+                    middle = (low + high) // 2
+                    if recall_at(middle) >= target:
+                        high = middle
+                    else:
+                        low = middle + 1
+                ef_for[target] = high
+            logger.info(
+                f"calibrated {collection_uuid}: "
+                + ", ".join(
+                    f"recall {recalls[ef]:.3f} at ef {ef}" for ef in sorted(set(ef_for.values()))
+                )
+            )
+
+            if previous is not None:
+                ef_for = {**previous["ef"], **ef_for}
+            elements = previous["elements"] if previous is not None else len(labels)
+            loaded.metadata["ef_calibration"] = {"k": k, "elements": elements, "ef": ef_for}
+            self._mark_dirty(collection_uuid, loaded, 0)
+        return ef_for
+
+    def _exact_neighbors(self, loaded: LoadedIndex, queries, labels, k, chunk_size=10000):
+        """Labels of the exact k nearest neighbors of each query, scanning the index in chunks"""
+        best_labels = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(labels), chunk_size):
+            chunk = labels[start : start + chunk_size]
+            found, distances = self._exact_search(loaded, queries, chunk, min(k, len(chunk)))
+            candidates = np.concatenate([best_labels, found], axis=1)
+            distances = np.concatenate([best_distances, distances], axis=1)
+            positions, best_distances = top_k(distances, np.arange(candidates.shape[1]), k)
+            best_labels = np.take_along_axis(candidates, positions, axis=1)
+        return best_labels
+
+    def _exact_search(self, loaded: LoadedIndex, query, labels, k, threads=1):
+        vectors = np.asarray(loaded.index.get_items(labels), dtype=np.float32)
+        return search_in_threads(
+            lambda block: brute_force_knn(block, vectors, labels, k, loaded.metadata["space"]),
+            query,
+            threads,
+        )
+
+    def _postfiltered_search(self, loaded: LoadedIndex, query, labels, k, threads=1):
+        oversampled = oversampled_k(k, len(labels), len(loaded.ids))
+        candidates, candidate_distances = loaded.index.knn_query(
+            query, k=oversampled, num_threads=threads
+        )
+
+        allowed = np.isin(candidates, labels)
+        # stable sort moves the allowed candidates to the front, keeping them in distance order
+        order = np.argsort(~allowed, axis=1, kind="stable")[:, :k]
+        database_ids = np.take_along_axis(candidates, order, axis=1)
+        distances = np.take_along_axis(candidate_distances, order, axis=1)
+
+        # queries that did not find k allowed results fall back to the filtered search
+        short = np.flatnonzero(allowed.sum(axis=1) < k)
+        if len(short) > 0:
+            logger.debug(f"post-filtering found too few results for {len(short)} queries")
+            database_ids[short], distances[short] = loaded.backend.filtered_search(
+                loaded.index, query[short], labels, k, threads
+            )
+        return database_ids, distances
+
+    def reset(self):
+        self._evicted.clear()
+        for key in self._pool.keys():
+            loaded = self._pool.pop(key)
+            if loaded is not None:
+                self._retire(loaded)
+        self._pool.clear()
+
+        # the files and snapshot directories of every index
+        shutil.rmtree(f"{self._save_folder}", ignore_errors=True)
+        # recreate the directory
+        if not os.path.exists(f"{self._save_folder}"):
+            os.makedirs(f"{self._save_folder}")
+
+    def delete_index(self, uuid):
+        uuid = str(uuid)
+        self._drop(uuid)
+
+        if os.path.exists(f"{self._save_folder}"):
+            for f in os.listdir(f"{self._save_folder}"):
+                if uuid in f:
+                    path = os.path.join(f"{self._save_folder}", f)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+
+    def _drop(self, collection_uuid):
+        """Drop a collection's index from memory, without saving it"""
+        key = str(collection_uuid)
+        self._evicted.pop(key, None)
+        self._pool.unpin(key)
+        loaded = self._pool.pop(key)
+        if loaded is not None:
+            self._retire(loaded)
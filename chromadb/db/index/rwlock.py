@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+import threading
+
+
+class ReadWriteLock:
+    """A lock held either by any number of readers or by a single writer.
+
+    Writers take precedence: once a writer is waiting, new readers wait behind it, so a steady
+    stream of queries cannot starve mutations. Neither side is reentrant, a thread holding the
+    lock must not take it again.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writing or self._waiting_writers > 0:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers > 0:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
@@ -0,0 +1,205 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from typing import Any, Callable, List, Optional
+import hnswlib
+import numpy as np
+from chromadb.db.index.arrayfile import load_arrays, save_arrays
+from chromadb.db.index.distances import top_k
+from chromadb.db.index.flat import Filter, _resized
+from chromadb.db.index.filters import label_filter
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _shard_executor() -> ThreadPoolExecutor:
+    """Threads shared by every sharded index, created on first use, so that a single query
+    fans out to its shards without starting threads of its own"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1, thread_name_prefix="index-shard"
+            )
+        return _executor
+
+
+class ShardedIndex:
+    """An hnsw index split into several independent graphs, built and searched in parallel.
+
+    Label l lives in shard l % shards, as label l // shards of that shard's graph. Labels are
+    handed out in insertion order and reused once deleted, so the shards stay balanced as a
+    hash of the uuids would keep them. A query searches every shard at once, hnswlib releasing
+    the GIL while it does, and the k nearest of each shard are merged with a partial sort. Each
+    graph is a fraction of the size of a single one, so it is built and searched in less time
+    per thread, and a single query uses as many cores as there are shards.
+
+    It mirrors the parts of hnswlib.Index that the index uses. Which labels are present and
+    deleted is tracked here, hnswlib does not expose it, so that each shard is asked for no
+    more results than it can return.
+    """
+
+    def __init__(self, space: str, dim: int, shards: int):
+        self.space = space
+        self.dim = dim
+        self.shards = shards
+        self.M = 0
+        self.ef = 10
+        self.num_threads = 1
+        self._indexes: List[hnswlib.Index] = []
+        self._present = np.zeros(0, dtype=bool)
+        self._deleted = np.zeros(0, dtype=bool)
+        # elements each shard can return, kept up to date so that an unfiltered query does not
+        # count them
+        self._live = np.zeros(shards, dtype=np.int64)
+
+    def _shard_size(self, max_elements: int) -> int:
+        return max(-(-max_elements // self.shards), 1)
+
+    def init_index(self, max_elements: int, ef_construction: int = 200, M: int = 16, **kwargs):
+        self.M = M
+        self._indexes = []
+        for _ in range(self.shards):
+            index = hnswlib.Index(space=self.space, dim=self.dim)
+            index.init_index(
+                max_elements=self._shard_size(max_elements), ef_construction=ef_construction, M=M
+            )
+            self._indexes.append(index)
+        self._present = np.zeros(max_elements, dtype=bool)
+        self._deleted = np.zeros(max_elements, dtype=bool)
+        self._live = np.zeros(self.shards, dtype=np.int64)
+
+    @property
+    def element_count(self) -> int:
+        return sum(index.element_count for index in self._indexes)
+
+    def set_ef(self, ef: int):
+        self.ef = ef
+        for index in self._indexes:
+            index.set_ef(ef)
+
+    def set_num_threads(self, num_threads: int):
+        self.num_threads = num_threads
+
+    def _threads_per_shard(self, num_threads: int) -> int:
+        return max((self.num_threads if num_threads < 0 else num_threads) // self.shards, 1)
+
+    def get_max_elements(self) -> int:
+        return len(self._present)
+
+    def resize_index(self, new_size: int):
+        for index in self._indexes:
+            index.resize_index(self._shard_size(new_size))
+        used = len(self._present)
+        self._present = _resized(self._present, new_size, min(used, new_size))
+        self._deleted = _resized(self._deleted, new_size, min(used, new_size))
+
+    def _map(self, function: Callable[[int], Any], shards) -> List[Any]:
+        shards = list(shards)
+        if len(shards) <= 1 or (os.cpu_count() or 1) == 1:
+            return [function(s) for s in shards]
+        return list(_shard_executor().map(function, shards))
+
+    def add_items(self, data, ids=None, num_threads: int = -1, replace_deleted: bool = False):
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        labels = np.arange(len(data)) if ids is None else np.asarray(ids, dtype=np.int64)
+        if len(labels) == 0:
+            return
+        if labels.max() >= self.get_max_elements():
+            raise RuntimeError("The number of elements exceeds the specified limit")
+        shard_of = labels % self.shards
+        threads = self._threads_per_shard(num_threads)
+
+        def add(s):
+            rows = np.flatnonzero(shard_of == s)
+            self._indexes[s].add_items(data[rows], labels[rows] // self.shards, num_threads=threads)
+
+        self._map(add, np.unique(shard_of))
+        added = np.unique(labels)
+        added = added[~self._present[added] | self._deleted[added]]
+        self._live += np.bincount(added % self.shards, minlength=self.shards)
+        self._present[labels] = True
+        self._deleted[labels] = False
+
+    def mark_deleted(self, label: int):
+        self._indexes[label % self.shards].mark_deleted(label // self.shards)
+        self._deleted[label] = True
+        self._live[label % self.shards] -= 1
+
+    def get_items(self, ids, return_type: str = "numpy"):
+        labels = np.asarray(ids, dtype=np.int64)
+        vectors = np.zeros((len(labels), self.dim), dtype=np.float32)
+        shard_of = labels % self.shards
+        for s in np.unique(shard_of):
+            rows = np.flatnonzero(shard_of == s)
+            vectors[rows] = self._indexes[s].get_items(
+                labels[rows] // self.shards, return_type="numpy"
+            )
+        return vectors if return_type == "numpy" else vectors.tolist()
+
+    def knn_query(self, data, k: int = 1, num_threads: int = -1, filter: Optional[Filter] = None):
+        queries = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        available = self._live
+        if filter is not None:
+            capacity = self.get_max_elements()
+            allowed = self._present & ~self._deleted
+            if isinstance(filter, np.ndarray):
+                allowed &= filter[:capacity]
+            else:
+                allowed &= np.fromiter(map(filter, range(capacity)), dtype=bool, count=capacity)
+            # the local labels each shard may return
+            shard_labels = [np.flatnonzero(allowed[s :: self.shards]) for s in range(self.shards)]
+            available = np.array([len(labels) for labels in shard_labels])
+        if available.sum() < k:
+            raise RuntimeError(
+                "Cannot return the results in a contigious 2D array. Probably ef or M is too small"
+            )
+        threads = self._threads_per_shard(num_threads)
+
+        def search(s):
+            index = self._indexes[s]
+            k_shard = min(k, int(available[s]))
+            if filter is None:
+                found, distances = index.knn_query(queries, k=k_shard, num_threads=threads)
+            else:
+                found, distances = index.knn_query(
+                    queries,
+                    k=k_shard,
+                    num_threads=threads,
+                    filter=label_filter(shard_labels[s], index.get_max_elements()),
+                )
+            return found.astype(np.int64) * self.shards + s, distances
+
+        results = self._map(search, np.flatnonzero(available > 0))
+        candidates = np.concatenate([r[0] for r in results], axis=1)
+        distances = np.concatenate([r[1] for r in results], axis=1)
+        positions, distances = top_k(distances, np.arange(candidates.shape[1]), k)
+        return np.take_along_axis(candidates, positions, axis=1).astype(np.uint64), distances
+
+    def save_index(self, path: str):
+        for s, index in enumerate(self._indexes):
+            index.save_index(f"{path}.{s}")
+        save_arrays(
+            path,
+            {"present": self._present, "deleted": self._deleted},
+            {"shards": self.shards, "M": self.M},
+        )
+
+    def load_index(self, path: str, max_elements: int = 0, **kwargs):
+        arrays, metadata = load_arrays(path)
+        self.shards = metadata["shards"]
+        self.M = metadata["M"]
+        # copied out of the mapping, the flags are written on every add and delete
+        self._present = np.array(arrays["present"])
+        self._deleted = np.array(arrays["deleted"])
+        live = np.flatnonzero(self._present & ~self._deleted)
+        self._live = np.bincount(live % self.shards, minlength=self.shards)
+        max_elements = max(max_elements, len(self._present))
+        self._indexes = []
+        for s in range(self.shards):
+            index = hnswlib.Index(space=self.space, dim=self.dim)
+            index.load_index(f"{path}.{s}", max_elements=self._shard_size(max_elements))
+            self._indexes.append(index)
+        if max_elements > len(self._present):
+            self.resize_index(max_elements)
@@ -0,0 +1,51 @@
+import os
+import pickle
+from typing import Any, Iterator, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WriteAheadLog:
+    """An append-only log of index mutations, used to recover writes that were acknowledged
+    but not yet written to the index files.
+
+    Each record is a pickled (sequence, operation, payload) tuple. Records are fsynced before
+    append() returns. A torn record at the end of the file, left behind by a crash in the
+    middle of an append, is ignored on replay.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+
+    def append(self, sequence: int, operation: str, payload: Any):
+        if self._file is None:
+            self._file = open(self._path, "ab")
+        pickle.dump((sequence, operation, payload), self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def replay(self) -> Iterator[Tuple[int, str, Any]]:
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+                except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                    logger.warning(f"Ignoring torn record at the end of {self._path}")
+                    return
+
+    def truncate(self):
+        """Drop all records, once everything they describe has been saved to the index files"""
+        self.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
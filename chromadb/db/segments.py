@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from chromadb.db.clickhouse import db_schema_to_keys
+
+logger = logging.getLogger(__name__)
+
+
+def latest_rows(folder: str, segments: List[str], tombstones: List[str]) -> str:
+    """A query of the latest version of each row of the segments of a folder, oldest first,
+    without the rows deleted by the tombstones"""
+    columns = ", ".join(db_schema_to_keys())
+    if len(segments) == 1:
+        rows = f"SELECT {columns} FROM read_parquet('{folder}/{segments[0]}')"
+    else:
+        versions = " UNION ALL ".join(
+            f"SELECT {columns}, {position} AS segment FROM read_parquet('{folder}/{segment}')"
+            for position, segment in enumerate(segments)
+        )
+        rows = f"""
+            SELECT {columns} FROM (
+                SELECT *, row_number() OVER (PARTITION BY uuid ORDER BY segment DESC) AS version
+                FROM ({versions})
+            ) WHERE version = 1"""
+    if len(tombstones) == 0:
+        return rows
+    deleted = " UNION ALL ".join(
+        f"SELECT uuid FROM read_parquet('{folder}/{t}')" for t in tombstones
+    )
+    return f"SELECT * FROM ({rows}) WHERE uuid NOT IN ({deleted})"
+
+
+def _copied(manifest: Dict) -> Dict:
+    return json.loads(json.dumps(manifest))
+
+
+class Segments:
+    """The parquet segments the rows of a collection are persisted in, in a folder of their own.
+
+    Each persist appends a segment holding only the rows added or changed since the last one,
+    and a tombstone file of the uuids deleted since, so that its cost follows the changes rather
+    than the size of the collection. A manifest lists the live segments, oldest first, and is
+    replaced atomically once the files it names are written. The rows are the latest version
+    of each row of the segments, less the ones with a tombstone.
+
+    Segments are merged the newest first, and as far back as the merged segment stays larger
+    than the next older one, so that a large old segment is rewritten only once the rows after
+    it have caught up.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        # held while the manifest is read and replaced, by persists, merges and loads
+        self.lock = threading.Lock()
+        try:
+            with open(self._file("manifest.json")) as f:
+                self.manifest: Optional[Dict] = json.load(f)
+        except FileNotFoundError:
+            self.manifest = None
+
+    def _file(self, name: str) -> str:
+        return f"{self.folder}/{name}"
+
+    def _publish(self, manifest: Dict):
+        path = self._file("manifest.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+        self.manifest = manifest
+
+    def _next_file(self, manifest: Dict, kind: str) -> str:
+        manifest["sequence"] += 1
+        return f"{kind}-{manifest['sequence']:06d}.parquet"
+
+    def _copy(self, connection, query: str, name: str) -> int:
+        """Write the rows of query to a parquet file of the folder, returning their number"""
+        path = self._file(name)
+        connection.execute(f"COPY ({query}) TO '{path}.tmp' (FORMAT PARQUET)")
+        os.replace(f"{path}.tmp", path)
+        return connection.execute(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchall()[0][0]
+
+    def rows(self) -> Optional[str]:
+        """A query of the saved rows, None if there are none; the lock must be held while it runs,
+        a merge removes the files it reads"""
+        if self.manifest is None or len(self.manifest["segments"]) == 0:
+            return None
+        return latest_rows(
+            self.folder,
+            [segment["file"] for segment in self.manifest["segments"]],
+            self.manifest["tombstones"],
+        )
+
+    def segments(self) -> int:
+        return 0 if self.manifest is None else len(self.manifest["segments"])
+
+    def append(
+        self, connection, changed: str, deleted: Optional[str] = None, replace: bool = False
+    ):
+        """Save the rows of changed as a new segment, and the uuids of deleted as a tombstone
+        file; replace saves changed as the only segment, in place of every other"""
+        with self.lock:
+            os.makedirs(self.folder, exist_ok=True)
+            previous = self.manifest
+            if previous is None or replace:
+                sequence = 0 if previous is None else previous["sequence"]
+                manifest = {"sequence": sequence, "segments": [], "tombstones": []}
+            else:
+                manifest = _copied(previous)
+
+            if connection.execute(f"SELECT COUNT(*) FROM ({changed})").fetchall()[0][0] > 0:
+                segment = self._next_file(manifest, "embeddings")
+                manifest["segments"].append(
+                    {"file": segment, "rows": self._copy(connection, changed, segment)}
+                )
+            if (
+                deleted is not None
+                and len(manifest["segments"]) > 0
+                and connection.execute(f"SELECT COUNT(*) FROM ({deleted})").fetchall()[0][0] > 0
+            ):
+                tombstone = self._next_file(manifest, "tombstones")
+                self._copy(connection, deleted, tombstone)
+                manifest["tombstones"].append(tombstone)
+
+            if manifest != previous:
+                self._publish(manifest)
+            if replace and previous is not None:
+                for name in [s["file"] for s in previous["segments"]] + previous["tombstones"]:
+                    os.remove(self._file(name))
+
+    def _merge_start(self, segments: List[Dict]) -> int:
+        """The position of the oldest segment to merge with every segment after it"""
+        start = len(segments) - 1
+        rows = segments[start]["rows"]
+        while start > 0 and (segments[start - 1]["rows"] <= rows or len(segments) - start < 2):
+            start -= 1
+            rows += segments[start]["rows"]
+        return start
+
+    def merge(self, connection):
+        """Merge the newest segments into one. Tombstones are applied to the merged rows, and
+        dropped once every segment has been merged, otherwise combined into one."""
+        with self.lock:
+            manifest = self.manifest
+            if manifest is None or len(manifest["segments"]) <= 1:
+                return
+            merging = manifest["segments"][self._merge_start(manifest["segments"]) :]
+            tombstones = list(manifest["tombstones"])
+            everything = merging[0] is manifest["segments"][0]
+            # the names are taken now, so that a persist meanwhile does not take them too
+            reserved = _copied(manifest)
+            merged = self._next_file(reserved, "embeddings")
+            combined = self._next_file(reserved, "tombstones")
+            manifest["sequence"] = reserved["sequence"]
+
+        s = time.time()
+        rows = self._copy(
+            connection,
+            latest_rows(self.folder, [segment["file"] for segment in merging], tombstones),
+            merged,
+        )
+        if not everything and len(tombstones) > 1:
+            deleted = " UNION ".join(
+                f"SELECT uuid FROM read_parquet('{self._file(t)}')" for t in tombstones
+            )
+            self._copy(connection, deleted, combined)
+
+        with self.lock:
+            manifest = _copied(self.manifest)
+            files = [segment["file"] for segment in manifest["segments"]]
+            start = files.index(merging[0]["file"])
+            # segments persisted meanwhile come after the merged ones
+            manifest["segments"][start : start + len(merging)] = [{"file": merged, "rows": rows}]
+            # as do tombstones, which may delete rows of the merged segment
+            added = [t for t in manifest["tombstones"] if t not in tombstones]
+            if everything:
+                manifest["tombstones"] = added
+            elif len(tombstones) > 1:
+                manifest["tombstones"] = [combined] + added
+            self._publish(manifest)
+            removed = [segment["file"] for segment in merging]
+            if everything or len(tombstones) > 1:
+                removed += tombstones
+            for name in removed:
+                os.remove(self._file(name))
+        logger.info(
+            f"Merged {len(merging)} segments of {self.folder} into one of {rows} rows "
+            f"in {time.time() - s:.2f}s"
+        )
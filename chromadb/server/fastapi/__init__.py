@@ -15,6 +15,7 @@ from chromadb.errors import (
 )
 from chromadb.server.fastapi.types import (
     AddEmbedding,
+    CalibrateIndex,
     CountEmbedding,
     DeleteEmbedding,
     GetEmbedding,
@@ -25,9 +26,11 @@ from chromadb.server.fastapi.types import (
     CreateCollection,
     UpdateCollection,
     UpdateEmbedding,
+    WarmUp,
 )
 from starlette.requests import Request
 from starlette.responses import Response
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
@@ -71,6 +74,9 @@ class FastAPI(chromadb.server.Server):
         self.router.add_api_route("/api/v1/reset", self.reset, methods=["POST"])
         self.router.add_api_route("/api/v1/persist", self.persist, methods=["POST"])
         self.router.add_api_route("/api/v1/raw_sql", self.raw_sql, methods=["POST"])
+        self.router.add_api_route("/api/v1/ready", self.ready, methods=["GET"])
+        self.router.add_api_route("/api/v1/warm_up", self.warm_up, methods=["POST"])
+        self.router.add_api_route("/api/v1/index_status", self.index_status, methods=["GET"])
 
         self.router.add_api_route("/api/v1/collections", self.list_collections, methods=["GET"])
         self.router.add_api_route("/api/v1/collections", self.create_collection, methods=["POST"])
@@ -103,6 +109,11 @@ class FastAPI(chromadb.server.Server):
             self.create_index,
             methods=["POST"],
         )
+        self.router.add_api_route(
+            "/api/v1/collections/{collection_name}/calibrate_index",
+            self.calibrate_index,
+            methods=["POST"],
+        )
         self.router.add_api_route(
             "/api/v1/collections/{collection_name}", self.get_collection, methods=["GET"]
         )
@@ -117,12 +128,44 @@ class FastAPI(chromadb.server.Server):
 
         use_route_names_as_operation_ids(self._app)
 
+        # the server reports ready once the indexes it was asked to preload are warm, which it
+        # does in the background so that it can answer health checks meanwhile
+        self._ready = threading.Event()
+        if settings.chroma_index_preload:
+            threading.Thread(
+                target=self._preload,
+                args=(settings.chroma_index_preload, settings.chroma_index_warmup_queries),
+                daemon=True,
+            ).start()
+        else:
+            self._ready.set()
+
+    def _preload(self, collection_names, queries):
+        try:
+            warmed = self._api.warm_up(collection_names, queries)
+            logger.info(f"Preloaded the indexes of {sum(warmed.values())} collections")
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._ready.set()
+
     def app(self):
         return self._app
 
     def root(self):
         return {"nanosecond heartbeat": self._api.heartbeat()}
 
+    def ready(self):
+        content = {"ready": self._ready.is_set(), "collections": self._api.index_status()}
+        status_code = 200 if content["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE
+        return JSONResponse(content=content, status_code=status_code)
+
+    def warm_up(self, warm_up: WarmUp):
+        return self._api.warm_up(warm_up.collection_names, warm_up.queries)
+
+    def index_status(self):
+        return self._api.index_status()
+
     def persist(self):
         self._api.persist()
 
@@ -207,6 +250,9 @@ class FastAPI(chromadb.server.Server):
                 query_embeddings=query.query_embeddings,
                 n_results=query.n_results,
                 include=query.include,
+                search_ef=query.search_ef,
+                recall_target=query.recall_target,
+                num_threads=query.num_threads,
             )
             return nnresult
         except NoDatapointsException as e:
@@ -221,3 +267,6 @@ class FastAPI(chromadb.server.Server):
 
     def create_index(self, collection_name: str):
         return self._api.create_index(collection_name)
+
+    def calibrate_index(self, collection_name: str, calibrate: CalibrateIndex):
+        return self._api.calibrate_index(collection_name, calibrate.recall_targets)
@@ -25,6 +25,9 @@ class QueryEmbedding(BaseModel):
     query_embeddings: List
     n_results: int = 10
     include: Include = ["metadatas", "documents", "distances"]
+    search_ef: int = None
+    recall_target: float = None
+    num_threads: int = None
 
 
 class ProcessEmbedding(BaseModel):
@@ -55,6 +58,15 @@ class SpaceKeyInput(BaseModel):
     collection_name: str
 
 
+class CalibrateIndex(BaseModel):
+    recall_targets: List[float] = None
+
+
+class WarmUp(BaseModel):
+    collection_names: List[str] = None
+    queries: int = 10
+
+
 class DeleteEmbedding(BaseModel):
     ids: List = None
     where: dict = None
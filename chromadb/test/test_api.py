@@ -5,10 +5,15 @@ from chromadb.config import Settings
 from chromadb.errors import NoDatapointsException
 import chromadb.server.fastapi
 import pytest
+import threading
 import time
 import tempfile
 import copy
 import os
+import shutil
+import json
+import duckdb
+import numpy as np
 from multiprocessing import Process
 import uvicorn
 from requests.exceptions import ConnectionError
@@ -1224,3 +1229,422 @@ def test_invalid_id(api_fixture, request):
     with pytest.raises(ValueError) as e:
         collection.delete(ids=["valid", 0])
     assert "ID" in str(e.value)
+
+
+# test that the index configuration in the collection metadata is used for the index
+@pytest.mark.parametrize("api_fixture", test_apis)
+def test_index_params(api_fixture, request):
+    api = request.getfixturevalue(api_fixture.__name__)
+
+    api.reset()
+    collection = api.create_collection(
+        "test_index_params", metadata={"hnsw:space": "cosine", "hnsw:M": 8}
+    )
+    collection.add(embeddings=[[1, 0, 0], [0, 1, 0]], ids=["a", "b"])
+
+    items = collection.query(query_embeddings=[10, 0, 0], n_results=2)
+    assert items["ids"][0] == ["a", "b"]
+    assert items["distances"][0][0] == pytest.approx(0, abs=1e-6)
+    assert items["distances"][0][1] == pytest.approx(1, abs=1e-6)
+
+    with pytest.raises(Exception):
+        api.create_collection("test_index_params_bad", metadata={"hnsw:space": "hamming"})
+
+
+# test that the index configuration cannot change under an index already built
+@pytest.mark.parametrize("api_fixture", test_apis)
+def test_modify_index_params(api_fixture, request):
+    api = request.getfixturevalue(api_fixture.__name__)
+
+    api.reset()
+    collection = api.create_collection(
+        "test_modify_index_params", metadata={"hnsw:space": "cosine"}
+    )
+    # no index yet, the configuration is free to change
+    collection.modify(metadata={"hnsw:space": "l2"})
+    collection.add(embeddings=[[1, 0, 0], [0, 1, 0]], ids=["a", "b"])
+
+    for metadata in [{"hnsw:space": "cosine"}, {"hnsw:M": 8}, {"index:partition_key": "tenant"}]:
+        with pytest.raises(Exception):
+            collection.modify(metadata=metadata)
+    assert api.get_collection("test_modify_index_params").metadata == {"hnsw:space": "l2"}
+
+    # the search parameters can change
+    collection.modify(metadata={"hnsw:space": "l2", "hnsw:search_ef": 50, "other": 1})
+    items = collection.query(query_embeddings=[1, 0, 0], n_results=1)
+    assert items["ids"][0] == ["a"]
+
+
+# test that queries can trade recall for speed through search_ef or a recall target
+@pytest.mark.parametrize("api_fixture", test_apis)
+def test_query_search_ef_and_recall_target(api_fixture, request):
+    api = request.getfixturevalue(api_fixture.__name__)
+
+    api.reset()
+    collection = api.create_collection("test_query_search_ef")
+    embeddings = np.random.default_rng(0).random((200, 4)).tolist()
+    ids = [f"id{i}" for i in range(200)]
+    collection.add(embeddings=embeddings, ids=ids)
+
+    items = collection.query(query_embeddings=embeddings[5], n_results=3, search_ef=50)
+    assert items["ids"][0][0] == "id5"
+
+    calibration = collection.calibrate_index([0.9, 0.99])
+    assert calibration[0.9] <= calibration[0.99]
+
+    items = collection.query(query_embeddings=embeddings[7], n_results=3, recall_target=0.95)
+    assert items["ids"][0][0] == "id7"
+
+    with pytest.raises(ValueError):
+        collection.query(query_embeddings=embeddings[0], search_ef=50, recall_target=0.9)
+    with pytest.raises(ValueError):
+        collection.query(query_embeddings=embeddings[0], recall_target=1.5)
+
+    items = collection.query(query_embeddings=embeddings[:3], n_results=1, num_threads=2)
+    assert items["ids"] == [["id0"], ["id1"], ["id2"]]
+    with pytest.raises(ValueError):
+        collection.query(query_embeddings=embeddings[0], num_threads=0)
+
+
+# test that create_index reads the collection in chunks
+def test_create_index_streams_chunks():
+    api = chromadb.Client(
+        Settings(
+            chroma_api_impl="local",
+            chroma_db_impl="duckdb",
+            persist_directory=tempfile.mkdtemp(),
+            chroma_index_build_chunk_size=7,
+        )
+    )
+    collection = api.create_collection("test_create_index_streams_chunks")
+    embeddings = np.random.default_rng(1).random((50, 3)).tolist()
+    ids = [f"id{i}" for i in range(50)]
+    collection.add(embeddings=embeddings, ids=ids, increment_index=False)
+
+    collection.create_index()
+    for i in [0, 13, 49]:
+        items = collection.query(query_embeddings=embeddings[i], n_results=1)
+        assert items["ids"][0] == [ids[i]]
+
+
+# test that warming up collections loads and pins their indexes
+@pytest.mark.parametrize("api_fixture", test_apis)
+def test_warm_up_and_index_status(api_fixture, request):
+    api = request.getfixturevalue(api_fixture.__name__)
+
+    api.reset()
+    collection = api.create_collection("test_warm_up")
+    collection.add(embeddings=[[1.1, 2.3, 3.2], [4.5, 6.9, 4.4]], ids=["a", "b"])
+    api.create_collection("test_warm_up_empty")
+
+    assert api.warm_up(["test_warm_up"], queries=2) == {"test_warm_up": True}
+    status = api.index_status()
+    assert status["test_warm_up"] == {"loaded": True, "pinned": True}
+    assert status["test_warm_up_empty"] == {"loaded": False, "pinned": False}
+
+    assert api.warm_up() == {"test_warm_up": True, "test_warm_up_empty": False}
+    items = collection.query(query_embeddings=[1.1, 2.3, 3.2], n_results=1)
+    assert items["ids"][0] == ["a"]
+
+
+# test that queries for one value of a partition key are answered from that value's sub-index
+def test_partitioned_index():
+    api = chromadb.Client(
+        Settings(
+            chroma_api_impl="local",
+            chroma_db_impl="duckdb",
+            persist_directory=tempfile.mkdtemp(),
+            chroma_index_partition_min_size=20,
+        )
+    )
+    collection = api.create_collection(
+        "test_partitioned", metadata={"index:partition_key": "tenant"}
+    )
+    rng = np.random.default_rng(2)
+    embeddings = rng.random((60, 3))
+    tenants = ["a"] * 15 + ["b"] * 10 + ["a"] * 15 + ["c"] * 5 + [None] * 15
+    ids = [f"id{i}" for i in range(60)]
+    metadatas = [{"tenant": t} if t is not None else {"other": 1} for t in tenants]
+    collection.add(embeddings=embeddings[:25].tolist(), ids=ids[:25], metadatas=metadatas[:25])
+    collection.add(embeddings=embeddings[25:].tolist(), ids=ids[25:], metadatas=metadatas[25:])
+
+    idx = api._db._idx
+    collection_uuid = api._db.get_collection_uuid_from_name("test_partitioned")
+    # a outgrew the shared sub-index and was moved to one of its own
+    assert idx.partition_route(collection_uuid, {"tenant": "a"})[1] is False
+    assert idx.partition_route(collection_uuid, {"tenant": "b"})[1] is True
+    assert idx.partition_route(collection_uuid, {"tenant": "a", "other": 1}) is None
+
+    query = rng.random(3)
+
+    def nearest(tenant, n):
+        rows = [
+            i for i, t in enumerate(tenants) if t == tenant or (tenant is None and t != "deleted")
+        ]
+        order = np.argsort(np.linalg.norm(embeddings[rows] - query, axis=1))[:n]
+        return [ids[rows[i]] for i in order]
+
+    for where in [{"tenant": "a"}, {"tenant": {"$eq": "a"}}]:
+        assert collection.query(query_embeddings=query.tolist(), n_results=5, where=where)["ids"][
+            0
+        ] == nearest("a", 5)
+    items = collection.query(query_embeddings=query.tolist(), n_results=20, where={"tenant": "b"})
+    assert items["ids"][0] == nearest("b", 10)
+    assert collection.query(query_embeddings=query.tolist(), n_results=10)["ids"][0] == nearest(
+        None, 10
+    )
+
+    # moving an element to another partition, and deleting one
+    closest_b = nearest("b", 1)[0]
+    collection.update(ids=[closest_b], metadatas=[{"tenant": "a"}])
+    tenants[ids.index(closest_b)] = "a"
+    collection.delete(ids=[nearest("a", 1)[0]])
+    tenants[ids.index(nearest("a", 1)[0])] = "deleted"
+    assert collection.query(query_embeddings=query.tolist(), n_results=5, where={"tenant": "a"})[
+        "ids"
+    ][0] == nearest("a", 5)
+    assert collection.query(query_embeddings=query.tolist(), n_results=5, where={"tenant": "b"})[
+        "ids"
+    ][0] == nearest("b", 5)
+
+    collection.create_index()
+    assert idx.partition_route(collection_uuid, {"tenant": "a"})[1] is False
+    assert collection.query(query_embeddings=query.tolist(), n_results=5, where={"tenant": "a"})[
+        "ids"
+    ][0] == nearest("a", 5)
+    assert collection.query(query_embeddings=query.tolist(), n_results=5)["ids"][0] == nearest(
+        None, 5
+    )
+
+
+def test_persist_segments():
+    persist_directory = tempfile.mkdtemp()
+
+    def client():
+        return chromadb.Client(
+            Settings(
+                chroma_api_impl="local",
+                chroma_db_impl="duckdb+parquet",
+                persist_directory=persist_directory,
+                chroma_db_max_segments=3,
+            )
+        )
+
+    api = client()
+    collection = api.create_collection("test_segments")
+    collection_uuid = api._db.get_collection_uuid_from_name("test_segments")
+
+    def segments():
+        with open(f"{persist_directory}/embeddings/{collection_uuid}/manifest.json") as f:
+            return json.load(f)["segments"]
+
+    rng = np.random.default_rng(3)
+    collection.add(embeddings=rng.random((100, 3)).tolist(), ids=[f"id{i}" for i in range(100)])
+    api.persist()
+    assert [s["rows"] for s in segments()] == [100]
+
+    # each persist writes only the rows changed since the last one
+    collection.add(embeddings=rng.random((2, 3)).tolist(), ids=["new0", "new1"])
+    api.persist()
+    assert [s["rows"] for s in segments()] == [100, 2]
+    collection.update(ids=["id0"], metadatas=[{"updated": True}])
+    collection.delete(ids=["id1", "new0"])
+    api.persist()
+    assert [s["rows"] for s in segments()] == [100, 2, 1]
+    collection.add(embeddings=rng.random((1, 3)).tolist(), ids=["new2"])
+    api.persist()
+    api._db._merging.join()
+    # the small segments are merged, the large one left as it is
+    assert [s["rows"] for s in segments()] == [100, 3]
+
+    loaded = client().get_collection("test_segments")
+    assert loaded.count() == 101
+    assert loaded.get(ids=["id0"])["metadatas"] == [{"updated": True}]
+    assert loaded.get(ids=["id1", "new0"])["ids"] == []
+    assert sorted(loaded.get(ids=["new1", "new2"])["ids"]) == ["new1", "new2"]
+
+
+def test_persist_database_file():
+    persist_directory = tempfile.mkdtemp()
+
+    def client(storage):
+        return chromadb.Client(
+            Settings(
+                chroma_api_impl="local",
+                chroma_db_impl="duckdb+parquet",
+                persist_directory=persist_directory,
+                chroma_db_storage=storage,
+            )
+        )
+
+    # a store saved as parquet segments is moved into the database file
+    api = client("parquet")
+    collection = api.create_collection("test_database_file")
+    rng = np.random.default_rng(4)
+    collection.add(embeddings=rng.random((10, 3)).tolist(), ids=[f"id{i}" for i in range(10)])
+    api.persist()
+    collection.delete(ids=["id0"])
+    api.persist()
+    api._db._persisted_at_exit = True
+    del api, collection
+
+    api = client("file")
+    assert not os.path.exists(f"{persist_directory}/chroma-manifest.json")
+    collection = api.get_collection("test_database_file")
+    assert collection.count() == 9
+    collection.add(embeddings=rng.random((1, 3)).tolist(), ids=["new"], metadatas=[{"a": 1}])
+    collection.update(ids=["id1"], metadatas=[{"b": 2}])
+
+    # writes are in the database file and its log without a persist, as a copy of them shows
+    copied = tempfile.mkdtemp()
+    for name in os.listdir(persist_directory):
+        if name.startswith("chroma.duckdb"):
+            shutil.copy(f"{persist_directory}/{name}", copied)
+    other = duckdb.connect(f"{copied}/chroma.duckdb")
+    rows = other.execute(
+        "SELECT id, metadata FROM embeddings WHERE id IN ('new', 'id1') ORDER BY id"
+    ).fetchall()
+    assert rows == [("id1", '{"b": 2}'), ("new", '{"a": 1}')]
+
+
+@pytest.mark.parametrize(
+    "db_impl, storage",
+    [("duckdb", "parquet"), ("duckdb+parquet", "parquet"), ("duckdb+parquet", "file")],
+)
+def test_concurrent_writes(db_impl, storage):
+    api = chromadb.Client(
+        Settings(
+            chroma_api_impl="local",
+            chroma_db_impl=db_impl,
+            persist_directory=tempfile.mkdtemp(),
+            chroma_db_storage=storage,
+        )
+    )
+    collections = [api.create_collection(f"test_concurrent_{t}") for t in range(4)]
+    errors = []
+
+    def write(t):
+        rng = np.random.default_rng(t)
+        try:
+            for i in range(20):
+                collections[t].add(
+                    embeddings=rng.random((10, 3)).tolist(),
+                    ids=[f"id{i}-{j}" for j in range(10)],
+                    metadatas=[{"i": i}] * 10,
+                )
+                if i % 5 == 4:
+                    collections[t].update(ids=[f"id{i}-0"], metadatas=[{"i": -1}])
+                    collections[t].query(query_embeddings=rng.random((1, 3)).tolist(), n_results=3)
+        except Exception as e:
+            errors.append(e)
+
+    # each request thread has its own views and transactions, none blocks or aborts the others
+    threads = [threading.Thread(target=write, args=(t,)) for t in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+        assert not thread.is_alive()
+    assert errors == []
+    for collection in collections:
+        assert collection.count() == 200
+        assert len(collection.get(where={"i": -1})["ids"]) == 4
+
+
+def test_collections_attached_lazily():
+    persist_directory = tempfile.mkdtemp()
+
+    def client(memory_budget=0):
+        return chromadb.Client(
+            Settings(
+                chroma_api_impl="local",
+                chroma_db_impl="duckdb+parquet",
+                persist_directory=persist_directory,
+                chroma_db_memory_budget=memory_budget,
+            )
+        )
+
+    def loaded(api):
+        return dict(
+            api._db._conn.execute(
+                "SELECT collection_uuid, COUNT(*) FROM embeddings GROUP BY collection_uuid"
+            ).fetchall()
+        )
+
+    api = client()
+    rng = np.random.default_rng(5)
+    for name in ["test_lazy_a", "test_lazy_b", "test_lazy_c"]:
+        api.create_collection(name).add(
+            embeddings=rng.random((50, 3)).tolist(), ids=[f"id{i}" for i in range(50)]
+        )
+    api.persist()
+    api._db._persisted_at_exit = True
+    del api
+
+    # only the collections table is loaded until a collection is used
+    api = client(memory_budget=2 * 50 * (8 * 3 + 80))
+    assert len(api.list_collections()) == 3
+    assert loaded(api) == {}
+    a = api.get_collection("test_lazy_a")
+    assert a.count() == 50
+    a_uuid = api._db.get_collection_uuid_from_name("test_lazy_a")
+    assert loaded(api) == {a_uuid: 50}
+
+    # past the budget the least recently used collection is detached, with its changes saved
+    a.delete(ids=["id0"])
+    assert api.get_collection("test_lazy_b").count() == 50
+    assert api.get_collection("test_lazy_c").count() == 50
+    assert a_uuid not in loaded(api)
+    assert len(loaded(api)) == 2
+    assert a.count() == 49
+    assert a.get(ids=["id0"])["ids"] == []
+
+    # a collection in use by a query is not detached until it is done
+    b_uuid = api._db.get_collection_uuid_from_name("test_lazy_b")
+    with api._db.collection_in_use(b_uuid):
+        assert a.count() == 49
+        assert api.get_collection("test_lazy_c").count() == 50
+        assert b_uuid in loaded(api)
+    assert a.count() == 49
+    assert b_uuid not in loaded(api)
+    items = a.query(query_embeddings=[[0.5, 0.5, 0.5]], n_results=3, include=["metadatas"])
+    assert len(items["ids"][0]) == 3
+
+    # raw sql sees the rows of every collection, none is detached to fit the budget meanwhile
+    assert len(api.raw_sql("SELECT id FROM embeddings")) == 149
+    assert len(api.raw_sql("SELECT DISTINCT collection_uuid FROM embeddings")) == 3
+
+    # with room for a single collection each call attaches its own, detaching the others unless
+    # a call on them is still running
+    api = client(memory_budget=50 * (8 * 3 + 80))
+    collections = [api.get_collection(f"test_lazy_{x}") for x in ["a", "b", "c"]]
+    errors = []
+
+    def use(collection):
+        rng = np.random.default_rng(6)
+        try:
+            for i in range(1, 21):
+                collection.add(
+                    embeddings=rng.random((5, 3)).tolist(), ids=[f"new{i}-{j}" for j in range(5)]
+                )
+                collection.update(ids=[f"id{i}"], metadatas=[{"used": i}])
+                assert len(collection.get(ids=[f"id{i}", f"new{i}-0"])["ids"]) == 2
+                collection.delete(ids=[f"new{i}-1"])
+                collection.query(query_embeddings=rng.random((1, 3)).tolist(), n_results=3)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=use, args=(c,)) for c in collections]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for collection, count in zip(collections, [49, 50, 50]):
+        assert collection.count() == count + 80
+        assert len(collection.get(where={"used": {"$gt": 0}})["ids"]) == 20
+
+    # warming up every index loads the rows of every collection
+    api = client()
+    api.warm_up(["all"], queries=1)
+    assert len(loaded(api)) == 3
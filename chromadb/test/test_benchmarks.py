@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import chromadb
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(chromadb.__file__)))
+
+# the benchmarks are in the repository, not in the installed package
+pytestmark = pytest.mark.skipif(
+    not os.path.isdir(os.path.join(ROOT, "benchmarks")), reason="benchmarks not found"
+)
+
+
+# each benchmark run end to end on a tiny dataset, so that they keep working as the code changes
+@pytest.mark.parametrize(
+    "script, args",
+    [
+        ("add_latency.py", "--elements 200 --batch-size 50 --dim 8"),
+        ("duckdb_add.py", "--rows 20 50 --dim 8"),
+        ("filtered_latency.py", "--elements 500 --dim 8 --queries 5"),
+        ("index_backends.py", "--elements 300 --dim 8 --clusters 5 --queries 10"),
+        ("quantized_recall.py", "--elements 300 --dim 8 --queries 10"),
+        (
+            "query_threads.py",
+            "--elements 300 --dim 8 --seconds 0.05 --threads 1 2 --batch-sizes 1 4",
+        ),
+        ("startup_latency.py", "--elements 300 --dim 8 --workers 1"),
+    ],
+)
+def test_benchmark_runs(script, args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT] + [env["PYTHONPATH"]] if env.get("PYTHONPATH") else [ROOT]
+    )
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmarks", script)] + args.split(),
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stderr
+    assert len(result.stdout.splitlines()) > 1
@@ -0,0 +1,896 @@
+import glob
+import os
+import pickle
+import shutil
+import uuid
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+from chromadb.config import Settings
+from chromadb.db.index.backends import FlatBackend, HnswBackend, IVFBackend, ShardedBackend
+from chromadb.db.index.distances import pairwise_distances
+from chromadb.db.index.hnswlib import Hnswlib, index_params_from_metadata
+from chromadb.db.index.filters import label_filter
+from chromadb.db.index.idmap import IdMap
+from chromadb.db.index.planner import (
+    EXACT,
+    FILTERED,
+    POSTFILTER,
+    plan_filtered_query,
+    query_threads,
+)
+from chromadb.db.index.pool import IndexPool
+from chromadb.db.index.rwlock import ReadWriteLock
+
+
+@pytest.fixture
+def index_settings():
+    # hnsw from the first element, tests of flat indexes raise the threshold
+    return Settings(persist_directory=tempfile.mkdtemp(), chroma_index_flat_threshold=0)
+
+
+def _random_batch(n, dim=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return [uuid.uuid4() for _ in range(n)], rng.random((n, dim)).tolist()
+
+
+def test_pool_evicts_least_recently_used_by_bytes():
+    evicted = []
+    pool = IndexPool(100, on_evict=lambda key, entry: evicted.append(key))
+    pool.put("a", "A", 40)
+    pool.put("b", "B", 40)
+    assert pool.get("a") == "A"
+
+    pool.put("c", "C", 40)
+
+    assert evicted == ["b"]
+    assert "a" in pool and "c" in pool
+    assert pool.get("b") is None
+    assert pool.stats()["hits"] == 1
+    assert pool.stats()["misses"] == 1
+    assert pool.stats()["evictions"] == 1
+
+
+def test_pool_keeps_oversized_entry():
+    pool = IndexPool(10)
+    pool.put("a", "A", 50)
+    assert "a" in pool
+    pool.put("b", "B", 50)
+    assert "a" not in pool and "b" in pool
+
+
+def test_pool_does_not_evict_pinned_entries():
+    pool = IndexPool(100)
+    pool.put("a", "A", 60)
+    pool.pin("a")
+    pool.put("b", "B", 60)
+    pool.put("c", "C", 60)
+    assert "a" in pool and "b" not in pool and "c" in pool
+
+    pool.unpin("a")
+    pool.put("d", "D", 60)
+    assert "a" not in pool
+
+
+def test_warm_up_loads_and_pins_index(index_settings):
+    index_settings.chroma_index_cache_bytes = 1
+    idx = Hnswlib(index_settings)
+    uuids_a, embeddings_a = _random_batch(10, seed=1)
+    uuids_b, embeddings_b = _random_batch(10, seed=2)
+    idx.add_incremental("a", uuids_a, embeddings_a)
+    idx.add_incremental("b", uuids_b, embeddings_b)
+    idx.persist()
+    assert idx.index_status("a") == {"loaded": False, "pinned": False}
+
+    assert idx.warm_up("a", queries=3)
+    assert not idx.warm_up("missing")
+    idx.get_nearest_neighbors("b", [embeddings_b[0]], 1)
+
+    assert idx.index_status("a") == {"loaded": True, "pinned": True}
+    assert idx.index_status("b") == {"loaded": True, "pinned": False}
+    res, _ = idx.get_nearest_neighbors("a", [embeddings_a[3]], 1)
+    assert res[0][0] == uuids_a[3]
+
+
+def test_read_write_lock_writer_waits_for_readers():
+    lock = ReadWriteLock()
+    written = []
+
+    def write():
+        with lock.write():
+            written.append(True)
+
+    with lock.read():
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join(0.1)
+        assert written == []
+    writer.join()
+    assert written == [True]
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_concurrent_queries_and_adds(index_settings, write_behind):
+    index_settings.chroma_index_write_behind = write_behind
+    idx = Hnswlib(index_settings)
+    index_types = {"a": "hnsw", "b": "flat", "c": "sq8", "d": "hnsw"}
+    batches = {
+        name: [_random_batch(20, seed=100 * i + j) for j in range(10)]
+        for i, name in enumerate(index_types)
+    }
+    # "d" is created by whichever of its adders comes first
+    for name in "abc":
+        idx.add_incremental(
+            name, *batches[name][0], index_params_from_metadata({"index:type": index_types[name]})
+        )
+
+    def add(name, batch_numbers):
+        for j in batch_numbers:
+            idx.add_incremental(name, *batches[name][j])
+
+    def query(name):
+        uuids, embeddings = batches[name][0]
+        for i in range(50):
+            res, _ = idx.get_nearest_neighbors(name, [embeddings[i % 20]], 1)
+            assert res[0][0] == uuids[i % 20]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = [executor.submit(add, name, range(1, 10)) for name in "abc"]
+        futures += [executor.submit(add, "d", range(j, 10, 2)) for j in range(2)]
+        futures += [executor.submit(query, name) for name in "abc" for _ in range(4)]
+        for future in futures:
+            future.result()
+    idx.stop()
+
+    for name in index_types:
+        for uuids, embeddings in batches[name]:
+            res, _ = idx.get_nearest_neighbors(name, embeddings[:5], 1)
+            assert [r[0] for r in res] == uuids[:5]
+        assert len(idx._get(name).ids) == 200
+        assert len(Hnswlib(index_settings)._get(name).ids) == 200
+
+
+def test_alternating_collections_stay_resident(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids_a, embeddings_a = _random_batch(10, seed=1)
+    uuids_b, embeddings_b = _random_batch(10, seed=2)
+    idx.add_incremental("a", uuids_a, embeddings_a)
+    idx.add_incremental("b", uuids_b, embeddings_b)
+
+    for _ in range(3):
+        res_a, _ = idx.get_nearest_neighbors("a", [embeddings_a[0]], 1)
+        res_b, _ = idx.get_nearest_neighbors("b", [embeddings_b[0]], 1)
+        assert res_a[0][0] == uuids_a[0]
+        assert res_b[0][0] == uuids_b[0]
+
+    stats = idx.cache_stats()
+    assert stats["misses"] == 2  # only the initial lookups before each index was built
+    assert stats["evictions"] == 0
+
+
+def test_evicted_index_is_reloaded_from_disk(index_settings):
+    index_settings.chroma_index_cache_bytes = 1
+    idx = Hnswlib(index_settings)
+    uuids_a, embeddings_a = _random_batch(10, seed=1)
+    uuids_b, embeddings_b = _random_batch(10, seed=2)
+    idx.add_incremental("a", uuids_a, embeddings_a)
+    idx.add_incremental("b", uuids_b, embeddings_b)
+
+    res_a, _ = idx.get_nearest_neighbors("a", [embeddings_a[3]], 1)
+    assert res_a[0][0] == uuids_a[3]
+    assert idx.cache_stats()["evictions"] >= 1
+
+
+def test_write_behind_recovers_acknowledged_writes(index_settings):
+    index_settings.chroma_index_write_behind = True
+    index_settings.chroma_index_flush_interval = 3600
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(20, seed=3)
+    idx.add_incremental("a", uuids[:10], embeddings[:10])
+    idx.add_incremental("a", uuids[10:], embeddings[10:])
+    idx.delete_from_index("a", [uuids[0]])
+
+    # a second instance sees only the index files and the write-ahead log, as after a crash
+    recovered = Hnswlib(index_settings)
+    assert recovered.get_metadata("a")["elements"] == 20
+    res, _ = recovered.get_nearest_neighbors("a", [embeddings[15]], 1)
+    assert res[0][0] == uuids[15]
+    res, _ = recovered.get_nearest_neighbors("a", [embeddings[0]], 19)
+    assert uuids[0] not in res[0]
+
+    idx.stop()
+    recovered.stop()
+
+
+def test_write_behind_persist_saves_index(index_settings):
+    index_settings.chroma_index_write_behind = True
+    index_settings.chroma_index_flush_interval = 3600
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(20, seed=4)
+    idx.add_incremental("a", uuids[:10], embeddings[:10])
+    idx.add_incremental("a", uuids[10:], embeddings[10:])
+
+    idx.persist()
+    assert not os.path.exists(idx._path("wal", "a", "log"))
+
+    idx.stop()
+    index_settings.chroma_index_write_behind = False
+    reloaded = Hnswlib(index_settings)
+    assert reloaded.get_metadata("a")["elements"] == 20
+
+
+def test_capacity_grows_geometrically_and_compacts(index_settings):
+    index_settings.chroma_index_growth_factor = 2.0
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(25, seed=5)
+    idx.add_incremental("a", uuids[:10], embeddings[:10])
+    idx.add_incremental("a", uuids[10:11], embeddings[10:11])
+    assert idx.get_metadata("a")["capacity"] == 20
+
+    idx.add_incremental("a", uuids[11:25], embeddings[11:25])
+    assert idx.get_metadata("a")["capacity"] == 40
+    assert idx.get_metadata("a")["elements"] == 25
+
+    idx.compact("a")
+    assert idx.get_metadata("a")["capacity"] == 25
+    assert Hnswlib(index_settings).get_metadata("a")["capacity"] == 25
+
+
+def test_loads_pickled_id_mappers_of_previous_format(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(10, seed=6)
+    idx.add_incremental("a", uuids, embeddings)
+
+    # lay the files out the way indexes used to be saved, before snapshots and with pickled
+    # mappings
+    snapshot = idx._files("a", idx._snapshot_version("a"))
+    for kind in ["index", "index_metadata"]:
+        shutil.move(snapshot[kind], idx._files("a", None)[kind])
+    idx._remove_snapshots("a")
+    os.remove(idx._path("manifest", "a", "json"))
+    with open(idx._path("id_to_uuid", "a", "pkl"), "wb") as f:
+        pickle.dump({i: u for i, u in enumerate(uuids)}, f)
+    with open(idx._path("uuid_to_id", "a", "pkl"), "wb") as f:
+        pickle.dump({u.hex: i for i, u in enumerate(uuids)}, f)
+
+    legacy = Hnswlib(index_settings)
+    res, _ = legacy.get_nearest_neighbors("a", [embeddings[7]], 1, uuids=uuids[5:])
+    assert res[0][0] == uuids[7]
+
+    # the next save writes a snapshot in place of the previous files
+    legacy.delete_from_index("a", uuids[:1])
+    assert sorted(os.listdir(f"{index_settings.persist_directory}/index")) == [
+        "manifest_a.json",
+        "publish_a.lock",
+        "snapshot_a.1",
+    ]
+    assert len(Hnswlib(index_settings)._get("a").ids) == 9
+
+
+def test_saves_publish_snapshots_atomically(index_settings, monkeypatch):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(40, seed=7)
+    idx.add_incremental("a", uuids[:10], embeddings[:10])
+    reader = Hnswlib(index_settings)
+    assert len(reader._get("a").ids) == 10
+
+    # a save that fails part way leaves the previous snapshot published
+    def failing_save(self, *args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(IdMap, "save", failing_save)
+    with pytest.raises(OSError):
+        idx.add_incremental("a", uuids[10:20], embeddings[10:20])
+    monkeypatch.undo()
+    assert len(Hnswlib(index_settings)._get("a").ids) == 10
+
+    for start in [20, 30]:
+        idx.add_incremental("a", uuids[start : start + 10], embeddings[start : start + 10])
+    # only the last two snapshots are kept, the partial one is cleaned up
+    assert sorted(glob.glob(f"{index_settings.persist_directory}/index/snapshot_a.*")) == [
+        idx._snapshot_path("a", 2),
+        idx._snapshot_path("a", 3),
+    ]
+    assert idx._snapshot_version("a") == 3
+    assert len(Hnswlib(index_settings)._get("a").ids) == 40
+    # a process that loaded an earlier snapshot keeps serving it
+    res, _ = reader.get_nearest_neighbors("a", embeddings[3:4], 1)
+    assert res[0][0] == uuids[3]
+
+
+def test_concurrent_saves_publish_distinct_snapshots(index_settings):
+    uuids, embeddings = _random_batch(210, seed=7)
+    Hnswlib(index_settings).add_incremental("a", uuids[:10], embeddings[:10])
+    # as two processes would, each with the index loaded and saving it after every add
+    writers = [Hnswlib(index_settings), Hnswlib(index_settings)]
+    for writer in writers:
+        writer._get("a")
+
+    def add(writer, start):
+        for i in range(start, start + 100, 10):
+            writer.add_incremental("a", uuids[i : i + 10], embeddings[i : i + 10])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for future in [executor.submit(add, writers[0], 10), executor.submit(add, writers[1], 110)]:
+            future.result()
+    assert writers[0]._snapshot_version("a") == 21
+    assert sorted(glob.glob(f"{index_settings.persist_directory}/index/snapshot_a.*")) == [
+        writers[0]._snapshot_path("a", 20),
+        writers[0]._snapshot_path("a", 21),
+    ]
+    assert len(Hnswlib(index_settings)._get("a").ids) == 110
+
+
+def test_corrupt_snapshot_is_not_mistaken_for_a_missing_one(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(10, seed=7)
+    idx.add_incremental("a", uuids, embeddings)
+    with open(idx._files("a", idx._snapshot_version("a"))["index_metadata"], "wb") as f:
+        f.write(b"not a pickle")
+
+    with pytest.raises(pickle.UnpicklingError):
+        Hnswlib(index_settings)._get("a")
+    idx.delete("a")
+    assert Hnswlib(index_settings)._get("a") is None
+
+
+def test_id_map_round_trip(index_settings):
+    ids = IdMap()
+    uuids = [uuid.uuid4() for _ in range(1000)]
+    ids.add(uuids, np.arange(1000))
+    ids.remove(uuids[:10])
+
+    path = index_settings.persist_directory
+    ids.save(f"{path}/uuids.npy", f"{path}/table.npy")
+    loaded = IdMap.load(f"{path}/uuids.npy", f"{path}/table.npy")
+
+    assert len(loaded) == 990
+    assert loaded.labels_for(uuids[8:12]).tolist() == [-1, -1, 10, 11]
+    assert loaded.uuids_for(np.array([[42, 999]])) == [[uuids[42], uuids[999]]]
+
+
+@pytest.mark.parametrize(
+    "exact_threshold, exact_scan_cost, postfilter_selectivity",
+    # exact scan, post-filtered and filtered hnsw
+    [(1000, 3.0, 0.5), (0, float("inf"), 0.0), (0, float("inf"), 1.1)],
+)
+def test_filtered_query_plans_agree(
+    index_settings, exact_threshold, exact_scan_cost, postfilter_selectivity
+):
+    index_settings.chroma_query_exact_threshold = exact_threshold
+    index_settings.chroma_query_exact_scan_cost = exact_scan_cost
+    index_settings.chroma_query_postfilter_selectivity = postfilter_selectivity
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(200, seed=7)
+    idx.add_incremental("a", uuids, embeddings)
+
+    allowed = uuids[::4]
+    res, distances = idx.get_nearest_neighbors("a", embeddings[:3], 5, uuids=allowed)
+
+    data = np.array(embeddings)
+    for q in range(3):
+        expected = np.argsort(((data[::4] - data[q]) ** 2).sum(axis=1))[:5]
+        assert res[q] == [allowed[i] for i in expected]
+        assert np.all(np.diff(distances[q]) >= 0)
+
+
+def test_exact_plan_follows_scan_size_and_selectivity():
+    def plan(filter_size, index_size, dim=128, ef=32):
+        return plan_filtered_query(filter_size, index_size, dim, ef, 65536, 3.0, 0.5)
+
+    # a scan of a few vectors is cheap whatever it is weighed against
+    assert plan(400, 1000) == EXACT
+    assert plan(400, 1000, dim=256) == FILTERED
+    # the same scan is worth more against a search of a larger graph for a narrower filter
+    assert plan(2000, 100000) == FILTERED
+    assert plan(2000, 1000000) == EXACT
+    assert plan(10000, 1000000) == FILTERED
+    assert plan(500000, 1000000) == POSTFILTER
+
+
+def test_label_filter_matches_allowed_labels():
+    allowed = label_filter(np.array([0, 3, 7]), 8)
+    assert [i for i in range(8) if allowed(i)] == [0, 3, 7]
+
+
+def test_search_ef_follows_k_and_recall_target(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(500, dim=8, seed=8)
+    idx.add_incremental("a", uuids, embeddings)
+    loaded = idx._get("a")
+
+    idx.get_nearest_neighbors("a", embeddings[:1], 1)
+    small_k_ef = loaded.index.ef
+    idx.get_nearest_neighbors("a", embeddings[:1], 100)
+    assert loaded.index.ef > small_k_ef >= 10
+
+    idx.get_nearest_neighbors("a", embeddings[:1], 5, search_ef=77)
+    assert loaded.index.ef == 77
+
+    # the first recall targeted query calibrates the index, the calibration is saved with it
+    idx.get_nearest_neighbors("a", embeddings[:1], 10, recall_target=0.97)
+    calibration = idx.get_metadata("a")["ef_calibration"]
+    assert calibration["ef"][0.97] == loaded.index.ef
+    assert calibration["ef"][0.9] <= calibration["ef"][0.97] <= calibration["ef"][0.99]
+    assert Hnswlib(index_settings).get_metadata("a")["ef_calibration"] == calibration
+
+
+def test_queries_at_different_ef_do_not_change_each_others(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(200, dim=8, seed=9)
+    idx.add_incremental("a", uuids, embeddings, index_params_from_metadata({"index:type": "flat"}))
+    index = idx._get("a").index
+    knn_query = index.knn_query
+    changed = []
+
+    def slow_knn_query(*args, **kwargs):
+        ef = index.ef
+        time.sleep(0.001)
+        changed.append(index.ef != ef)
+        return knn_query(*args, **kwargs)
+
+    index.knn_query = slow_knn_query
+
+    def query(search_ef):
+        for _ in range(20):
+            idx.get_nearest_neighbors("a", embeddings[:1], 5, search_ef=search_ef)
+
+    threads = [threading.Thread(target=query, args=(ef,)) for ef in [20, 20, 40, 60]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(changed) == 80 and not any(changed)
+
+
+def test_new_recall_targets_are_added_to_the_calibration(index_settings, monkeypatch):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(500, dim=8, seed=8)
+    idx.add_incremental("a", uuids, embeddings)
+    measured = []
+    exact_neighbors = Hnswlib._exact_neighbors
+
+    def counting_exact_neighbors(self, *args):
+        measured.append(1)
+        return exact_neighbors(self, *args)
+
+    monkeypatch.setattr(Hnswlib, "_exact_neighbors", counting_exact_neighbors)
+    for target in [0.995, 0.999, 0.995, 0.999, 0.999]:
+        idx.get_nearest_neighbors("a", embeddings[:1], 10, recall_target=target)
+    assert len(measured) == 2
+    calibration = idx.get_metadata("a")["ef_calibration"]
+    assert sorted(calibration["ef"]) == [0.9, 0.95, 0.99, 0.995, 0.999]
+    # queries that waited on the lock while another calibrated their target measure nothing
+    idx.calibrate("a", [0.9, 0.999], merge=True)
+    assert len(measured) == 2
+
+    # an explicit calibration replaces the table
+    assert list(idx.calibrate("a", [0.9])) == [0.9]
+    assert list(idx.get_metadata("a")["ef_calibration"]["ef"]) == [0.9]
+
+
+def test_reconfigure_applies_search_params_and_refuses_others(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(20, seed=8)
+    idx.add_incremental("a", uuids, embeddings)
+
+    idx.reconfigure("a", index_params_from_metadata({"hnsw:search_ef": 40, "hnsw:num_threads": 1}))
+    assert idx._get("a").index.ef == 40
+    assert Hnswlib(index_settings).get_metadata("a")["ef"] == 40
+
+    for metadata in [
+        {"hnsw:space": "ip"},
+        {"index:type": "flat"},
+        {"index:partition_key": "tenant"},
+    ]:
+        with pytest.raises(ValueError):
+            idx.reconfigure("a", index_params_from_metadata(metadata))
+    # a collection without an index takes any configuration
+    idx.reconfigure("b", index_params_from_metadata({"hnsw:space": "ip"}))
+
+
+def test_deleted_slots_are_reused(index_settings):
+    index_settings.chroma_index_compaction_threshold = 1.1
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(100, seed=9)
+    idx.add_incremental("a", uuids, embeddings)
+
+    for round in range(5):
+        new_uuids, new_embeddings = _random_batch(10, seed=10 + round)
+        idx.delete_from_index("a", uuids[round * 10 : round * 10 + 10])
+        assert idx.get_metadata("a")["deleted"] == 10
+        idx.add_incremental("a", new_uuids, new_embeddings)
+
+        metadata = idx.get_metadata("a")
+        assert (metadata["elements"], metadata["deleted"], metadata["capacity"]) == (100, 0, 100)
+        res, _ = idx.get_nearest_neighbors("a", new_embeddings[3:4], 1)
+        assert res[0][0] == new_uuids[3]
+
+
+def test_compaction_drops_deleted_elements_and_keeps_concurrent_writes(index_settings):
+    index_settings.chroma_index_compaction_threshold = 1.1
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(100, seed=20)
+    late_uuids, late_embeddings = _random_batch(5, seed=21)
+    idx.add_incremental("a", uuids, embeddings)
+    idx.delete_from_index("a", uuids[:60])
+
+    # writes made while the compacted copy is built are replayed onto it
+    build = idx._build
+
+    def build_during_writes(*args):
+        index = build(*args)
+        idx.add_incremental("a", late_uuids, late_embeddings)
+        idx.delete_from_index("a", uuids[60:62])
+        return index
+
+    idx._build = build_during_writes
+    idx.compact("a")
+
+    # the deletes replayed onto the copy leave their own tombstones
+    metadata = idx.get_metadata("a")
+    assert (metadata["elements"], metadata["deleted"]) == (45, 2)
+    for loaded in [idx._get("a"), Hnswlib(index_settings)._get("a")]:
+        assert loaded.index.element_count == 45
+        assert set(loaded.ids.uuids_for(loaded.ids.live_labels()[None, :])[0]) == set(
+            uuids[62:] + late_uuids
+        )
+
+    res, _ = idx.get_nearest_neighbors("a", late_embeddings[:1], 1)
+    assert res[0][0] == late_uuids[0]
+
+
+def test_compaction_starts_in_background_past_dead_ratio(index_settings):
+    index_settings.chroma_index_compaction_threshold = 0.3
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(100, seed=22)
+    idx.add_incremental("a", uuids, embeddings)
+
+    idx.delete_from_index("a", uuids[:20])
+    assert idx.get_metadata("a")["elements"] == 100
+    idx.delete_from_index("a", uuids[20:30])
+    idx.stop()  # waits for the compaction
+    assert idx.get_metadata("a")["elements"] == 70
+
+
+def test_build_from_chunks_sizes_index_up_front(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(30, seed=23)
+    chunks = [(uuids[i : i + 8], np.array(embeddings[i : i + 8])) for i in range(0, 30, 8)]
+
+    idx.build("a", 30, chunks)
+    assert idx.get_metadata("a")["capacity"] == 30
+    assert idx.get_metadata("a")["elements"] == 30
+
+    # a collection that grew after it was counted still gets all its embeddings indexed
+    idx.build("b", 10, chunks)
+    assert idx.get_metadata("b")["elements"] == 30
+    res, _ = idx.get_nearest_neighbors("b", embeddings[29:], 1)
+    assert res[0][0] == uuids[29]
+
+
+@pytest.mark.parametrize("space", ["l2", "cosine", "ip"])
+def test_flat_index_is_exact(index_settings, space):
+    index_settings.chroma_index_flat_threshold = 1000
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(300, dim=8, seed=24)
+    params = index_params_from_metadata({"hnsw:space": space})
+    idx.add_incremental("a", uuids[:200], embeddings[:200], params)
+    idx.add_incremental("a", uuids[200:], embeddings[200:])
+    idx.delete_from_index("a", uuids[:10])
+    assert idx.get_metadata("a")["backend"] == "flat"
+
+    data = np.array(embeddings, dtype=np.float32)
+    queries = data[[5, 50, 250]]
+    for loaded in [idx, Hnswlib(index_settings)]:
+        res, distances = loaded.get_nearest_neighbors("a", queries, 5)
+        allowed = uuids[::3]
+        filtered, _ = loaded.get_nearest_neighbors("a", queries, 5, uuids=allowed)
+
+        expected = pairwise_distances(queries, data, space)
+        expected[:, :10] = np.inf
+        for q in range(3):
+            order = np.argsort(expected[q])
+            assert res[q] == [uuids[i] for i in order[:5]]
+            assert np.allclose(distances[q], expected[q, order[:5]], atol=1e-5)
+            assert filtered[q] == [uuids[i] for i in order if i % 3 == 0][:5]
+
+
+def test_auto_index_is_promoted_to_hnsw(index_settings):
+    index_settings.chroma_index_flat_threshold = 50
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(80, seed=25)
+    idx.add_incremental("a", uuids[:40], embeddings[:40])
+    assert idx.get_metadata("a")["backend"] == "flat"
+
+    idx.add_incremental("a", uuids[40:], embeddings[40:])
+    idx.stop()  # waits for the promotion
+    assert idx.get_metadata("a")["backend"] == "hnsw"
+    assert Hnswlib(index_settings).get_metadata("a")["backend"] == "hnsw"
+    res, _ = idx.get_nearest_neighbors("a", embeddings[60:61], 1)
+    assert res[0][0] == uuids[60]
+
+    with pytest.raises(ValueError):
+        index_params_from_metadata({"index:type": "lsh"})
+
+
+def test_each_collection_is_indexed_by_its_own_backend(index_settings):
+    index_settings.chroma_index_flat_threshold = 50
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(40, seed=26)
+    backends = {
+        "a": ({}, FlatBackend),
+        "b": ({"index:type": "hnsw"}, HnswBackend),
+        "c": ({"hnsw:shards": 2, "index:type": "hnsw"}, ShardedBackend),
+        "d": ({"index:type": "ivf", "ivf:nlist": 2}, IVFBackend),
+    }
+    for name, (metadata, _) in backends.items():
+        idx.add_incremental(name, uuids, embeddings, index_params_from_metadata(metadata))
+
+    for name, (_, backend) in backends.items():
+        assert type(idx._get(name).backend) is backend
+        res, _ = idx.get_nearest_neighbors(name, embeddings[7:8], 1)
+        assert res[0][0] == uuids[7]
+    idx.stop()
+
+
+@pytest.mark.parametrize("index_type", ["sq8", "pq"])
+def test_quantized_index_reranks_to_exact_neighbors(index_settings, index_type):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(400, dim=16, seed=26)
+    params = index_params_from_metadata({"index:type": index_type, "index:rerank": 20})
+    idx.add_incremental("a", uuids, embeddings, params)
+    assert idx.get_metadata("a")["backend"] == index_type
+
+    data = np.array(embeddings, dtype=np.float32)
+    queries = data[[5, 50, 250]]
+    expected = pairwise_distances(queries, data, "l2")
+    for loaded in [idx, Hnswlib(index_settings)]:
+        res, distances = loaded.get_nearest_neighbors("a", queries, 5)
+        for q in range(3):
+            order = np.argsort(expected[q])
+            assert res[q] == [uuids[i] for i in order[:5]]
+            assert np.allclose(distances[q], expected[q, order[:5]], atol=1e-5)
+
+    # codes are resident, the full precision vectors are mapped from the index file
+    assert idx._get("a").index.nbytes() < data.nbytes
+    assert isinstance(idx._get("a").index._full, np.memmap)
+
+    # without re-ranking the scan of the codes alone still finds mostly the same neighbors
+    approximate = Hnswlib(index_settings)
+    approximate._get("a").index.rerank = 0
+    res, _ = approximate.get_nearest_neighbors("a", queries, 5)
+    found = sum(len(set(r) & {uuids[i] for i in np.argsort(e)[:5]}) for r, e in zip(res, expected))
+    assert found >= 8
+
+
+def test_quantized_index_is_retrained_as_it_grows(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(200, dim=8, seed=27)
+    params = index_params_from_metadata({"index:type": "pq", "pq:subvectors": 4})
+    idx.add_incremental("a", uuids[:10], embeddings[:10], params)
+    assert idx._get("a").index.trained_on == 10
+
+    idx.add_incremental("a", uuids[10:], embeddings[10:])
+    idx.stop()  # waits for the retraining
+    assert idx._get("a").index.trained_on == 200
+    assert idx.get_metadata("a")["pq_subvectors"] == 4
+    res, _ = idx.get_nearest_neighbors("a", embeddings[150:151], 1)
+    assert res[0][0] == uuids[150]
+
+    with pytest.raises(ValueError):
+        index_params_from_metadata({"index:rerank": -1})
+
+
+def test_ivf_index_keeps_vectors_on_disk(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(500, dim=8, seed=28)
+    params = index_params_from_metadata({"index:type": "ivf", "ivf:nlist": 8})
+    idx.add_incremental("a", uuids[:300], embeddings[:300], params)
+    idx.add_incremental("a", uuids[300:], embeddings[300:])
+    idx.delete_from_index("a", uuids[:10])
+    assert idx.get_metadata("a")["backend"] == "ivf"
+
+    data = np.array(embeddings, dtype=np.float32)
+    queries = data[[5, 50, 450]]
+    expected = pairwise_distances(queries, data, "l2")
+    expected[:, :10] = np.inf
+    for loaded in [idx, Hnswlib(index_settings)]:
+        # probing every list is exact
+        res, distances = loaded.get_nearest_neighbors("a", queries, 5, search_ef=8)
+        filtered, _ = loaded.get_nearest_neighbors("a", queries, 5, uuids=uuids[::3], search_ef=8)
+        for q in range(3):
+            order = np.argsort(expected[q])
+            assert res[q] == [uuids[i] for i in order[:5]]
+            assert np.allclose(distances[q], expected[q, order[:5]], atol=1e-5)
+            assert filtered[q] == [uuids[i] for i in order if i % 3 == 0][:5]
+        # probing a single list still finds the element itself
+        res, _ = loaded.get_nearest_neighbors("a", queries[1:], 1, search_ef=1)
+        assert [r[0] for r in res] == [uuids[50], uuids[450]]
+
+    # only the centroids and a few integers per element are resident
+    assert idx._get("a").index.nbytes() < data.nbytes
+    idx.delete("a")
+    assert os.listdir(f"{index_settings.persist_directory}/index") == []
+
+
+def test_ivf_index_is_clustered_again_as_it_grows(index_settings):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(200, dim=4, seed=29)
+    idx.add_incremental(
+        "a", uuids[:10], embeddings[:10], index_params_from_metadata({"index:type": "ivf"})
+    )
+    assert idx._get("a").index.clustered_for == 10
+
+    idx.add_incremental("a", uuids[10:], embeddings[10:])
+    idx.stop()  # waits for the clustering
+    index = idx._get("a").index
+    assert index.clustered_for == 200
+    assert len(index._centroids) == 14
+    # the vectors file of the index it replaced is gone
+    assert glob.glob(f"{index_settings.persist_directory}/index/*.ivf") == index.data_files
+    res, _ = idx.get_nearest_neighbors("a", embeddings[150:151], 1)
+    assert res[0][0] == uuids[150]
+
+
+def test_ivf_index_loaded_from_disk_appends_to_a_file_of_its_own(index_settings):
+    index_settings.chroma_index_write_behind = True
+    index_settings.chroma_index_flush_interval = 3600
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(300, dim=4, seed=31)
+    params = index_params_from_metadata({"index:type": "ivf", "ivf:nlist": 4})
+    idx.add_incremental("a", uuids[:100], embeddings[:100], params)
+    # logged and appended to the vectors file, but not saved yet
+    idx.add_incremental("a", uuids[100:200], embeddings[100:200])
+    written = idx._get("a").index.data_files
+    sizes = [os.path.getsize(path) for path in written]
+
+    # a second instance loads the saved snapshot and replays the log into a file of its own,
+    # leaving the rows the first one appended past the snapshot alone
+    reader = Hnswlib(index_settings)
+    loaded = reader._get("a")
+    assert len(loaded.ids) == 200
+    assert loaded.index.data_files[:-1] == written
+    assert [os.path.getsize(path) for path in written] == sizes
+
+    idx.add_incremental("a", uuids[200:], embeddings[200:])
+    for index, queried in [(idx, [150, 250]), (reader, [50, 150])]:
+        res, _ = index.get_nearest_neighbors("a", [embeddings[i] for i in queried], 1, search_ef=4)
+        assert [r[0] for r in res] == [uuids[i] for i in queried]
+    idx.stop()
+    reader.stop()
+
+
+def test_ivf_vectors_files_are_written_out_as_one_once_there_are_many(index_settings):
+    uuids, embeddings = _random_batch(200, dim=4, seed=32)
+    params = index_params_from_metadata({"index:type": "ivf", "ivf:nlist": 4})
+    Hnswlib(index_settings).add_incremental("a", uuids[:100], embeddings[:100], params)
+    # each instance loads the index and appends to a new file
+    for start in range(100, 200, 10):
+        idx = Hnswlib(index_settings)
+        idx.add_incremental("a", uuids[start : start + 10], embeddings[start : start + 10])
+        idx.stop()  # waits for the rebuild
+
+    # the ninth file made the index rebuild into one, the last two added one each since
+    index = Hnswlib(index_settings)._get("a").index
+    assert len(index.data_files) == 3
+    assert sorted(glob.glob(f"{index_settings.persist_directory}/index/*.ivf")) == sorted(
+        index.data_files
+    )
+    res, _ = Hnswlib(index_settings).get_nearest_neighbors("a", embeddings[195:196], 1, search_ef=4)
+    assert res[0][0] == uuids[195]
+
+
+@pytest.mark.parametrize("index_type", ["flat", "sq8", "ivf"])
+def test_index_files_are_memory_mapped(index_settings, index_type):
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(100, dim=4, seed=30)
+    params = index_params_from_metadata({"index:type": index_type})
+    idx.add_incremental("a", uuids[:80], embeddings[:80], params)
+
+    loaded = Hnswlib(index_settings)._get("a")
+    assert isinstance(loaded.index._present, np.memmap)
+    assert len(loaded.ids) == 80
+
+    # writes go to private copies of the mapped pages, and the next save maps the new file
+    other = Hnswlib(index_settings)
+    other.add_incremental("a", uuids[80:], embeddings[80:])
+    other.delete_from_index("a", uuids[:5])
+    assert isinstance(other._get("a").index._present, np.memmap)
+    for index in [loaded, other._get("a"), Hnswlib(index_settings)._get("a")]:
+        expected = 80 if index is loaded else 95
+        assert len(index.ids) == expected
+        found, _ = index.index.knn_query(np.array(embeddings[50:51], dtype=np.float32), k=1)
+        assert index.ids.uuids_for(found)[0][0] == uuids[50]
+
+
+def test_query_threads_keep_small_batches_on_one_thread():
+    assert query_threads(1, 8, 16) == 1
+    assert query_threads(31, 8, 16) == 1
+    assert query_threads(64, 8, 16) == 4
+    assert query_threads(1000, 8, 16) == 8
+
+
+@pytest.mark.parametrize("index_type", ["hnsw", "flat", "sq8", "ivf"])
+def test_batched_queries_split_across_threads_agree(index_settings, index_type):
+    index_settings.chroma_query_min_queries_per_thread = 1
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(500, dim=8, seed=40)
+    idx.add_incremental(
+        "a", uuids, embeddings, index_params_from_metadata({"index:type": index_type})
+    )
+    _, queries = _random_batch(40, dim=8, seed=41)
+
+    expected, expected_distances = idx.get_nearest_neighbors("a", queries, 5, num_threads=1)
+    for num_threads in [2, 7]:
+        results, distances = idx.get_nearest_neighbors("a", queries, 5, num_threads=num_threads)
+        assert results == expected
+        assert np.allclose(distances, expected_distances)
+    # filtered to a few elements, the batch is scanned exactly
+    results, _ = idx.get_nearest_neighbors("a", queries, 1, uuids=uuids[:20], num_threads=4)
+    nearest = np.argmin(
+        pairwise_distances(np.array(queries), np.array(embeddings[:20]), "l2"), axis=1
+    )
+    assert [r[0] for r in results] == [uuids[i] for i in nearest]
+
+
+@pytest.mark.parametrize("metadata", [{}, {"hnsw:shards": 3}])
+def test_filtered_batches_split_across_threads_agree(index_settings, metadata):
+    index_settings.chroma_query_min_queries_per_thread = 1
+    index_settings.chroma_query_exact_threshold = 0
+    index_settings.chroma_query_exact_scan_cost = float("inf")
+    index_settings.chroma_query_postfilter_selectivity = 1.1
+    idx = Hnswlib(index_settings)
+    uuids, embeddings = _random_batch(500, dim=8, seed=42)
+    idx.add_incremental("a", uuids, embeddings, index_params_from_metadata(metadata))
+    _, queries = _random_batch(40, dim=8, seed=43)
+
+    expected, _ = idx.get_nearest_neighbors("a", queries, 5, uuids=uuids[::3], num_threads=1)
+    assert all(set(r) <= set(uuids[::3]) for r in expected)
+    for num_threads in [2, 7]:
+        results, _ = idx.get_nearest_neighbors(
+            "a", queries, 5, uuids=uuids[::3], num_threads=num_threads
+        )
+        assert results == expected
+
+
+def test_sharded_index_matches_exact_neighbors(index_settings):
+    index_settings.chroma_query_exact_threshold = 0
+    index_settings.chroma_query_exact_scan_cost = float("inf")
+    idx = Hnswlib(index_settings)
+    params = index_params_from_metadata(
+        {"index:type": "hnsw", "hnsw:shards": 3, "hnsw:search_ef": 100}
+    )
+    uuids, embeddings = _random_batch(300, dim=8, seed=50)
+    idx.add_incremental("a", uuids[:200], embeddings[:200], params)
+    idx.add_incremental("a", uuids[200:], embeddings[200:], params)
+    idx.delete_from_index("a", uuids[:30])
+    loaded = idx._get("a")
+    assert loaded.metadata["shards"] == 3
+    assert [index.element_count for index in loaded.index._indexes] == [100, 100, 100]
+
+    _, queries = _random_batch(20, dim=8, seed=51)
+    vectors = np.array(embeddings)
+
+    def exact(candidates, k):
+        distances = pairwise_distances(np.array(queries), vectors[candidates], "l2")
+        return [[uuids[candidates[i]] for i in row] for row in np.argsort(distances, axis=1)[:, :k]]
+
+    results, distances = idx.get_nearest_neighbors("a", queries, 5)
+    assert results == exact(np.arange(30, 300), 5)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    # filtered to fewer elements than are asked for from some shards
+    results, _ = idx.get_nearest_neighbors("a", queries, 4, uuids=uuids[25:35])
+    assert results == exact(np.arange(30, 35), 4)
+
+    reloaded = Hnswlib(index_settings)
+    assert reloaded.get_nearest_neighbors("a", queries, 5)[0] == exact(np.arange(30, 300), 5)
+
+
+def test_shards_must_be_positive():
+    with pytest.raises(ValueError):
+        index_params_from_metadata({"hnsw:shards": 0})